@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+This file is used to calibrate the color sensor from the raw samples recorded by
+`python3 get_colors.py batch` on the robot (copy color_samples.csv to this folder).
+It should be run on your computer, not on the robot.
+
+It fits a Gaussian to the normalized RGB vectors and to the ambient values of every
+label, and reports how well the labels can be told apart:
+- the Bhattacharyya distance between the Gaussians of every pair of labels, and the
+  bound of the misclassification rate between the two that it gives,
+- the misclassification rate of the samples by the classifier of color.py (closest
+  mean), and its confusion matrix,
+- the is_black tolerance with the fewest misclassified ambient samples.
+
+With -write, the colors, ambients and thresholds used by color.py are written to the
+project folder: python3 color_calibration.py [samples file] -write
+
+Before running this script for the first time, you must install the dependencies
+as explained in the README.md file.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from loader import group_mean_std, load_csv
+
+# Wanted CSV file containing the samples
+COLOR_SAMPLES_FILE = "color_samples.csv"
+
+# Files read by color.py
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project")
+COLORS_FILE = os.path.join(PROJECT_DIR, "colors.csv")
+AMBIENTS_FILE = os.path.join(PROJECT_DIR, "ambients.csv")
+THRESHOLDS_FILE = os.path.join(PROJECT_DIR, "thresholds.csv")
+
+DEFAULT_BLACK_TOLERANCE = 0.3  # is_black tolerance of color.py without thresholds file
+COVARIANCE_EPSILON = 1e-6  # added to the covariances, as the normalized vectors lie on a sphere
+
+
+def fit_gaussians(labels: np.ndarray, values: np.ndarray):
+    """
+    Return the labels, and the mean and covariance matrix of the values of each of them.
+    """
+    names, means, _ = group_mean_std(labels, values)
+    _, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    centered = values - means[inverse]
+    covariances = np.einsum("ni,nj,nk->kij", centered, centered, np.eye(len(names))[inverse])
+    covariances /= np.bincount(inverse, minlength=len(names))[:, None, None]
+    covariances += COVARIANCE_EPSILON * np.eye(values.shape[1])
+    return names, means, covariances
+
+
+def bhattacharyya(mean1: np.ndarray, cov1: np.ndarray, mean2: np.ndarray, cov2: np.ndarray) -> float:
+    """
+    Return the Bhattacharyya distance between two Gaussians. With equal priors, the
+    misclassification rate between them is at most exp(-distance) / 2.
+
+    >>> round(bhattacharyya(np.array([0.0]), np.array([[1.0]]), np.array([2.0]), np.array([[1.0]])), 3)
+    0.5
+    """
+    cov = (cov1 + cov2) / 2
+    diff = mean1 - mean2
+    _, logdet = np.linalg.slogdet(cov)
+    _, logdet1 = np.linalg.slogdet(cov1)
+    _, logdet2 = np.linalg.slogdet(cov2)
+    return float(diff @ np.linalg.solve(cov, diff) / 8 + (logdet - (logdet1 + logdet2) / 2) / 2)
+
+
+def closest_mean(values: np.ndarray, means: np.ndarray) -> np.ndarray:
+    "Return the index of the closest mean to every value, as color.py classifies."
+    distances = np.linalg.norm(values[:, None, :] - means[None, :, :], axis=2)
+    return distances.argmin(axis=1)
+
+
+def black_tolerance(labels: np.ndarray, ambients: np.ndarray, black: float):
+    """
+    Return the is_black tolerance (relative distance to the black ambient) that
+    misclassifies the fewest samples, weighting black and other samples equally,
+    with its misclassification rate.
+    """
+    errors = np.abs(ambients - black) / black
+    is_black = labels == "black"
+    # Every distinct error is a candidate tolerance, evaluated at once from the sorted errors
+    candidates = np.unique(errors)
+    black_errors = np.sort(errors[is_black])
+    other_errors = np.sort(errors[~is_black])
+    missed = 1 - np.searchsorted(black_errors, candidates, side="right") / max(len(black_errors), 1)
+    false = np.searchsorted(other_errors, candidates, side="right") / max(len(other_errors), 1)
+    rates = (missed + false) / 2
+    best = rates.argmin()
+    # Halfway to the next error, not to be right on the edge of a sample
+    tolerance = candidates[best] if best + 1 == len(candidates) else (candidates[best] + candidates[best + 1]) / 2
+    return float(tolerance), float(rates[best])
+
+
+def tolerance_rate(labels: np.ndarray, ambients: np.ndarray, black: float, tolerance: float) -> float:
+    "Return the misclassification rate of is_black with a tolerance."
+    detected = np.abs(ambients - black) / black <= tolerance
+    is_black = labels == "black"
+    return float((np.mean(~detected[is_black]) + np.mean(detected[~is_black])) / 2)
+
+
+def print_matrix(title: str, names: np.ndarray, matrix: np.ndarray, fmt: str):
+    print(title)
+    width = max(8, max(len(name) for name in names) + 1)
+    print(" " * width + "".join(f"{name:>{width}}" for name in names))
+    for name, row in zip(names, matrix):
+        print(f"{name:>{width}}" + "".join(f"{value:>{width}{fmt}}" for value in row))
+    print()
+
+
+def main(samples_file: str, write: bool):
+    data = load_csv(samples_file, ["label", "r", "g", "b", "ambient"], dtypes={"label": "U32"})
+    labels = data["label"]
+
+    # Normalized RGB vectors of the color samples, as color.py compares them
+    rgb = np.stack([data["r"], data["g"], data["b"]], axis=1)
+    norms = np.linalg.norm(rgb, axis=1)
+    valid = ~np.isnan(norms) & (norms > 0)
+    rgb_labels = labels[valid]
+    rgb = rgb[valid] / norms[valid, None]
+
+    names, means, covariances = fit_gaussians(rgb_labels, rgb)
+    print(f"{len(rgb)} color samples of {len(names)} labels")
+    for name, mean, covariance in zip(names, means, covariances):
+        print(f"{name}: mean {np.round(mean, 4).tolist()}, "
+              f"standard deviation {np.round(np.sqrt(np.diag(covariance)), 4).tolist()}")
+    print()
+
+    # Pairwise separability of the Gaussians
+    distances = np.array([[bhattacharyya(means[i], covariances[i], means[j], covariances[j])
+                           if i != j else np.inf for j in range(len(names))] for i in range(len(names))])
+    print_matrix("Bhattacharyya distance (higher is better)", names, distances, ".2f")
+    print_matrix("Misclassification rate bound", names, np.exp(-distances) / 2, ".2%")
+
+    # Misclassification of the samples by the closest mean
+    _, truth = np.unique(rgb_labels, return_inverse=True)
+    predicted = closest_mean(rgb, means)
+    confusion = np.zeros((len(names), len(names)), dtype=int)
+    np.add.at(confusion, (truth.reshape(-1), predicted), 1)
+    print_matrix("Confusion matrix of the closest mean (rows are the labels)", names, confusion, "d")
+    print(f"Expected misclassification rate: {1 - np.trace(confusion) / max(len(rgb), 1):.2%}\n")
+
+    # Ambient values
+    ambient_valid = ~np.isnan(data["ambient"])
+    ambient_labels = labels[ambient_valid]
+    ambients = data["ambient"][ambient_valid]
+    ambient_names, ambient_means, ambient_stds = group_mean_std(ambient_labels, ambients)
+    ambient_means, ambient_stds = ambient_means[:, 0], ambient_stds[:, 0]
+    for name, mean, std in zip(ambient_names, ambient_means, ambient_stds):
+        print(f"{name}: ambient mean {mean:.3f}, standard deviation {std:.3f}")
+
+    thresholds = {}
+    if "black" in ambient_names and len(ambient_names) > 1:
+        black = float(ambient_means[list(ambient_names).index("black")])
+        tolerance, rate = black_tolerance(ambient_labels, ambients, black)
+        default_rate = tolerance_rate(ambient_labels, ambients, black, DEFAULT_BLACK_TOLERANCE)
+        print(f"is_black tolerance: {tolerance:.3f} ({rate:.2%} misclassified), "
+              f"{DEFAULT_BLACK_TOLERANCE} would misclassify {default_rate:.2%}")
+        thresholds["black_tolerance"] = tolerance
+    else:
+        print("No black and other ambient samples, the is_black tolerance is not calibrated")
+
+    if write:
+        with open(COLORS_FILE, "w", newline="") as file:
+            for name, mean in zip(names, means):
+                file.write(f"{name},{mean[0]},{mean[1]},{mean[2]}\n")
+        with open(AMBIENTS_FILE, "w", newline="") as file:
+            for name, mean in zip(ambient_names, ambient_means):
+                file.write(f"{name},{mean}\n")
+        if thresholds:
+            with open(THRESHOLDS_FILE, "w", newline="") as file:
+                for name, value in thresholds.items():
+                    file.write(f"{name},{value}\n")
+        print(f"\nCalibration written to {os.path.normpath(PROJECT_DIR)}")
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if argument != "-write"]
+    main(arguments[0] if arguments else COLOR_SAMPLES_FILE, "-write" in sys.argv)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+This file is used to plot the color measurements collected from the color sensor,
+as the Gaussian distribution of each RGB component for every color.
+It should be run on your computer, not on the robot.
+
+Each line of the data file is a labeled sample: label,r,g,b,ambient, as recorded by
+`python3 get_colors.py batch` on the robot.
+
+Before running this script for the first time, you must install the dependencies
+as explained in the README.md file.
+"""
+
+from matplotlib import pyplot as plt
+import numpy as np
+
+from loader import group_mean_std, load_csv
+
+# Wanted CSV file containing the data
+COLOR_SENSOR_DATA_FILE = "color_samples.csv"
+
+# Read the labeled samples from the CSV file
+data = load_csv(COLOR_SENSOR_DATA_FILE, ["label", "r", "g", "b", "ambient"], dtypes={"label": "U32"})
+rgb = np.stack([data["r"], data["g"], data["b"]], axis=1)
+
+# Normalize the RGB vectors, as color.py does, dropping the samples without color
+norms = np.linalg.norm(rgb, axis=1)
+valid = norms > 0
+labels = data["label"][valid]
+rgb = rgb[valid] / norms[valid, None]
+
+# Gaussian of each component for every color
+names, means, stds = group_mean_std(labels, rgb)
+for name, mean, std in zip(names, means, stds):
+    print(f"{name}: mean {np.round(mean, 3).tolist()}, standard deviation {np.round(std, 3).tolist()}")
+
+figure, axes = plt.subplots(3, 1, sharex=True)
+x = np.linspace(0, 1, 500)
+stds = np.maximum(stds, 1e-3)  # a color with a single sample still gets a (narrow) curve
+pdfs = np.exp(-0.5 * ((x[None, None, :] - means[:, :, None]) / stds[:, :, None]) ** 2) \
+    / (stds[:, :, None] * np.sqrt(2 * np.pi))
+
+# Plot the distributions of every color, one component per plot
+for component, (axis, title) in enumerate(zip(axes, ["Red", "Green", "Blue"])):
+    for i, name in enumerate(names):
+        axis.plot(x, pdfs[i, component], label=name)
+    axis.set_title(f"{title} Component of the Normalized RGB Vector")
+    axis.set_ylabel("Density")
+axes[-1].set_xlabel("Normalized intensity")
+axes[0].legend()
+
+# Show the plot
+plt.show()
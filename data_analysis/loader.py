@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Shared loader of the sensor logs, for the visualization scripts of this folder.
+It should be run on your computer, not on the robot.
+
+Logs are loaded into columns: a dictionary of numpy arrays, one per column. CSV files
+are parsed in chunks of CHUNK_ROWS lines, and the parsed columns are cached in a .npz
+file next to the log, used instead of the CSV file as long as the CSV file does not
+change. Recordings of utils/recorder.py are mapped into memory as they are.
+
+Example Usage:
+
+    from loader import load_csv, load_recording
+
+    data = load_csv("us_sensor.csv", ["distance", "note"])
+    print(data["distance"].mean())
+
+    records = load_recording("run.rec", kind=SENSOR_VALUE, port=PORT_1)
+    print(records["timestamp"], records["values"][:, 0])
+"""
+
+from itertools import islice
+import os
+
+import numpy as np
+
+CHUNK_ROWS = 100_000  # lines of CSV parsed at once
+CACHE_SUFFIX = ".npz"
+
+# Format of the recordings of project/utils/recorder.py (MAGIC and RECORD there)
+RECORDING_MAGIC = b"DPMREC02"
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"), ("kind", "u1"), ("port", "u1"), ("flags", "<u2"), ("caller", "<u2"),
+    ("values", "<f4", (4,)),
+])
+RECORD_FLAG_NONE = 0x100
+
+# Kinds of records of project/utils/recorder.py
+SENSOR_VALUE = 1
+SENSOR_STATUS = 2
+MOTOR_STATUS = 3
+MOTOR_ENCODER = 4
+MOTOR_POWER = 10
+MOTOR_DPS = 11
+MOTOR_POSITION = 12
+MOTOR_POSITION_RELATIVE = 13
+MOTOR_LIMITS = 14
+MOTOR_OFFSET = 15
+MARK = 20
+
+# Ports of the records, as in BrickPi3
+PORT_1, PORT_2, PORT_3, PORT_4 = 0x01, 0x02, 0x04, 0x08
+PORT_A, PORT_B, PORT_C, PORT_D = 0x01, 0x02, 0x04, 0x08
+
+
+def _source_stamp(path: str) -> np.ndarray:
+    "Return what identifies a version of a file: its size and modification time."
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _read_cache(path: str, names: list):
+    "Return the cached columns of path, or None if there are none or they are out of date."
+    cache_path = path + CACHE_SUFFIX
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if ("_source" not in cache or not np.array_equal(cache["_source"], _source_stamp(path))
+                or any(name not in cache for name in names)):
+            return None
+        return {name: cache[name] for name in names}
+
+
+def _write_cache(path: str, columns: dict):
+    try:
+        np.savez(path + CACHE_SUFFIX, _source=_source_stamp(path), **columns)
+    except OSError as err:
+        print(f"Could not cache {path}: {err}")
+
+
+def load_csv(path: str, names: list, dtypes: dict = None, cache: bool = True,
+             chunk_rows: int = CHUNK_ROWS) -> dict:
+    """
+    Return the columns of a CSV file without header, as a dictionary of numpy arrays.
+
+    names - name of every column, in order
+    dtypes - numpy type of the columns that are not floats, eg. {"label": "U16", "note": int}
+    cache - use (and update) the cached columns of the file
+    """
+    if cache:
+        columns = _read_cache(path, names)
+        if columns is not None:
+            return columns
+
+    dtype = np.dtype([(name, (dtypes or {}).get(name, float)) for name in names])
+    chunks = []
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunk_rows))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                chunks.append(np.loadtxt(lines, delimiter=",", dtype=dtype, ndmin=1))
+    table = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+    columns = {}
+    for name in names:
+        column = table[name]
+        if column.dtype.kind == "U":
+            column = np.char.strip(column)  # eg. after ", "
+        columns[name] = column
+    if cache:
+        _write_cache(path, columns)
+    return columns
+
+
+def load_recording(path: str, kind: int = None, port: int = None) -> np.ndarray:
+    """
+    Return the records of a recording of utils/recorder.py as a numpy structured array,
+    with the fields of RECORD_DTYPE, keeping only the given kind and port (any if None).
+    Values that were None are NaN. The file is mapped into memory, not read.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a recording")
+    count = (os.path.getsize(path) - len(RECORDING_MAGIC)) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=len(RECORDING_MAGIC), shape=(count,))
+
+    mask = np.ones(count, dtype=bool)
+    if kind is not None:
+        mask &= records["kind"] == kind
+    if port is not None:
+        mask &= records["port"] == port
+    records = np.array(records[mask])
+    records["values"][(records["flags"] & RECORD_FLAG_NONE) != 0] = np.nan
+    return records
+
+
+def group_indices(labels: np.ndarray):
+    """
+    Return the unique labels, and the index of the label of every row in them, to compute
+    statistics of every group with np.bincount.
+    """
+    return np.unique(labels, return_inverse=True)
+
+
+def group_mean_std(labels: np.ndarray, values: np.ndarray):
+    """
+    Return the unique labels, and the mean and standard deviation of the values of each
+    of them. values may have several columns, which are reduced separately.
+
+    >>> mean, std = group_mean_std(np.array(["a", "b", "a"]), np.array([[1.0, 2.0], [5.0, 5.0], [3.0, 2.0]]))[1:]
+    >>> mean.tolist(), std.tolist()
+    ([[2.0, 2.0], [5.0, 5.0]], [[1.0, 0.0], [0.0, 0.0]])
+    """
+    unique, inverse = group_indices(labels)
+    inverse = inverse.reshape(-1)
+    values = values.reshape(len(values), -1)
+    counts = np.bincount(inverse, minlength=len(unique))[:, None]
+    sums = np.stack([np.bincount(inverse, values[:, i], len(unique)) for i in range(values.shape[1])], axis=1)
+    squares = np.stack([np.bincount(inverse, values[:, i] ** 2, len(unique))
+                        for i in range(values.shape[1])], axis=1)
+    mean = sums / counts
+    std = np.sqrt(np.maximum(squares / counts - mean ** 2, 0))
+    return unique, mean, std
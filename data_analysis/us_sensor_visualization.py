@@ -9,35 +9,50 @@ as explained in the README.md file.
 """
 
 from matplotlib import pyplot as plt
+import numpy as np
+
+from loader import group_mean_std, load_csv
 
 # Wanted CSV file containing the data
 US_SENSOR_DATA_FILE = "us_sensor.csv"
 
-# Lists to hold distances and notes played
-distances = []
-notes = []
+# Width of the distance histogram bins in cm
+BIN_WIDTH = 1
+
+# Read the distances and notes played from the CSV file
+data = load_csv(US_SENSOR_DATA_FILE, ["distance", "note"], dtypes={"note": int})
+distances = data["distance"]
+notes = data["note"]
+
+# Count the distances of every note at once
+note_values, means, stds = group_mean_std(notes, distances)
+bins = np.arange(0, distances.max() + 2 * BIN_WIDTH, BIN_WIDTH)
+counts, _, _ = np.histogram2d(distances, notes, bins=[bins, np.append(note_values, note_values[-1] + 1)])
 
-# Read the ultrasonic sensor data from the CSV file
-with open(US_SENSOR_DATA_FILE, "r") as f:
-    # Get data from each line of the file
-    for line in f:
-        data = line.strip().split(", ")
+# Print the distance statistics of every note
+for note, samples, mean, std in zip(note_values, counts.sum(axis=0), means[:, 0], stds[:, 0]):
+    print(f"Note {note}: {samples:.0f} samples, mean {mean:.1f} cm, standard deviation {std:.1f} cm")
 
-        # Append distance and note to respective lists
-        distances.append(float(data[0]))
-        notes.append(int(data[1]))
+figure, (scatter, histogram) = plt.subplots(2, 1, sharex=True)
 
 # Plot the data using matplotlib
-plt.plot(distances, notes, ".", color="red")
+scatter.plot(distances, notes, ".", color="red")
 
 # Define plot labels and title
-plt.title("Note Played for Specific Distance from Ultrasonic Sensor")
-plt.ylabel("Note played (1-4)")
-plt.xlabel("Distance (cm)")
+scatter.set_title("Note Played for Specific Distance from Ultrasonic Sensor")
+scatter.set_ylabel("Note played (1-4)")
+scatter.set_yticks(range(0, 5, 1))
+
+# Plot the distance histogram of every note
+for i, note in enumerate(note_values):
+    histogram.stairs(counts[:, i], bins, label=f"Note {note}")
+histogram.set_title("Distances for Each Note")
+histogram.set_ylabel("Samples")
+histogram.set_xlabel("Distance (cm)")
+histogram.legend()
 
 # Define plot ticks
-plt.xticks(range(0, 51, 10))
-plt.yticks(range(0, 5, 1))
+histogram.set_xticks(range(0, 51, 10))
 
 # Show the plot
 plt.show()
@@ -5,17 +5,37 @@ Script to deploy this project from a computer to a robot. See main entry point a
 command line arguments.
 """
 
+from fnmatch import fnmatch
 from threading import Thread
 from tkinter import Tk
 from tkinter.ttk import Button
 from types import FunctionType
+import hashlib
+import io
 import json
 import os
+import shlex
+import subprocess
 import sys
+import tarfile
 
 
 ENV_FILE = ".env"  # in this folder
 ECSE211_DIR = "/home/pi/ecse211"  # on the brick
+DEPLOY_IGNORE_FILE = ".deployignore"  # in this folder, one glob pattern per line
+DEPLOY_MANIFEST = ".deploy_manifest.json"  # in the project folder on the brick, hashes of the deployed files
+
+RUNNER = "scripts/brick_runner.py"  # resident runner on the brick, keeps the brick modules loaded
+
+# Reuse one SSH connection for every command to the brick, kept open 10 minutes after the last one
+SSH_OPTIONS = "-o ControlMaster=auto -o ControlPath=~/.ssh/dpm-%C -o ControlPersist=10m"
+
+# Never deployed, in addition to the patterns of DEPLOY_IGNORE_FILE. A pattern matches a
+# path relative to this folder (eg. project/doc), or any single file or folder name.
+DEFAULT_IGNORE = [
+    ".git", ".env", ".vscode", ".pytest_cache", "__pycache__", "*.pyc",
+    "README.pdf", "project/doc", "data_analysis", DEPLOY_IGNORE_FILE, DEPLOY_MANIFEST,
+]
 
 error = lambda text: print(f"\033[91m{text}\033[0m")  # print text in red
 
@@ -53,25 +73,128 @@ robot_name = f"dpm-{project_info['group']}.local"
 password = read_password()
 
 
-def copy_project_folder_to_brick():
+def ssh_command(remote_cmd: str) -> str:
+    "Return the command to run remote_cmd on the brick, over the shared SSH connection (not on Windows)."
+    os.makedirs(os.path.expanduser("~/.ssh"), exist_ok=True)
+    return f'sshpass -p "{password}" ssh {SSH_OPTIONS} pi@{robot_name} {shlex.quote(remote_cmd)}'
+
+
+def open_ssh_connection():
+    """
+    Open the shared SSH connection in the background, if it is not open yet (not on Windows).
+    A connection opened by a command whose output is captured would keep the capture pipes
+    open, and the command would only return once the connection closes.
     """
-    Copy this project folder to brick, under the ecse211 folder. This will overwrite previous
-    versions of the project.
+    os.makedirs(os.path.expanduser("~/.ssh"), exist_ok=True)
+    ssh = f'sshpass -p "{password}" ssh'
+    quiet = {"shell": True, "stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    if subprocess.run(f"{ssh} {SSH_OPTIONS} -O check pi@{robot_name}", **quiet).returncode:
+        # The first value of an option is used, so this overrides the ControlMaster=auto of SSH_OPTIONS
+        subprocess.run(f"{ssh} -o ControlMaster=yes {SSH_OPTIONS} -Nf pi@{robot_name}", **quiet)
+
+
+def read_ignore_patterns() -> list:
+    "Return the default ignore patterns, and those of the .deployignore file if it exists."
+    patterns = list(DEFAULT_IGNORE)
+    if os.path.exists(DEPLOY_IGNORE_FILE):
+        with open(DEPLOY_IGNORE_FILE) as f:
+            for line in f:
+                line = line.strip().rstrip("/")
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+    return patterns
+
+
+def is_ignored(path: str, patterns: list) -> bool:
+    "Return True if the relative path (with / separators) or one of its parts matches a pattern."
+    parts = path.split("/")
+    return any(fnmatch(path, pattern) or any(fnmatch(part, pattern) for part in parts)
+               for pattern in patterns)
+
+
+def build_manifest(patterns: list) -> dict:
+    "Return the SHA-1 hash of every file of this folder that is not ignored, by relative path."
+    manifest = {}
+    for folder, dirs, files in os.walk("."):
+        folder = os.path.relpath(folder).replace(os.sep, "/")
+        prefix = "" if folder == "." else folder + "/"
+        dirs[:] = [d for d in dirs if not is_ignored(prefix + d, patterns)]
+        for name in files:
+            path = prefix + name
+            if is_ignored(path, patterns):
+                continue
+            with open(path, "rb") as f:
+                manifest[path] = hashlib.sha1(f.read()).hexdigest()
+    return manifest
+
+
+def read_robot_manifest(robot_project_path: str) -> dict:
+    "Return the manifest of the last deploy on the brick, or an empty one if there is none."
+    open_ssh_connection()
+    cmd = ssh_command(f"cat {robot_project_path}/{DEPLOY_MANIFEST}")
+    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return json.loads(result.stdout) if result.returncode == 0 else {}
+    except ValueError:
+        return {}
+
+
+def copy_project_folder_to_brick(full: bool = False):
+    """
+    Copy this project folder to brick, under the ecse211 folder. Only the files that changed
+    since the last deploy are sent, in a single compressed stream, and the files deleted since
+    are removed. Files matching the ignore patterns are never sent. If full is True, the
+    project folder on the brick is replaced entirely.
     """
     project_name = os.path.basename(os.getcwd())
     robot_project_path = f"{ECSE211_DIR}/{project_name}"
-    
+
     if is_windows:
-        rm_cmd = f'plink -batch -l pi -pw "{password}" {robot_name} "rm -rf {robot_project_path}"'
-        if command_result(rm_cmd):
-            error("Failed to connect to brick or remove old project. Please ensure the brick is turned on and "
-                  "connected to the same network as this computer.")
-        else:
-            copy_cmd = f'pscp -batch -l pi -pw "{password}" -r {os.getcwd()} pi@{robot_name}:{ECSE211_DIR}'
-    else:
-        copy_cmd = f'''sshpass -p "{password}" ssh pi@{robot_name} "rm -rf {robot_project_path
-            }" && sshpass -p "{password}" scp -pr "{os.getcwd()}" pi@{robot_name}:{robot_project_path}'''
-    print(f"Copying {project_name} to {robot_name}...")
+        copy_project_folder_to_brick_windows(robot_project_path)
+        return
+
+    manifest = build_manifest(read_ignore_patterns())
+    robot_manifest = {} if full else read_robot_manifest(robot_project_path)
+    changed = [path for path, digest in manifest.items() if robot_manifest.get(path) != digest]
+    removed = [path for path in robot_manifest if path not in manifest]
+    if not changed and not removed:
+        print(f"{project_name} is up to date on {robot_name}")
+        return
+
+    # Archive the changed files, and the new manifest
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for path in changed:
+            tar.add(path, recursive=False)
+        data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+        info = tarfile.TarInfo(DEPLOY_MANIFEST)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    remote_cmd = f"mkdir -p {robot_project_path} && cd {robot_project_path}"
+    if full:
+        remote_cmd = f"rm -rf {robot_project_path} && " + remote_cmd
+    if removed:
+        remote_cmd += " && rm -f -- " + " ".join(shlex.quote(path) for path in removed)
+    remote_cmd += " && tar xzmf -"
+    copy_cmd = ssh_command(remote_cmd)
+
+    print(f"Copying {project_name} to {robot_name}: {len(changed)} changed, {len(removed)} removed "
+          f"({archive.tell() / 1024:.1f} KiB)...")
+    if subprocess.run(copy_cmd, shell=True, input=archive.getvalue()).returncode:
+        error("Failed to copy project to brick. Please ensure it is turned on and connected to "
+              "the same network as this computer.")
+
+
+def copy_project_folder_to_brick_windows(robot_project_path: str):
+    "Copy the whole project folder with pscp, overwriting the previous version."
+    rm_cmd = f'plink -batch -l pi -pw "{password}" {robot_name} "rm -rf {robot_project_path}"'
+    if command_result(rm_cmd):
+        error("Failed to connect to brick or remove old project. Please ensure the brick is turned on and "
+              "connected to the same network as this computer.")
+        return
+    copy_cmd = f'pscp -batch -l pi -pw "{password}" -r {os.getcwd()} pi@{robot_name}:{ECSE211_DIR}'
+    print(f"Copying {os.path.basename(os.getcwd())} to {robot_name}...")
     if command_result(copy_cmd):
         error("Failed to copy project to brick. Please ensure it is turned on and connected to "
               "the same network as this computer.")
@@ -82,7 +205,7 @@ def run_on_brick(program_path: str, cmd: str):
     if is_windows:
         run_cmd = f'plink -batch -l pi -pw "{password}" {robot_name} "cd {program_path} && {cmd}"'
     else:
-        run_cmd = f'sshpass -p "{password}" ssh pi@{robot_name} "cd {program_path} && {cmd}"'
+        run_cmd = ssh_command(f"cd {program_path} && {cmd}")
     print(f"Running command on {robot_name}:\n> {run_cmd}".replace(password, 8 * '*'))
     if command_result(run_cmd):
         error(f"Failed to run `{run_cmd}` command on brick.")
@@ -96,11 +219,17 @@ def command_result(command: str) -> int:
         return os.WEXITSTATUS(os.system(command))
 
 
-def run_main_entry_point():
-    "Run the main entry point defined in project_info.json."
+def run_main_entry_point(cold: bool = False):
+    """
+    Run the main entry point defined in project_info.json. Unless cold is True (or on Windows),
+    it is run by the resident runner of the brick, which already has the brick modules loaded.
+    """
     project_name = os.path.basename(os.getcwd())
     main_entry_point = project_info["entrypoint"]
-    python_cmd = f"python3 {main_entry_point}"
+    if cold or is_windows:
+        python_cmd = f"python3 {main_entry_point}"
+    else:
+        python_cmd = f"python3 {RUNNER} run {main_entry_point}"
     run_on_brick(f"{ECSE211_DIR}/{project_name}", python_cmd)
 
 
@@ -156,10 +285,10 @@ if __name__ == "__main__":
         root.mainloop()
 
     if "-copy" in sys.argv:
-        copy_project_folder_to_brick()
+        copy_project_folder_to_brick(full="-full" in sys.argv)
 
     if "-run" in sys.argv:
-        run_main_entry_point()
+        run_main_entry_point(cold="-cold" in sys.argv)
 
     if "-reset" in sys.argv:
         reset_brick()
@@ -1,35 +1,99 @@
 import csv
+import os
 from math import fabs, sqrt
-from time import sleep
+from time import perf_counter, sleep
+import sys
 
 from utils.brick import EV3ColorSensor, wait_ready_sensors
+from utils.color_lut import ColorLUT
+from utils.filters import AdaptiveThreshold
 
+# Calibration, loaded from the CSV files by load_calibration() on first use
 COLORS = {}
 AMBIENTS = {}
+THRESHOLDS = {}
 
-# Load colors from CSV file into the dictionary
-with open("colors.csv", "r") as file:
-    reader = csv.reader(file)
-    for row in reader:
-        name = row[0]
-        r = float(row[1])
-        g = float(row[2])
-        b = float(row[3])
-        COLORS[name] = [r, g, b]
+# Thresholds used without thresholds.csv, written by data_analysis/color_calibration.py
+DEFAULT_THRESHOLDS = {"black_tolerance": 0.3}
 
-# Load ambients from CSV file into the dictionary
-with open("ambients.csv", "r") as file:
-    reader = csv.reader(file)
-    for row in reader:
-        name = row[0]
-        ambient = float(row[1])
-        AMBIENTS[name] = ambient
+# Lookup table of the closest color, rebuilt from COLORS when they change
+COLOR_LUT_FILE = "color_lut.bin"
+LUT = None
 
-COLOR = EV3ColorSensor(4)
+# Color sensor, created by get_sensor() on first use
+COLOR = None
 
-print("Sensors waiting")
-wait_ready_sensors()
-print("Sensors ready")
+# Ambient of the black line and of the floor, learned from the readings while driving, so
+# that changes of lighting do not need a new calibration. The calibrated ambients are used
+# until both the line and the floor were seen in the last AMBIENT_WINDOW readings.
+AMBIENT_WINDOW = 200
+AMBIENT_LEVELS = AdaptiveThreshold(window_size=AMBIENT_WINDOW)
+
+# The learned ambients are only used if their contrast is at least this fraction of the
+# calibrated one. Dimming the light does not change the contrast, but while the line is
+# followed well the window only holds the gray of its edge, whose spread looks like a
+# (low) contrast.
+AMBIENT_MIN_CONTRAST = 0.75
+
+
+def load_calibration() -> None:
+    """
+    Load the colors, ambients and thresholds from the CSV files into the dictionaries, if not done yet.
+    """
+
+    global LUT
+
+    if COLORS and AMBIENTS:
+        return
+
+    # Load colors from CSV file into the dictionary
+    with open("colors.csv", "r") as file:
+        reader = csv.reader(file)
+        for row in reader:
+            name = row[0]
+            r = float(row[1])
+            g = float(row[2])
+            b = float(row[3])
+            COLORS[name] = [r, g, b]
+
+    # Load ambients from CSV file into the dictionary
+    with open("ambients.csv", "r") as file:
+        reader = csv.reader(file)
+        for row in reader:
+            name = row[0]
+            ambient = float(row[1])
+            AMBIENTS[name] = ambient
+
+    # Only learn ambients with a contrast close to the calibrated one
+    black, white = AMBIENTS["black"], AMBIENTS["white"]
+    AMBIENT_LEVELS.min_margin = AMBIENT_MIN_CONTRAST * (white - black) / (white + black)
+
+    # Load thresholds from CSV file into the dictionary, if calibrated
+    THRESHOLDS.update(DEFAULT_THRESHOLDS)
+    if os.path.exists("thresholds.csv"):
+        with open("thresholds.csv", "r") as file:
+            reader = csv.reader(file)
+            for row in reader:
+                THRESHOLDS[row[0]] = float(row[1])
+
+    LUT = ColorLUT.load_or_build(COLOR_LUT_FILE, COLORS)
+
+
+def get_sensor() -> EV3ColorSensor:
+    """
+    Get the color sensor, creating it the first time.
+
+    Returns
+    -------
+    EV3ColorSensor
+        The color sensor.
+    """
+
+    global COLOR
+
+    if COLOR is None:
+        COLOR = EV3ColorSensor(4)
+    return COLOR
 
 
 def get_color() -> str:
@@ -42,24 +106,71 @@ def get_color() -> str:
         Name of the closest color, returns "unknown" if no valid color is detected.
     """
 
+    return get_color_confidence()[0]
+
+
+def get_color_confidence(thresholds: tuple = ()) -> tuple:
+    """
+    Get the closest color to the current reading, and how much closer it is than the next one.
+
+    Parameters
+    ----------
+    thresholds : tuple
+        Confidences the result is compared to. The lookup table gives an approximate
+        confidence, so the exact one is computed when it is close to one of them.
+
+    Returns
+    -------
+    tuple
+        (name, confidence) of the closest color. The confidence is 1.0 for an exact match and
+        0.0 when the reading is halfway between the two closest colors. Returns ("unknown", 0.0)
+        if no valid color is detected.
+    """
+
+    load_calibration()
+
     # Read color and normalize
-    color = COLOR.get_rgb()
+    color = get_sensor().get_rgb()
 
     # Check for existence of color
     if color[0] is None or color[1] is None or color[2] is None:
-        return "unknown"
+        return "unknown", 0.0
 
     dist = sqrt(color[0] * color[0] + color[1] * color[1] + color[2] * color[2])
 
     # Check for zero distance
     if dist == 0:
-        return "unknown"
+        return "unknown", 0.0
 
     color = [color[0] / dist, color[1] / dist, color[2] / dist]
 
-    # Find closest color
+    # Look the color up, unless it is on the boundary between two colors
+    result = LUT.classify(color[0], color[1], color[2], thresholds)
+    if result is not None:
+        return result
+
+    return get_closest_color(color)
+
+
+def get_closest_color(color: list) -> tuple:
+    """
+    Search the closest color to a normalized RGB vector.
+
+    Parameters
+    ----------
+    color : list
+        The normalized RGB vector.
+
+    Returns
+    -------
+    tuple
+        (name, confidence) of the closest color, as returned by get_color_confidence.
+    """
+
+    # Find the two closest colors
     closest_name = ""
     closest_dist = float("inf")
+    second_dist = float("inf")
     for name, ref_color in COLORS.items():
         # Get euclidean distance
         dist_list = [
@@ -73,10 +184,66 @@ def get_color() -> str:
             + dist_list[2] * dist_list[2]
         )
         if dist < closest_dist:
+            second_dist = closest_dist
             closest_dist = dist
             closest_name = name
+        elif dist < second_dist:
+            second_dist = dist
 
-    return closest_name
+    if second_dist == float("inf"):
+        return closest_name, 1.0
+    return closest_name, 1 - closest_dist / second_dist
+
+
+def read_ambient() -> float:
+    """
+    Read the ambient, and add it to the readings of the adaptive ambient levels.
+
+    Returns
+    -------
+    float
+        The ambient reading, None if no valid ambient is detected.
+    """
+
+    ambient = get_sensor().get_ambient()
+    if ambient is not None:
+        AMBIENT_LEVELS.append(ambient)
+    return ambient
+
+
+def get_ambient_levels() -> tuple:
+    """
+    Get the current ambient of the black line and of the white floor.
+
+    Returns
+    -------
+    tuple
+        (black, white) ambients, learned while driving if possible, calibrated otherwise.
+    """
+
+    load_calibration()
+
+    if AMBIENT_LEVELS.is_valid():
+        return AMBIENT_LEVELS.dark, AMBIENT_LEVELS.bright
+    return AMBIENTS["black"], AMBIENTS["white"]
+
+
+def get_contrast_margin() -> float:
+    """
+    Get the current contrast between the black line and the white floor.
+
+    Returns
+    -------
+    float
+        (white - black) / (white + black) of the learned ambients. Returns None if they are
+        not used (see get_ambient_levels), eg. if not enough ambients were read yet.
+    """
+
+    load_calibration()
+
+    if not AMBIENT_LEVELS.is_valid():
+        return None
+    return AMBIENT_LEVELS.get_margin()
 
 
 def get_ambient() -> str:
@@ -89,13 +256,19 @@ def get_ambient() -> str:
         Name of the closest ambient, returns "unknown" if no valid ambient is detected.
     """
 
+    load_calibration()
+
     # Read ambient
-    ambient = COLOR.get_ambient()
+    ambient = read_ambient()
 
     # Check for existence of ambient
     if ambient is None:
         return "unknown"
 
+    # Compensate the lighting, by mapping the learned black and white to the calibrated ones
+    black, white = get_ambient_levels()
+    ambient = AMBIENTS["black"] + (ambient - black) * (AMBIENTS["white"] - AMBIENTS["black"]) / (white - black)
+
     # Find closest ambient
     closest_name = ""
     closest_dist = float("inf")
@@ -119,11 +292,81 @@ def is_black() -> bool:
         True if the current color is black, False otherwise.
     """
 
-    ambient = COLOR.get_ambient()
-    dist = fabs(ambient - AMBIENTS["black"])
-    error = dist / AMBIENTS["black"]
+    ambient = read_ambient()
+
+    # Check for existence of ambient
+    if ambient is None:
+        return False
+
+    black, white = get_ambient_levels()
+    dist = fabs(ambient - black)
+    error = dist / black
+
+    return error <= THRESHOLDS["black_tolerance"] and ambient < (black + white) / 2
+
+
+def get_line_error() -> float:
+    """
+    Get the position of the current ambient reading relative to the edge of the black line.
+
+    Returns
+    -------
+    float
+        -1.0 on the black line, 1.0 on the white floor and 0.0 on the edge between them,
+        clipped to that range. Returns None if no valid ambient is detected.
+    """
+
+    ambient = read_ambient()
+
+    # Check for existence of ambient
+    if ambient is None:
+        return None
+
+    black, white = get_ambient_levels()
+    error = 2 * (ambient - black) / (white - black) - 1
 
-    return error <= 0.3
+    return min(max(error, -1.0), 1.0)
+
+
+def benchmark(samples_filename: str) -> None:
+    """
+    Compare the lookup table with the search of the closest color, on the RGB samples of a
+    file written by "python3 get_colors.py batch".
+
+    Parameters
+    ----------
+    samples_filename : str
+        The file of samples, with label,r,g,b,ambient lines.
+    """
+
+    load_calibration()
+
+    samples = []
+    with open(samples_filename, "r") as file:
+        reader = csv.reader(file)
+        for row in reader:
+            r, g, b = float(row[1]), float(row[2]), float(row[3])
+            dist = sqrt(r * r + g * g + b * b)
+            if dist > 0:  # also skips the ambient samples (nan)
+                samples.append([r / dist, g / dist, b / dist])
+
+    start = perf_counter()
+    searched = [get_closest_color(color)[0] for color in samples]
+    search_time = perf_counter() - start
+
+    start = perf_counter()
+    looked_up = []
+    for color in samples:
+        result = LUT.classify(color[0], color[1], color[2])
+        looked_up.append(result[0] if result is not None else get_closest_color(color)[0])
+    lookup_time = perf_counter() - start
+
+    count = max(len(samples), 1)
+    different = sum(1 for a, b in zip(searched, looked_up) if a != b)
+    fallbacks = sum(1 for color in samples if LUT.classify(color[0], color[1], color[2]) is None)
+    print(f"{len(samples)} samples, {different} classified differently, {fallbacks} searched")
+    print(f"Search: {search_time / count * 1e6:.1f} us per sample")
+    print(f"Lookup table: {lookup_time / count * 1e6:.1f} us per sample")
 
 
 # Simple test loop
@@ -132,6 +375,11 @@ def test() -> None:
     Simple test loop to print color readings.
     """
 
+    get_sensor()
+    print("Sensors waiting")
+    wait_ready_sensors()
+    print("Sensors ready")
+
     try:
         while True:
             color_name = get_ambient()
@@ -142,4 +390,7 @@ def test() -> None:
 
 
 if __name__ == "__main__":
-    test()
+    if len(sys.argv) == 3 and sys.argv[1] == "bench":
+        benchmark(sys.argv[2])
+    else:
+        test()
@@ -1,5 +1,6 @@
 from math import sqrt
-from time import sleep
+from time import monotonic, sleep
+import sys
 
 from utils.brick import EV3ColorSensor, TouchSensor, wait_ready_sensors
 
@@ -9,6 +10,10 @@ COLORS = {}
 AMBIENTS_FILENAME = "ambients.csv"
 AMBIENTS = {}
 
+# Raw samples of the batch mode, one per line: label,r,g,b,ambient (nan for the other mode)
+SAMPLES_FILENAME = "color_samples.csv"
+BATCH_SECONDS = 5  # seconds of samples of each mode for every label
+
 TOUCH_SENSOR = TouchSensor(3)
 COLOR_SENSOR = EV3ColorSensor(4)
 
@@ -134,6 +139,62 @@ def test() -> None:
         test()
 
 
+def record_samples(label: str, mode: str, file) -> int:
+    """
+    Writes the samples of one sensor mode read as fast as possible for BATCH_SECONDS.
+
+    Parameters
+    ----------
+    label : str
+        The name of the color the sensor is on.
+    mode : str
+        "color" for RGB samples, "ambient" for ambient samples.
+    file : file
+        Where the samples are written.
+
+    Returns
+    -------
+    int
+        Number of samples written.
+    """
+
+    # Switch the sensor mode before starting the clock
+    read = COLOR_SENSOR.get_rgb if mode == "color" else COLOR_SENSOR.get_ambient
+    read()
+
+    lines = []
+    end = monotonic() + BATCH_SECONDS
+    while monotonic() < end:
+        value = read()
+        if mode == "color":
+            if value[0] is not None and value[1] is not None and value[2] is not None:
+                lines.append(f"{label},{value[0]},{value[1]},{value[2]},nan\n")
+        elif value is not None:
+            lines.append(f"{label},nan,nan,nan,{value}\n")
+
+    file.writelines(lines)
+    return len(lines)
+
+
+def batch() -> None:
+    """
+    Batch calibration: records the raw samples of every label given, for the calibration
+    script of data_analysis. Move the sensor over the color while it records.
+    """
+
+    with open(SAMPLES_FILENAME, mode="a", newline="") as file:
+        while True:
+            label = input("Label (empty to exit): ").strip().lower()
+            if label == "":
+                return
+
+            for mode in ("color", "ambient"):
+                input(f"Place the sensor on {label} for {mode} samples, then press Enter.")
+                count = record_samples(label, mode, file)
+                print(f"Saved {count} {mode} samples of {label} to {SAMPLES_FILENAME}.")
+            file.flush()
+
+
 def save() -> None:
     """
     Save the gathered colors and ambients into CSV files.
@@ -171,4 +232,7 @@ def save() -> None:
 
 
 if __name__ == "__main__":
-    test()
+    if "batch" in sys.argv:
+        batch()
+    else:
+        test()
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
-from time import sleep
-
 from utils.brick import (
+    EmergencyStop,
     Motor,
     TouchSensor,
     wait_ready_sensors,
@@ -18,6 +17,9 @@ EMERGENCY_STOP = TouchSensor(1)
 wait_ready_sensors()
 print("Done waiting.")
 
+# Cuts the drum motor as soon as the emergency stop is pressed
+ESTOP = EmergencyStop(EMERGENCY_STOP).start()
+
 
 def test():
     """
@@ -26,17 +28,14 @@ def test():
     """
 
     try:
-        while True:
-            # Break from loop if emergency stop is pressed
-            if EMERGENCY_STOP.is_pressed():
-                break
-
+        # Loop until the emergency stop is pressed
+        while not ESTOP.is_triggered():
             # Start the drum at 720 dps (120 bpm) if the start drum button is pressed
             if START_DRUM.is_pressed():
                 DRUM.set_dps(720)
 
-            # Short delay
-            sleep(0.1)
+            # Short delay, returning early on emergency stop
+            ESTOP.wait(0.1)
     except BaseException:
         # Avoid errors crashing the program to stop the motor properly
         pass
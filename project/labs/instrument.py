@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-from time import sleep
-
 from utils import sound
+from utils.mixer import get_mixer
 from utils.brick import (
+    EmergencyStop,
     EV3UltrasonicSensor,
     Motor,
     TouchSensor,
@@ -18,6 +18,9 @@ NOTES = [
     sound.Sound(duration=0.2, pitch="G5", volume=85),
 ]
 
+# Audio stream kept open for the whole program, so notes start without delay
+MIXER = get_mixer()
+
 print("Program start.\nWaiting for sensors to turn on...")
 
 # Initialize motors and sensors
@@ -29,10 +32,14 @@ US_SENSOR = EV3UltrasonicSensor(3)
 wait_ready_sensors()
 print("Done waiting.")
 
+# Cuts the drum motor and silences the notes as soon as the emergency stop is pressed
+ESTOP = EmergencyStop(EMERGENCY_STOP).start()
+ESTOP.add_callback(MIXER.all_notes_off)
+
 
 def play_sound(note):
     """
-    Play the wanted note on the speaker.
+    Start playing the wanted note on the speaker, without waiting for it to end.
 
     Parameters
     ----------
@@ -40,8 +47,7 @@ def play_sound(note):
         Wanted index of note to play.
     """
 
-    NOTES[note].play()
-    NOTES[note].wait_done()
+    MIXER.note_on(NOTES[note])
 
 
 def main_loop():
@@ -52,11 +58,8 @@ def main_loop():
 
     try:
         # Main while loop
-        while True:
-            # Break from loop if emergency stop is pressed
-            if EMERGENCY_STOP.is_pressed():
-                break
-
+        # Loop until the emergency stop is pressed
+        while not ESTOP.is_triggered():
             # Start the drum at 720 dps (120 bpm) if the start drum button is pressed
             if START_DRUM.is_pressed():
                 DRUM.set_dps(720)
@@ -75,12 +78,10 @@ def main_loop():
                     play_sound(2)
                 elif distance < 40:
                     play_sound(3)
-                else:
-                    # No note played for distances 40 cm and above
-                    sleep(0.2)
+                # No note played for distances 40 cm and above
 
-            # Short delay to avoid rapid triggering
-            sleep(0.3)
+            # Short delay to avoid rapid triggering, returning early on emergency stop
+            ESTOP.wait(0.3)
     except BaseException:
         # Avoid errors crashing the program to stop the motor properly
         pass
@@ -1,25 +1,37 @@
-from math import isclose, pi
+from utils import startup
+
+from math import cos, isclose, pi, radians
 from multiprocessing import Process
-from time import sleep
+from time import monotonic, sleep
+import os
 
-from color import get_color, is_black
+import color
+from color import get_color_confidence, get_contrast_margin, get_line_error, is_black
 from simpleaudio import WaveObject
-from utils.brick import EV3UltrasonicSensor, Motor, TouchSensor, wait_ready_sensors
-
-# Initialize motors and sensors
-STOP = TouchSensor(3)
-RIGHT_MOTOR = Motor("C")
-LEFT_MOTOR = Motor("B")
-CONVEYOR_MOTOR = Motor("D")
-ULTRASONIC_SENSOR = EV3UltrasonicSensor(1)
-
-# Sounds
-DROP_SOUND = WaveObject.from_wave_file("sounds/drop.wav")
-VICTORY_SOUND = WaveObject.from_wave_file("sounds/victory.wav")
-
-# print("Sensors waiting")
-wait_ready_sensors()
-# print("Sensors ready")
+from utils.brick import (EmergencyStop, EV3UltrasonicSensor, Motor, TouchSensor, get_default_brick, set_recorder,
+                         wait_ready_sensors)
+from utils.mission import Mission, MissionExecutor
+from utils.motion import SCurveProfile, SyncMove
+from utils.odometry import Odometry, wrap_degrees
+from utils.recorder import Recorder
+from utils.replay import ReplayBrick, ReplayEnded
+from utils.scheduler import Scheduler
+from utils.shared_state import SharedState, StopRequested
+
+# Motors and sensors, created by init_stop() and init_devices() rather than at import, so
+# that importing this file does not start the brick
+STOP = None
+RIGHT_MOTOR = None
+LEFT_MOTOR = None
+CONVEYOR_MOTOR = None
+ULTRASONIC_SENSOR = None
+
+# Cuts the motors when STOP is pressed, started by the supervisor process
+ESTOP = None
+
+# Sounds, loaded by get_sound() on first use
+SOUND_FILES = {"drop": "sounds/drop.wav", "victory": "sounds/victory.wav"}
+SOUNDS = {}
 
 # Measured values
 WHEEL_DIAMETER = 4.2
@@ -31,12 +43,113 @@ DROP_TURN = 40
 DISTANCE_TO_DEGREE = 360 / (pi * WHEEL_DIAMETER)
 DEGREE_TO_ROTATION = TURN_DIAMETER / WHEEL_DIAMETER
 
+# Pose tracking from the wheel encoders, created by init_devices() and started by initiate()
+ODOMETRY = None
+
+# State shared with the supervisor process, set by main_move
+STATE = None
+
+# Every sensor read and motor command of the movement process is recorded to this file if set
+RECORD_FILE = os.environ.get("DPM_RECORD")
+
+# The timing statistics of the line following loop are printed after every follow_line if set
+LINE_REPORT = bool(os.environ.get("DPM_LINE_REPORT"))
+
 # Values for functions
 DELIVERIES = 0
 DPS = 540
 POWER = DPS / 1250 * 100
 POLL = 0.01
 SLEEP = 0.3
+ACCELERATION = 1500  # peak wheel acceleration of move() and turn() in deg/s^2
+STOP_RATE = 50  # frequency of the stop checks of the movement and supervisor processes in Hz
+STOP_TIMEOUT = 2.0  # seconds given to the movement process to stop by itself
+
+# Idle time waiting for the motors to settle between motions, against the fixed sleeps it replaces
+IDLE_TIME = {"budget": 0.0, "actual": 0.0}
+
+# Room scanning
+SCAN_SWEEP = 45  # degrees scanned on each side of the entry heading
+SCAN_PASSES = 9  # maximum number of sweeps of a room
+SCAN_ADVANCE = 2  # centimeters moved into the room between two sweeps
+SCAN_DPS = 0.5 * DPS  # wheel speed while sweeping
+SCAN_RATE = 100  # color samples per second while sweeping
+SCAN_MIN_CONFIDENCE = 0.2  # samples less confident than this are ignored
+SCAN_MIN_SAMPLES = 2  # confident samples needed to detect a sticker
+
+# Line following controller (error is -1 on black, 1 on the floor, 0 on the edge)
+LINE_RATE = 100  # control loop frequency in Hz
+ULTRASONIC_RATE = 20  # wall distance polling frequency in Hz
+LINE_DPS = 450  # base speed of both wheels, until the contrast of the line is learned
+LINE_MAX_DPS = DPS  # base speed with a contrast of LINE_FULL_CONTRAST or more
+LINE_FULL_CONTRAST = 0.6  # contrast margin (see color.get_contrast_margin) for full speed
+LINE_KP = 250  # dps of steering per unit of error
+LINE_KI = 40
+LINE_KD = 8
+LINE_I_LIMIT = 1.0  # anti-windup bound of the integral term
+LINE_EDGE = 1  # 1 follows the left edge of the line, -1 the right edge
+LINE_WALL_DISTANCE = 15.0  # no steering closer than this to the wall, where the line ends
+LINE_LOST_ERROR = 0.95  # error above which the line is considered lost
+LINE_LOST_TIME = 1.0  # seconds lost before falling back to sweeping for the line
+LINE_STOP_TIME = 0.15  # seconds from the stop command to standstill, braking starts that early
+
+
+def init_stop() -> None:
+    """
+    Creates the STOP touch sensor and its emergency stop, if not done yet.
+    """
+
+    global STOP, ESTOP
+
+    if STOP is None:
+        STOP = TouchSensor(3)
+        ESTOP = EmergencyStop(STOP)
+
+
+def init_devices() -> None:
+    """
+    Creates the motors and sensors that are not created yet, loads the color calibration
+    and waits for the sensors.
+    """
+
+    global RIGHT_MOTOR, LEFT_MOTOR, CONVEYOR_MOTOR, ULTRASONIC_SENSOR, ODOMETRY
+
+    init_stop()
+    if RIGHT_MOTOR is None:
+        RIGHT_MOTOR = Motor("C")
+        LEFT_MOTOR = Motor("B")
+        CONVEYOR_MOTOR = Motor("D")
+        ULTRASONIC_SENSOR = EV3UltrasonicSensor(1)
+        ODOMETRY = Odometry(LEFT_MOTOR, RIGHT_MOTOR, WHEEL_DIAMETER, TURN_DIAMETER)
+    color.get_sensor()
+    # Read the calibration files now, rather than on the first color reading of the mission
+    with startup.span("load_calibration"):
+        color.load_calibration()
+
+    # print("Sensors waiting")
+    with startup.span("wait_ready_sensors"):
+        wait_ready_sensors()
+    # print("Sensors ready")
+
+
+def get_sound(name: str) -> WaveObject:
+    """
+    Gets a sound of SOUND_FILES, loading it the first time.
+
+    Parameters
+    ----------
+    name : str
+        Name of the sound.
+
+    Returns
+    -------
+    WaveObject
+        The sound, ready to play.
+    """
+
+    if name not in SOUNDS:
+        SOUNDS[name] = WaveObject.from_wave_file(SOUND_FILES[name])
+    return SOUNDS[name]
 
 
 def play_drop_sound() -> None:
@@ -44,7 +157,7 @@ def play_drop_sound() -> None:
     Plays the drop sound.
     """
 
-    DROP_SOUND.play()
+    get_sound("drop").play()
 
 
 def play_victory_sound() -> None:
@@ -52,7 +165,7 @@ def play_victory_sound() -> None:
     Plays the victory sound.
     """
 
-    VICTORY_SOUND.play()
+    get_sound("victory").play()
     sleep(5)
 
 
@@ -70,6 +183,9 @@ def initiate() -> None:
     except BaseException:
         pass
 
+    ODOMETRY.reset()
+    ODOMETRY.start()
+
 
 def wait() -> None:
     """
@@ -78,11 +194,11 @@ def wait() -> None:
 
     # Wait until the motor start moving
     while isclose(RIGHT_MOTOR.get_speed(), 0):
-        sleep(POLL)
+        poll()
 
     # Wait until the motor stop moving
     while not isclose(RIGHT_MOTOR.get_speed(), 0):
-        sleep(POLL)
+        poll()
 
 
 def wait_drop() -> None:
@@ -92,10 +208,79 @@ def wait_drop() -> None:
 
     # Wait until the motor start moving
     while isclose(CONVEYOR_MOTOR.get_speed(), 0):
-        sleep(POLL)
+        poll()
 
     while not isclose(CONVEYOR_MOTOR.get_speed(), 0):
-        sleep(POLL)
+        poll()
+
+
+def checkpoint() -> None:
+    """
+    Publishes the deliveries and pose to the shared state, and stops the mission if the
+    supervisor requested it. Call this regularly from every loop that moves the robot.
+
+    Raises
+    ------
+    StopRequested
+        If the supervisor requested a stop.
+    """
+
+    if STATE is None:
+        return
+
+    x, y, heading = ODOMETRY.get_pose()
+    STATE.update(deliveries=DELIVERIES, x=x, y=y, heading=heading)
+    STATE.check_stop()
+
+
+def poll() -> None:
+    """
+    Waits for one polling period, at a checkpoint.
+    """
+
+    checkpoint()
+    sleep(POLL)
+
+
+def settle(budget: float, motors: tuple = None, counted: bool = True) -> None:
+    """
+    Waits until the motors have settled after a motion, for at most the given budget.
+
+    Parameters
+    ----------
+    budget : float
+        The maximum time to wait in seconds, which is the fixed sleep this wait replaces.
+    motors : tuple
+        The motors to wait for, both wheels by default.
+    counted : bool
+        Whether the wait is counted in the idle report. Waits after motions that had no
+        fixed sleep in the original route are not, so the report compares the same pauses.
+    """
+
+    if motors is None:
+        motors = (LEFT_MOTOR, RIGHT_MOTOR)
+
+    checkpoint()
+    start = monotonic()
+    for motor in motors:
+        motor.wait_settled(timeout=max(0.0, budget - (monotonic() - start)))
+
+    if counted:
+        IDLE_TIME["budget"] += budget
+        IDLE_TIME["actual"] += monotonic() - start
+
+
+def idle_report() -> str:
+    """
+    Describes the time spent waiting for the motors to settle.
+
+    Returns
+    -------
+    str
+        The actual idle time, and the idle time of the fixed sleeps it replaces.
+    """
+
+    return f"Idle time: {IDLE_TIME['actual']:.2f}s (fixed sleeps: {IDLE_TIME['budget']:.2f}s)"
 
 
 def forward() -> None:
@@ -143,54 +328,55 @@ def stop() -> None:
     LEFT_MOTOR.set_dps(0)
 
 
-def move(distance: float) -> None:
+def drive(left_degrees: float, right_degrees: float, dps: float, tasks: tuple = ()) -> bool:
     """
-    Moves the robot forward by a certain distance.
+    Rotates both wheels by the given encoder degrees, following a shared S-curve
+    velocity profile so that both wheels start and finish at the same time.
 
     Parameters
     ----------
-    distance : float
-        The distance to move in centimeters. Positive values move forward, and negative values move backward.
-    """
+    left_degrees : float
+        Relative encoder degrees of the left wheel.
+    right_degrees : float
+        Relative encoder degrees of the right wheel.
+    dps : float
+        Maximum speed of the wheel with the longest rotation.
+    tasks : tuple
+        Extra (function, rate) pairs to run during the move, e.g. to sample a sensor.
 
-    # Compute encoder degrees
-    encoder_degrees = int(distance * DISTANCE_TO_DEGREE)
+    Returns
+    -------
+    bool
+        Whether or not both wheels reached their targets.
+    """
 
+    motion = SyncMove([LEFT_MOTOR, RIGHT_MOTOR], [left_degrees, right_degrees],
+                      max_velocity=dps, max_acceleration=ACCELERATION, profile=SCurveProfile)
     try:
-        # Set motors to move
-        if distance > 0:
-            forward()
-        else:
-            RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-            LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-            backward()
-
-        # Set wanted position
-        RIGHT_MOTOR.set_position_relative(encoder_degrees)
-        LEFT_MOTOR.set_position_relative(encoder_degrees)
-        RIGHT_MOTOR.wait_is_moving()
-        RIGHT_MOTOR.wait_is_stopped()
+        return motion.run(((checkpoint, STOP_RATE),) + tuple(tasks))
     finally:
         stop()
 
 
-def back_to_door() -> None:
+def move(distance: float) -> None:
     """
-    Moves the robot backward until it reaches the door.
+    Moves the robot forward by a certain distance.
+
+    Parameters
+    ----------
+    distance : float
+        The distance to move in centimeters. Positive values move forward, and negative values move backward.
     """
 
-    try:
-        # Set motors to move
-        backward()
+    # Compute encoder degrees
+    encoder_degrees = int(distance * DISTANCE_TO_DEGREE)
 
-        # Poll until it reaches the door
-        while get_color() != "orange":
-            sleep(POLL)
-    finally:
-        stop()
+    # Move backward slower
+    dps = DPS if distance > 0 else 0.6 * DPS
+    drive(encoder_degrees, encoder_degrees, dps)
 
 
-def turn(degrees: int) -> None:
+def turn(degrees: int, dps: float = 0.75 * DPS, tasks: tuple = ()) -> None:
     """
     Turns the robot by a certain number of degrees.
 
@@ -198,221 +384,147 @@ def turn(degrees: int) -> None:
     ----------
     degrees : int
         The number of degrees to turn. Positive values turn right, and negative values turn left.
+    dps : float
+        Maximum speed of the wheels.
+    tasks : tuple
+        Extra (function, rate) pairs to run during the turn, e.g. to sample a sensor.
     """
 
     # Compute encoder degrees
     encoder_degrees = int(degrees * DEGREE_TO_ROTATION)
 
-    try:
-        # Set motors to move
-        if degrees > 0:
-            right()
-        else:
-            left()
-
-        # Set limits (makes turning work properly)
-        RIGHT_MOTOR.set_limits(dps=0.75 * DPS, power=POWER)
-        LEFT_MOTOR.set_limits(dps=0.75 * DPS, power=POWER)
-
-        # Set wanted position
-        RIGHT_MOTOR.set_position_relative(-encoder_degrees)
-        LEFT_MOTOR.set_position_relative(encoder_degrees)
-        RIGHT_MOTOR.wait_is_moving()
-        RIGHT_MOTOR.wait_is_stopped()
-    finally:
-        stop()
-
+    drive(encoder_degrees, -encoder_degrees, dps, tasks)
 
-def check_red(encoder_degrees):
-    red_found = False
-    sleep(SLEEP)
 
-    right()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(-encoder_degrees)
-    LEFT_MOTOR.set_position_relative(encoder_degrees)
-
-    # Wait until the motor start moving
-    while isclose(RIGHT_MOTOR.get_speed(), 0):
-        sleep(POLL)
-
-    # Wait until the motor stop moving or detect a sticker
-    while not isclose(RIGHT_MOTOR.get_speed(), 0):
-        color = get_color()
-        if color == "red":
-            red_found = True
-        sleep(POLL)
-
-    stop()
-    sleep(SLEEP)
+def turn_to_heading(heading: float) -> None:
+    """
+    Turns the robot to face the given odometry heading.
 
-    # Sweep to the left
-    left()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(1.5 * encoder_degrees)
-    LEFT_MOTOR.set_position_relative(-1.5 * encoder_degrees)
+    Parameters
+    ----------
+    heading : float
+        The wanted heading in degrees, counterclockwise positive (see utils.odometry).
+    """
 
-    # Wait until the motor start moving
-    while isclose(RIGHT_MOTOR.get_speed(), 0):
-        sleep(POLL)
+    # turn() is clockwise positive
+    turn(-ODOMETRY.heading_error(heading))
 
-    # Wait until the motor stop moving or detect a sticker
-    while not isclose(RIGHT_MOTOR.get_speed(), 0):
-        color = get_color()
-        if color == "red":
-            red_found = True
-        sleep(POLL)
 
-    stop()
-    sleep(SLEEP)
+def return_to(pose: tuple, budget: float) -> None:
+    """
+    Returns the robot to a previously recorded pose, by facing its heading then
+    moving straight to its position.
 
-    right()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(-encoder_degrees)
-    LEFT_MOTOR.set_position_relative(encoder_degrees)
+    Parameters
+    ----------
+    pose : tuple
+        The (x, y, heading) pose to return to, from ODOMETRY.get_pose().
+    budget : float
+        The settle budget between the turn and the move.
+    """
 
-    # Wait until the motor start moving
-    while isclose(RIGHT_MOTOR.get_speed(), 0):
-        sleep(POLL)
+    turn_to_heading(pose[2])
+    settle(budget)
+    distance = ODOMETRY.distance_to(pose)
+    if abs(distance) >= 0.5:
+        move(distance)
 
-    # Wait until the motor stop moving or detect a sticker
-    while not isclose(RIGHT_MOTOR.get_speed(), 0):
-        color = get_color()
-        if color == "red":
-            red_found = True
-        sleep(POLL)
 
-    stop()
+def scan_sweep(degrees: float) -> list:
+    """
+    Turns by the given degrees at SCAN_DPS while recording the color under the sensor.
 
-    # if red_found:
-    # print("Found red")
-    return red_found
+    Parameters
+    ----------
+    degrees : float
+        The number of degrees to turn. Positive values turn right, and negative values turn left.
 
+    Returns
+    -------
+    list
+        (heading, color, confidence) samples, with the odometry heading in degrees.
+    """
 
-def green_sweep(encoder_degrees: int) -> bool:
-    sleep(0.5)
-    RIGHT_MOTOR.set_dps(450)
-    LEFT_MOTOR.set_dps(450)
-    RIGHT_MOTOR.set_position_relative(int(2 * DISTANCE_TO_DEGREE))
-    LEFT_MOTOR.set_position_relative(int(2 * DISTANCE_TO_DEGREE))
-    RIGHT_MOTOR.wait_is_moving()
-    RIGHT_MOTOR.wait_is_stopped()
-    stop()
+    samples = []
 
-    sleep(SLEEP)
-    right()
-    start_degrees_right = RIGHT_MOTOR.get_position()
-    start_degrees_left = LEFT_MOTOR.get_position()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(-encoder_degrees)
-    LEFT_MOTOR.set_position_relative(encoder_degrees)
+    def sample() -> None:
+        color, confidence = get_color_confidence((SCAN_MIN_CONFIDENCE,))
+        samples.append((ODOMETRY.get_heading(), color, confidence))
 
-    # Wait until the motor start moving
-    while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+    turn(degrees, SCAN_DPS, tasks=((sample, SCAN_RATE),))
+    return samples
 
-    # Wait until the motor stop moving or detect a sticker
-    while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
-        isclose(LEFT_MOTOR.get_speed(), 0)
-    ):
-        color = get_color()
-        if color == "green":
-            # print("Detected green sticker during sweep.")
-            stop()
-            end_degrees_right = RIGHT_MOTOR.get_position()
-            end_degrees_left = LEFT_MOTOR.get_position()
-            move_back_right = start_degrees_right - end_degrees_right
-            move_back_left = start_degrees_left - end_degrees_left
-            return [True, move_back_right, move_back_left]
-        sleep(POLL)
 
-    stop()
-    sleep(SLEEP)
+def find_sticker(samples: list, color: str) -> float:
+    """
+    Finds a sticker of the given color in the samples of a sweep.
 
-    # Sweep to the left
-    left()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(2 * encoder_degrees)
-    LEFT_MOTOR.set_position_relative(-2 * encoder_degrees)
+    Parameters
+    ----------
+    samples : list
+        (heading, color, confidence) samples from scan_sweep().
+    color : str
+        The color of the sticker.
 
-    # Wait until the motor start moving
-    while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+    Returns
+    -------
+    float
+        The confidence-weighted mean heading of the sticker, or None if fewer than
+        SCAN_MIN_SAMPLES confident samples of that color were recorded.
+    """
 
-    # Wait until the motor stop moving or detect a sticker
-    while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
-        isclose(LEFT_MOTOR.get_speed(), 0)
-    ):
-        color = get_color()
-        if color == "green":
-            # print("Detected green sticker during sweep.")
-            stop()
-            end_degrees_right = RIGHT_MOTOR.get_position()
-            end_degrees_left = LEFT_MOTOR.get_position()
-            move_back_right = start_degrees_right - end_degrees_right
-            move_back_left = start_degrees_left - end_degrees_left
-            return [True, move_back_right, move_back_left]
-        sleep(POLL)
+    hits = [(heading, confidence) for heading, name, confidence in samples
+            if name == color and confidence >= SCAN_MIN_CONFIDENCE]
+    if len(hits) < SCAN_MIN_SAMPLES:
+        return None
 
-    stop()
-    sleep(SLEEP)
+    # Average the offsets from the first hit, so that headings around +-180 do not cancel out
+    reference = hits[0][0]
+    total = sum(confidence for heading, confidence in hits)
+    offset = sum(wrap_degrees(heading - reference) * confidence for heading, confidence in hits) / total
+    return wrap_degrees(reference + offset)
 
-    right()
-    RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-    LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-    RIGHT_MOTOR.set_position_relative(-encoder_degrees)
-    LEFT_MOTOR.set_position_relative(encoder_degrees)
 
-    # Wait until the motor start moving
-    while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+def scan_room() -> str:
+    """
+    Scans the office for red and green stickers, in passes of a single sweep each.
 
-    # Wait until the motor stop moving or detect a sticker
-    while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
-        isclose(LEFT_MOTOR.get_speed(), 0)
-    ):
-        color = get_color()
-        if color == "green":
-            # print("Detected green sticker during sweep.")
-            stop()
-            end_degrees_right = RIGHT_MOTOR.get_position()
-            end_degrees_left = LEFT_MOTOR.get_position()
-            move_back_right = start_degrees_right - end_degrees_right
-            move_back_left = start_degrees_left - end_degrees_left
-            return [True, move_back_right, move_back_left]
-        sleep(POLL)
+    Every pass sweeps SCAN_SWEEP degrees on both sides of the entry heading, in alternating
+    directions, while recording the color samples. The robot moves SCAN_ADVANCE forward
+    between passes. If a green sticker is found, the robot is left facing it.
 
-    stop()
-    sleep(SLEEP)
+    Returns
+    -------
+    str
+        "red" if the office is occupied, "green" if a sticker was found, or "unknown".
+    """
 
-    return [False, 0, 0]
+    entry = ODOMETRY.get_heading()
 
+    # Start from the right edge of the sweep
+    direction = -1
+    samples = scan_sweep(SCAN_SWEEP)
 
-def check_green(sweep_degrees):
-    encoder_degrees = int(sweep_degrees * DEGREE_TO_ROTATION)
-    count = 0
-    found_green = False
+    for count in range(SCAN_PASSES):
+        samples += scan_sweep(direction * 2 * SCAN_SWEEP)
+        direction = -direction
 
-    while True:
-        count += 1
-        found_green_tuple = green_sweep(encoder_degrees)
-        found_green = found_green_tuple[0]
+        if find_sticker(samples, "red") is not None:
+            return "red"
 
-        # Check if count is done
-        if count > 8:
-            break
+        heading = find_sticker(samples, "green")
+        if heading is not None:
+            turn_to_heading(heading)
+            return "green"
 
-        # Check for value found
-        if found_green:
-            break
+        # Move diagonally from the edge of the sweep, by SCAN_ADVANCE along the entry heading.
+        # The sideways offsets of two passes cancel out, since the sweeps alternate.
+        samples = []
+        turn_to_heading(entry + direction * SCAN_SWEEP)
+        move(SCAN_ADVANCE / cos(radians(SCAN_SWEEP)))
+        settle(SLEEP, counted=False)
 
-    # print(f"{count}")
-    return [found_green, found_green_tuple[1], found_green_tuple[2], count]
+    return "unknown"
 
 
 def drop_block():
@@ -423,7 +535,7 @@ def drop_block():
     global DELIVERIES
 
     # Move slightly to the right
-    sleep(1)
+    settle(1)
     right()
     RIGHT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
     LEFT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
@@ -431,7 +543,7 @@ def drop_block():
     LEFT_MOTOR.set_position_relative(DROP_TURN)
     wait()
     stop()
-    sleep(SLEEP)
+    settle(SLEEP)
 
     # Run conveyor belt to drop block
     CONVEYOR_MOTOR.set_dps(450)
@@ -439,14 +551,14 @@ def drop_block():
     CONVEYOR_MOTOR.set_position_relative(135)
     wait_drop()
     CONVEYOR_MOTOR.set_dps(0)
-    sleep(SLEEP)
+    settle(SLEEP, (CONVEYOR_MOTOR,))
 
     CONVEYOR_MOTOR.set_dps(-450)
     CONVEYOR_MOTOR.set_limits(dps=450, power=POWER)
     CONVEYOR_MOTOR.set_position_relative(-90)
     wait_drop()
     CONVEYOR_MOTOR.set_dps(0)
-    sleep(SLEEP)
+    settle(SLEEP, (CONVEYOR_MOTOR,))
 
     # Increment deliveries completed
     DELIVERIES += 1
@@ -474,7 +586,7 @@ def black_sweep(encoder_degrees: int) -> bool:
 
     # Wait until the motor start moving
     while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+        poll()
 
     # Wait until the motor stop moving or detect a sticker
     while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
@@ -484,7 +596,7 @@ def black_sweep(encoder_degrees: int) -> bool:
             # print("Detected black line during sweep.")
             stop()
             return True
-        sleep(POLL)
+        poll()
 
     stop()
 
@@ -497,7 +609,7 @@ def black_sweep(encoder_degrees: int) -> bool:
 
     # Wait until the motor start moving
     while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+        poll()
 
     # Wait until the motor stop moving or detect a sticker
     while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
@@ -507,7 +619,7 @@ def black_sweep(encoder_degrees: int) -> bool:
             # print("Detected black line during sweep.")
             stop()
             return True
-        sleep(POLL)
+        poll()
 
     stop()
 
@@ -519,7 +631,7 @@ def black_sweep(encoder_degrees: int) -> bool:
 
     # Wait until the motor start moving
     while (isclose(RIGHT_MOTOR.get_speed(), 0)) or (isclose(LEFT_MOTOR.get_speed(), 0)):
-        sleep(POLL)
+        poll()
 
     # Wait until the motor stop moving or detect a sticker
     while (not isclose(RIGHT_MOTOR.get_speed(), 0)) or not (
@@ -529,52 +641,119 @@ def black_sweep(encoder_degrees: int) -> bool:
             # print("Detected black line during sweep.")
             stop()
             return True
-        sleep(POLL)
+        poll()
 
     stop()
 
     return False
 
 
+def find_line() -> bool:
+    """
+    Sweeps with increasing angles until the black line is found.
+
+    Returns
+    -------
+    bool
+        Whether or not the black line was found.
+    """
+
+    for encoder_degrees in (20, 45, 60, 90):
+        if black_sweep(encoder_degrees):
+            return True
+    return False
+
+
+def line_speed() -> float:
+    """
+    Gets the base speed of the line follower for the current contrast between the line and the floor.
+
+    Returns
+    -------
+    float
+        LINE_DPS without contrast, up to LINE_MAX_DPS with a contrast margin of LINE_FULL_CONTRAST,
+        since the edge of the line is then found more reliably. LINE_DPS if the contrast is not
+        learned yet.
+    """
+
+    margin = get_contrast_margin()
+    if margin is None:
+        return LINE_DPS
+    return LINE_DPS + (LINE_MAX_DPS - LINE_DPS) * min(max(margin / LINE_FULL_CONTRAST, 0.0), 1.0)
+
+
 def follow_line(distance: float) -> None:
     """
     Follow the black line until it reaches the specified distance from the wall.
 
+    The robot steers continuously with a PID controller on the edge of the line, running
+    at LINE_RATE while the wall distance is tracked at ULTRASONIC_RATE. It only stops to
+    sweep for the line if it was lost for LINE_LOST_TIME. It brakes as soon as the wall
+    distance is predicted to be reached within LINE_STOP_TIME. The sweep runs outside of the
+    control loop, which then starts over with a fresh wall distance. The better the contrast
+    between the line and the floor, the faster it drives (see line_speed).
+
     Parameters
     ----------
     distance : float
         The wanted distance from the wall in centimeters.
     """
 
-    global DELIVERIES
-
-    forward()
-    current_distance = 200.0
-    while current_distance > distance:
-        # print(f"{current_distance} cm")
+    period = 1 / LINE_RATE
+    state = {"integral": 0.0, "last_error": None, "lost_since": None, "lost": False}
+    tracker = ULTRASONIC_SENSOR.get_tracker()
+    scheduler = Scheduler()
+
+    def control_line() -> None:
+        turn = 0.0
+        error = get_line_error()
+
+        wall = tracker.distance
+        if error is not None and (wall is None or wall > LINE_WALL_DISTANCE):
+            # Fall back to sweeping if the line has been lost for too long
+            now = monotonic()
+            if error < LINE_LOST_ERROR:
+                state["lost_since"] = None
+            elif state["lost_since"] is None:
+                state["lost_since"] = now
+            elif now - state["lost_since"] > LINE_LOST_TIME:
+                state["lost"] = True
+                scheduler.stop()
+                return
+
+            # PID steering
+            integral = min(max(state["integral"] + error * period, -LINE_I_LIMIT), LINE_I_LIMIT)
+            last_error = state["last_error"]
+            derivative = 0.0 if last_error is None else (error - last_error) / period
+            state.update(integral=integral, last_error=error)
+            turn = LINE_KP * error + LINE_KI * integral + LINE_KD * derivative
+
+        speed = line_speed()
+        RIGHT_MOTOR.set_dps(speed - LINE_EDGE * turn)
+        LEFT_MOTOR.set_dps(speed + LINE_EDGE * turn)
+
+    def arrived() -> bool:
+        predicted = tracker.predict(LINE_STOP_TIME)
+        return predicted is not None and predicted <= distance
+
+    scheduler.add_task(control_line, LINE_RATE)
+    scheduler.add_task(tracker.update, ULTRASONIC_RATE, "read_distance")
+    scheduler.add_task(checkpoint, STOP_RATE)
 
-        if not is_black() and current_distance > 15.0:
+    try:
+        while True:
+            state.update(integral=0.0, last_error=None, lost_since=None, lost=False)
+            scheduler.run(until=arrived)
+            if not state["lost"]:
+                break
+            # Sweep for the line without the scheduler, whose tasks would all be late
             stop()
-            sleep(0.5 * SLEEP)
-
-            # Check for black line
-            black = black_sweep(20)
-            if not black:
-                black = black_sweep(45)
-                if not black:
-                    black = black_sweep(60)
-                    if not black:
-                        black = black_sweep(90)
-
-            # Continue forward
-            sleep(SLEEP)
-            # forward()
-            RIGHT_MOTOR.set_dps(450)
-            LEFT_MOTOR.set_dps(450)
-
-        current_distance = ULTRASONIC_SENSOR.get_value()
-        sleep(POLL)
-    stop()
+            find_line()
+            tracker.reset()
+    finally:
+        stop()
+    if LINE_REPORT:
+        print(scheduler.report())
 
 
 def turn_to_line_right():
@@ -594,7 +773,7 @@ def turn_to_line_right():
     RIGHT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
     LEFT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
     while not is_black():
-        sleep(POLL)
+        poll()
     stop()
 
 
@@ -615,7 +794,7 @@ def turn_to_line_left():
     RIGHT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
     LEFT_MOTOR.set_limits(dps=0.5 * DPS, power=POWER)
     while not is_black():
-        sleep(POLL)
+        poll()
     stop()
 
 
@@ -629,7 +808,7 @@ def interrupt() -> bool:
         Whether or not there is an interrupt.
     """
 
-    return STOP.is_pressed()
+    return ESTOP.is_triggered()
 
 
 def check_room() -> None:
@@ -637,187 +816,123 @@ def check_room() -> None:
     Function to scan the entire office for red and green stickers.
     """
 
-    sleep(SLEEP)
-    found_red = check_red(50)
-    if found_red:
-        return
-    else:
-        found_green_tuple = check_green(40)
-        found_green = found_green_tuple[0]
-        move_back_right = found_green_tuple[1]
-        move_back_left = found_green_tuple[2]
-
-        if found_green:
-            drop_block()
-            play_drop_sound()
-            stop()
-            sleep(SLEEP)
+    settle(SLEEP)
+    # Pose at the door, to come back to it after the scan
+    entry = ODOMETRY.get_pose()
 
-            RIGHT_MOTOR.set_limits(dps=DPS, power=POWER)
-            LEFT_MOTOR.set_limits(dps=DPS, power=POWER)
-            RIGHT_MOTOR.set_position_relative(move_back_right + DROP_TURN)
-            LEFT_MOTOR.set_position_relative(move_back_left - DROP_TURN)
-            wait()
-            stop()
-            sleep(SLEEP)
+    if scan_room() == "green":
+        drop_block()
+        play_drop_sound()
+    stop()
+    settle(SLEEP)
 
-            back_to_door()
-            sleep(SLEEP / 2)
-            move(1.5)
-            stop()
-            sleep(SLEEP)
-        else:
-            stop()
-            sleep(SLEEP)
+    # The original route paused for half a sleep between the turn back and the move out
+    return_to(entry, SLEEP / 2)
+    stop()
+    settle(SLEEP)
 
-            back_to_door()
-            sleep(SLEEP / 2)
-            move(1.5)
-            stop()
-            sleep(SLEEP)
+
+# Actions that can be used in the mission file
+MISSION_FILE = "mission.json"
+MISSION_ACTIONS = {
+    "initiate": initiate,
+    "follow_line": follow_line,
+    "move": move,
+    "turn": turn,
+    "turn_to_line_left": turn_to_line_left,
+    "turn_to_line_right": turn_to_line_right,
+    "check_room": check_room,
+    "settle": settle,
+    "play_drop_sound": play_drop_sound,
+    "play_victory_sound": play_victory_sound,
+}
 
 
-def main_move() -> None:
+def main_move(state: SharedState = None) -> None:
     """
     This is the main function of the code that is ran by the process. Add movement here.
-    """
-
-    global DELIVERIES
 
-    sleep(SLEEP)
+    The route, rooms and actions are described in MISSION_FILE, and run by a MissionExecutor.
+    The pauses between motions are settle actions of the mission file, each with the fixed
+    sleep of the original route as its budget.
 
-    # First office
-    # print("Going to first office")
-    initiate()
-    sleep(0.1)
-    follow_line(3 * TILE_SIZE + 0.5)
-    sleep(1)
-    turn(-90)
+    Parameters
+    ----------
+    state : SharedState
+        Where the mission state is published, and a stop can be requested.
+    """
 
-    sleep(SLEEP)
-    # print("Checking first office")
-    check_room()
-    sleep(1)
-    turn_to_line_right()
-    sleep(0.1)
-
-    # Second office
-    # print("Going to second office")
-    follow_line(TILE_SIZE + 2)
-    sleep(1)
-    turn(-90)
+    global STATE
 
-    sleep(SLEEP)
-    # print("Checking second office")
-    check_room()
-
-    # Mail room
-    if DELIVERIES == 2:
-        sleep(1)
-        turn_to_line_left()
-        # print("Going to mail room")
-        follow_line(2 * TILE_SIZE)
-        sleep(1)
-        # print("Turning to mail room")
-        turn(90)
-        sleep(SLEEP)
-        # print("Going to mail room")
-        # follow_line(3.1 * TILE_SIZE)
-        # move(20)
-        move(45)
-        # sleep(SLEEP)
-        # print("At mail room")
-        play_victory_sound()
-        exit()
+    STATE = state
+    init_devices()
+    if RECORD_FILE:
+        set_recorder(Recorder(RECORD_FILE))
+    # With DPM_REPLAY set, the sensors return the values of a recorded run from here on
+    replay = get_default_brick()
+    if isinstance(replay, ReplayBrick):
+        replay.start()
     else:
-        sleep(1)
-        turn_to_line_right()
-
-    # Big corner
-    # print("Going to first corner")
-    follow_line(6)
-    sleep(1)
-    # print("Turning first corner")
-    turn(-77.5)
+        replay = None
     sleep(SLEEP)
 
-    # Third office
-    # print("Going to third office")
-    follow_line(TILE_SIZE + 2)
-    sleep(1)
-    turn(-90)
-    sleep(SLEEP)
+    def set_phase(phase: str) -> None:
+        if STATE is not None:
+            STATE.update(phase=phase)
 
-    sleep(SLEEP)
-    # print("Checking third office")
-    check_room()
-    sleep(1)
-    turn_to_line_right()
-
-    # Big corner
-    # print("Going to second corner")
-    follow_line(6)
-    sleep(1)
-    # print("Turning second corner")
-    turn(-77.5)
-
-    # Mail room
-    if DELIVERIES == 2:
-        # print("Going to mail room")
-        sleep(SLEEP)
-        follow_line(2 * TILE_SIZE)
-        sleep(1)
-        # print("Turning to mail room")
-        turn(-90)
-        sleep(SLEEP)
-        # print("Going to mail room")
-        # follow_line(3.1 * TILE_SIZE)
-        # move(20)
-        move(45)
-        # print("At mail room")
-        play_victory_sound()
-        exit()
-
-    # Fourth office
-    # print("Going to fourth office")
-    follow_line(TILE_SIZE + 2)
-    sleep(1)
-    turn(-90)
+    mission = Mission.load(MISSION_FILE)
+    executor = MissionExecutor(mission, MISSION_ACTIONS, delivered=lambda: DELIVERIES,
+                               log=print, on_step=set_phase)
+    try:
+        startup.mark("mission start")
+        executor.run()
+        set_phase("done")
+    except StopRequested:
+        set_phase("stopped")
+    except ReplayEnded as err:
+        set_phase("replay ended")
+        print(f"Replay ended: {err}")
+    finally:
+        # Stop the motors here rather than being killed in the middle of a command
+        stop()
+        CONVEYOR_MOTOR.set_dps(0)
+        if RECORD_FILE:
+            set_recorder(None).close()
+    print(idle_report())
+    if replay is not None:
+        print("\n".join(replay.diff_commands()) or "Same commands as the recorded run")
 
-    sleep(SLEEP)
-    # print("Checking fourth office")
-    check_room()
-    sleep(1)
-    turn_to_line_left()
 
-    # Mail room
-    # print("Going to mail room")
-    sleep(SLEEP)
-    follow_line(2 * TILE_SIZE)
-    sleep(1)
-    # print("Turning to mail room")
-    turn(90)
-    sleep(SLEEP)
-    # print("Going to mail room")
-    # follow_line(3.1 * TILE_SIZE)
-    # move(20)
-    move(45)
-    # print("At mail room")
-    play_victory_sound()
+if __name__ == "__main__":
+    state = SharedState()
+    init_stop()
 
+    # Cut the motors and ask the movement process to stop as soon as STOP is pressed
+    ESTOP.add_callback(state.request_stop)
+    ESTOP.start()
 
-if __name__ == "__main__":
     # Create process for movement
-    move_process = Process(target=main_move)
+    move_process = Process(target=main_move, args=(state,))
     move_process.start()
     # print("Movement process started")
 
     # Wait for movement to finish
-    while move_process.is_alive() and not interrupt():
-        sleep(POLL)
+    supervisor = Scheduler()
+
+    def check_stop() -> None:
+        if not move_process.is_alive() or interrupt():
+            supervisor.stop()
+
+    supervisor.add_task(check_stop, STOP_RATE)
+    supervisor.run()
 
-    stop()
     # print("Movement process stopping")
-    move_process.terminate()
-    move_process.join()
-    # print("Movement process ended")
+    move_process.join(STOP_TIMEOUT)
+    if move_process.is_alive():
+        # Only kill the movement process if it did not stop by itself
+        move_process.terminate()
+        move_process.join()
+        ESTOP.cut_motors()  # the motors of this process are only created by the movement process
+    # Last state written by the movement process, eg. where it stopped after an emergency stop
+    print(f"Movement process ended: {state.read()}")
+    state.close()
@@ -0,0 +1,137 @@
+"""
+Module for using the sensors and motors of utils.brick from asyncio coroutines.
+
+The methods of utils.brick block the program while they talk to the BrickPi, and their
+waits poll with time.sleep. An AsyncBrick runs all these calls on a single thread, the
+owner of the bus, so that the coroutines of the event loop never block, never talk to
+the BrickPi at the same time, and the waits let the other coroutines run. Several tasks
+(eg. a line follower, an emergency stop watch, sounds and telemetry) can then run
+concurrently in one process, each written as a simple loop.
+
+Example Usage:
+
+    async def main():
+        async with AsyncBrick() as bus:
+            await bus.wait_ready(TOUCH_SENSOR, COLOR_SENSOR)
+            await bus.call(MOTOR.set_dps, 360)
+            await bus.watch(TOUCH_SENSOR.is_pressed)  # until pressed
+            async for ambient in bus.stream(COLOR_SENSOR.get_ambient, rate=100):
+                ...
+
+    asyncio.run(main())
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Callable
+import asyncio
+
+from .brick import SETTLED_SAMPLES, SETTLED_SPEED, SETTLED_TOLERANCE, Motor, Sensor
+
+POLL_INTERVAL = 0.01  # seconds between two reads of the waits and watches
+
+
+class AsyncBrick:
+    """Awaitable reads and waits of the devices of utils.brick, all run on one bus thread.
+
+    poll_interval - default seconds between two reads of the waits and watches
+
+    >>> from utils.filters import range_limit
+    >>> async def example(bus):
+    ...     return await bus.call(range_limit, 60, 30, 50), await bus.watch(iter(range(10)).__next__, lambda v: v > 3)
+    >>> bus = AsyncBrick()
+    >>> asyncio.run(example(bus))
+    (50, 4)
+    >>> bus.close()
+    """
+
+    def __init__(self, poll_interval: float = POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="brick-bus")
+
+    async def call(self, func: Callable, *args, **kwargs):
+        """Runs func(*args, **kwargs) on the bus thread and returns its result, eg.
+        await bus.call(MOTOR.set_dps, 360)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def read(self, sensor: Sensor):
+        "Returns the value of the sensor in its current mode, None if it could not be read."
+        return await self.call(sensor.get_value)
+
+    async def watch(self, read: Callable, predicate: Callable = bool, interval: float = None,
+                    timeout: float = None):
+        """Reads read() every interval until predicate(value) is True, and returns that value.
+        Raises asyncio.TimeoutError after timeout seconds, if given."""
+        if timeout is not None:
+            return await asyncio.wait_for(self.watch(read, predicate, interval), timeout)
+        interval = self.poll_interval if interval is None else interval
+        while True:
+            value = await self.call(read)
+            if predicate(value):
+                return value
+            await asyncio.sleep(interval)
+
+    async def watch_threshold(self, read: Callable, below: float = None, above: float = None,
+                              interval: float = None, timeout: float = None) -> float:
+        """Waits until read() returns a value below or above the given thresholds, and returns
+        that value. Invalid readings (None) are ignored."""
+        def crossed(value):
+            return value is not None and (below is not None and value < below
+                                          or above is not None and value > above)
+        return await self.watch(read, crossed, interval, timeout)
+
+    async def stream(self, read: Callable, rate: float) -> AsyncIterator:
+        """Yields read() rate times per second, without drifting (a late read does not delay
+        the next ones), until the loop using it stops."""
+        loop = asyncio.get_running_loop()
+        period = 1 / rate
+        next_time = loop.time()
+        while True:
+            yield await self.call(read)
+            next_time += period
+            delay = next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_time = loop.time()  # too late, restart the schedule from now
+
+    async def wait_ready(self, *sensors: Sensor, timeout: float = None):
+        "Waits until the sensors (all sensors created if none are given) are initialized."
+        if not sensors:
+            sensors = [sensor for sensor in Sensor.ALL_SENSORS.values() if sensor is not None]
+        for sensor in sensors:
+            await self.watch(sensor.get_status, lambda status: status == Sensor.Status.VALID_DATA,
+                             timeout=timeout)
+
+    async def wait_moving(self, motor: Motor, timeout: float = None):
+        "Waits until the motor is moving."
+        await self.watch(motor.is_moving, timeout=timeout)
+
+    async def wait_stopped(self, motor: Motor, timeout: float = None):
+        "Waits until the motor is stopped."
+        await self.watch(motor.is_moving, lambda moving: moving is False, timeout=timeout)
+
+    async def wait_settled(self, motor: Motor, speed_threshold: float = SETTLED_SPEED,
+                           tolerance: float = SETTLED_TOLERANCE, samples: int = SETTLED_SAMPLES,
+                           timeout: float = None):
+        """Waits until the motor is stopped at its last position target for samples consecutive
+        readings, like Motor.wait_settled (a reversing motor passes through zero speed)."""
+        count = 0
+
+        def settled(value) -> bool:
+            nonlocal count
+            count = count + 1 if value else 0
+            return count >= samples
+
+        await self.watch(partial(motor.is_settled, speed_threshold, tolerance), settled, timeout=timeout)
+
+    def close(self):
+        "Waits for the calls in progress, then stops the bus thread."
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
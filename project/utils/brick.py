@@ -12,9 +12,11 @@ import math
 import atexit
 import os
 import signal
+import threading
 import time
 import sys
 
+from . import recorder, replay, startup
 
 def busy_sleep(seconds: float):
     """A different form of time.sleep, which uses a while loop that 
@@ -28,20 +30,55 @@ class IOError(OSError):
     pass
 
 
-# Save process ID of this program so we can force stop it later if needed
-os.system(f"echo {os.getpid()} > ~/brickpi3_pid")
-BP = None
+PID_FILE = "~/brickpi3_pid"
+SPI_DEVICE = "/dev/spidev0.1"  # used by the BrickPi3
+
 try:
     from brickpi3 import Enumeration, FirmwareVersionError, SensorError, BrickPi3
     import spidev
-    BP = BrickPi3()  # The BrickPi3 instance
+    if not os.path.exists(SPI_DEVICE):
+        raise OSError(f"{SPI_DEVICE} not found")
 except (ModuleNotFoundError, OSError, TypeError) as err:
     print('A BrickPi module is missing, or BrickPi is missing, intializing dummy BP', file=sys.stderr)
     print(f'Warning: {err.__class__.__name__}({err})', file=sys.stderr)
     from .dummy import Enumeration, FirmwareVersionError, SensorError, BrickPi3
-    BP = BrickPi3()  # The BrickPi3 instance
 
-_OLD_BP = BP
+# The BrickPi3 instance used by new devices. It is only created by get_default_brick,
+# when the first device is created, since talking to the BrickPi takes time. It replays
+# a recorded run instead if the DPM_REPLAY environment variable is set (see utils.replay).
+BP = None
+_OLD_BP = None
+
+
+def write_pid():
+    "Save process ID of this program so we can force stop it later if needed."
+    try:
+        with open(os.path.expanduser(PID_FILE), "w") as f:
+            f.write(f"{os.getpid()}\n")
+    except OSError:
+        pass
+
+
+write_pid()
+
+
+def get_default_brick():
+    "Return the BrickPi3 instance used by new devices, creating it if needed."
+    global BP, _OLD_BP
+    if BP is None:
+        if _OLD_BP is None:
+            with startup.span("BrickPi3 init"):
+                _OLD_BP = replay.from_env()
+                if _OLD_BP is None:
+                    try:
+                        _OLD_BP = BrickPi3()
+                    except (ModuleNotFoundError, OSError, TypeError) as err:
+                        print('BrickPi could not be initialized, intializing dummy BP', file=sys.stderr)
+                        print(f'Warning: {err.__class__.__name__}({err})', file=sys.stderr)
+                        from . import dummy
+                        _OLD_BP = dummy.BrickPi3()
+        BP = _OLD_BP
+    return BP
 
 
 def restore_default_brick(bp=None):
@@ -52,9 +89,31 @@ def restore_default_brick(bp=None):
         BP = bp
 
 
+# Records every sensor read and motor command if set, see utils.recorder
+RECORDER = None
+
+
+def set_recorder(new_recorder: recorder.Recorder | None) -> recorder.Recorder | None:
+    """Record the sensor reads and motor commands of all devices with new_recorder,
+    or stop recording if None. Returns the recorder given, or the previous one if None."""
+    global RECORDER
+    previous, RECORDER = RECORDER, new_recorder
+    return new_recorder if new_recorder is not None else previous
+
+
 WAIT_READY_INTERVAL = 0.01
 INF = float("inf")
 
+# Defaults of Motor.is_settled and Motor.wait_settled
+SETTLED_SPEED = 5  # degrees per second below which a motor is considered stopped
+SETTLED_TOLERANCE = 5  # degrees of encoder error accepted from the last position target
+SETTLED_SAMPLES = 3  # consecutive settled readings needed by Motor.wait_settled
+
+# Defaults of EmergencyStop
+ESTOP_RATE = 200  # touch sensor reads per second
+ESTOP_NICE = -10  # priority of the watchdog thread, only applied if allowed (root)
+ESTOP_LOG = "~/estop_latency.log"
+
 PORTS: dict[str, int] = {
     '1': BrickPi3.PORT_1,
     '2': BrickPi3.PORT_2,
@@ -166,7 +225,7 @@ class Brick(BrickPi3):
 
     def __init__(self, bp=None):
         if bp is None:
-            self.bp = BP
+            self.bp = get_default_brick()
         else:
             self.bp = bp
         child = self.__dict__
@@ -364,7 +423,10 @@ class Sensor:
         NO_DATA
         I2C_ERROR
         """
-        return SENSOR_CODES[self.brick.get_sensor_status(self.port)]
+        code = self.brick.get_sensor_status(self.port)
+        if RECORDER is not None:
+            RECORDER.record(recorder.SENSOR_STATUS, self.port, code)
+        return SENSOR_CODES[code]
 
     def set_port(self, port: Literal[1, 2, 3, 4]):
         "Change sensor port number. Does not unassign previous port."
@@ -377,9 +439,12 @@ class Sensor:
     def get_value(self):
         "Get the raw sensor value. May return a float, int, list or None if error."
         try:
-            return self.brick.get_sensor(self.port)
+            value = self.brick.get_sensor(self.port)
         except SensorError:
-            return None
+            value = None
+        if RECORDER is not None:
+            RECORDER.record(recorder.SENSOR_VALUE, self.port, value)
+        return value
 
     def get_raw_value(self):
         "Get the raw sensor value. May return a float, int, list or None if error."
@@ -493,6 +558,15 @@ class EV3UltrasonicSensor(Sensor):
             self.wait_ready()
         return self.get_value() == 1
 
+    def get_tracker(self, **kwargs):
+        """
+        Returns a RangeTracker (see utils.ranging) of this sensor's distance in cm,
+        which rejects dropouts and outliers and estimates the closing velocity.
+        Keyword arguments are passed to RangeTracker.
+        """
+        from .ranging import RangeTracker
+        return RangeTracker(self.get_cm, **kwargs)
+
 
 class EV3ColorSensor(Sensor):
     """
@@ -652,6 +726,7 @@ class Motor:
         both motors at the exact same time (exact combined behavior unknown).
         """
         self.brick = Brick(bp)
+        self.target = None  # encoder target of the last position command, if any
         self.set_port(port)
 
     def set_port(self, port):
@@ -683,7 +758,10 @@ class Motor:
         Keyword arguments:
         power - The power from -100 to 100, or -128 for float
         """
+        self.target = None
         self.brick.set_motor_power(self.port, power)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_POWER, self.port, power)
 
     def float_motor(self):
         """(Float the motor), which unlocks the motor, and allows outside forces to rotate it.
@@ -699,7 +777,10 @@ class Motor:
         It DOES NOT RESET any limits defined by (Motor.set_limits)
         The Motor will stop any current movements, then unlock
         """
+        self.target = None
         self.brick.set_motor_power(self.port, -128)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_POWER, self.port, -128)
 
     def set_position(self, position):
         """
@@ -724,7 +805,10 @@ class Motor:
         If you use Motor.set_position IMMEDIATELY AFTER Motor.set_power or Motor.set_dps,
             it will rotate at FULL POWER. This may crash the robot.
         """
+        self.target = position
         self.brick.set_motor_position(self.port, position)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_POSITION, self.port, position)
 
     def set_position_relative(self, degrees):
         """
@@ -751,7 +835,11 @@ class Motor:
         If you use Motor.set_position IMMEDIATELY AFTER Motor.set_power or Motor.set_dps,
             it will rotate at FULL POWER. This may crash the robot.
         """
+        encoder = self.get_encoder()
+        self.target = None if encoder is None else encoder + degrees
         self.brick.set_motor_position_relative(self.port, degrees)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_POSITION_RELATIVE, self.port, degrees)
 
     def set_position_kp(self, kp=25):
         """
@@ -796,7 +884,10 @@ class Motor:
         Keyword arguments:
         dps - The target speed in degrees per second
         """
+        self.target = None
         self.brick.set_motor_dps(self.port, dps)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_DPS, self.port, dps)
         self.set_limits(dps=dps)
 
     def set_limits(self, power=0, dps=0):
@@ -816,6 +907,8 @@ class Motor:
         dps - The speed limit in degrees per second, with 0 being no limit
         """
         self.brick.set_motor_limits(self.port, power, dps)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_LIMITS, self.port, [power, dps])
 
     def get_status(self):
         """
@@ -833,9 +926,12 @@ class Motor:
             dps - The current speed in Degrees Per Second
         """
         try:
-            return self.brick.get_motor_status(self.port)
+            status = self.brick.get_motor_status(self.port)
         except IOError:
-            return [None, None, None, None]
+            status = [None, None, None, None]
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_STATUS, self.port, status)
+        return status
 
     def get_encoder(self):
         """
@@ -846,7 +942,10 @@ class Motor:
         Keyword arguments:
         Returns the encoder position in degrees
         """
-        return self.brick.get_motor_encoder(self.port)
+        encoder = self.brick.get_motor_encoder(self.port)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_ENCODER, self.port, encoder)
+        return encoder
 
     def get_position(self):
         """
@@ -904,6 +1003,8 @@ class Motor:
         You can zero the encoder by offsetting it by the current position
         """
         self.brick.offset_motor_encoder(self.port, position)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_OFFSET, self.port, position)
 
     def reset_encoder(self):
         """
@@ -912,6 +1013,8 @@ class Motor:
         Keyword arguments:
         """
         self.brick.reset_motor_encoder(self.port)
+        if RECORDER is not None:
+            RECORDER.record(recorder.MOTOR_OFFSET, self.port)
 
     def reset_position(self):
         """
@@ -940,6 +1043,42 @@ class Motor:
         while self.is_moving():
             time.sleep(sleep_interval)
 
+    def is_settled(self, speed_threshold: float = SETTLED_SPEED, tolerance: float = SETTLED_TOLERANCE):
+        """
+        Returns True if the motor speed is below speed_threshold, and the encoder is within
+        tolerance degrees of the target of the last set_position or set_position_relative
+        (if the motor was last commanded with set_dps or set_power, only the speed is checked).
+        Returns None if the motor status could not be read.
+        """
+        status = self.get_status()
+        speed, encoder = status[3], status[2]
+        if speed is None or encoder is None:
+            return None
+        if abs(speed) > speed_threshold:
+            return False
+        return self.target is None or abs(encoder - self.target) <= tolerance
+
+    def wait_settled(self, speed_threshold: float = SETTLED_SPEED, tolerance: float = SETTLED_TOLERANCE,
+                     samples: int = SETTLED_SAMPLES, timeout: float = None, sleep_interval: float = None) -> bool:
+        """
+        Waits until is_settled is True for the given number of consecutive readings,
+        or until timeout seconds have passed. Returns whether the motor settled.
+
+        Waiting for several readings avoids mistaking the turning point of an
+        oscillation around the target, or the start of a move, for a stop.
+        """
+        if sleep_interval is None:
+            sleep_interval = WAIT_READY_INTERVAL
+        deadline = None if timeout is None else time.monotonic() + timeout
+        count = 0
+        while True:
+            count = count + 1 if self.is_settled(speed_threshold, tolerance) else 0
+            if count >= samples:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(sleep_interval)
+
 
 def create_motors(motor_ports: list[Literal["A", "B", "C", "D"]] | str):
     return Motor.create_motors(motor_ports)
@@ -997,9 +1136,142 @@ def configure_ports(*,
     return sensors + motors
 
 
+class EmergencyStop:
+    """
+    Watchdog that reads a TouchSensor at a high rate in a background thread. When it is
+    pressed, all four motors are cut with a single command, then the registered callbacks
+    are called. The stop is latched: the motors are cut once, then the sensor is no longer read
+    and is_triggered() stays True. A read error is reported once, until a read succeeds again.
+
+    The press is seen at most one period (1 / rate) after it happens, and the motors are cut
+    one bus transaction later. Each trigger is logged to log_path as a CSV line of:
+    time, milliseconds from the read that saw the press to the cut,
+    and milliseconds from the read before it (upper bound of the latency).
+
+    Example Usage:
+
+        ESTOP = EmergencyStop(TouchSensor(1)).start()
+        ESTOP.add_callback(lambda: print("Emergency stop"))
+        while not ESTOP.is_triggered():
+            ...
+    """
+
+    def __init__(self, sensor: TouchSensor, rate: float = ESTOP_RATE, log_path: str = ESTOP_LOG, bp=None):
+        self.sensor = sensor
+        self.period = 1 / rate
+        self.log_path = None if log_path is None else os.path.expanduser(log_path)
+        self.brick = Brick(bp)
+        self.callbacks = []
+        self.latency = None  # seconds from the press read to the cut, of the last trigger
+
+        self._triggered = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add_callback(self, func):
+        "Registers func to be called without arguments once the stop is triggered."
+        self.callbacks.append(func)
+        return func
+
+    def cut_motors(self):
+        "Cuts the power of all four motors with one command."
+        ports = (BrickPi3.PORT_A, BrickPi3.PORT_B, BrickPi3.PORT_C, BrickPi3.PORT_D)
+        try:
+            self.brick.set_motor_power(sum(ports), 0)
+        except OSError:
+            # The dummy brick only accepts one port at a time
+            for port in ports:
+                self.brick.set_motor_power(port, 0)
+
+    def start(self):
+        "Starts watching the sensor in a background thread."
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="emergency stop", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        "Stops watching the sensor."
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_triggered(self) -> bool:
+        return self._triggered.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        "Waits until the stop is triggered. Returns False on timeout."
+        return self._triggered.wait(timeout)
+
+    def trigger(self, seen: float = None, previous: float = None):
+        "Cuts the motors, calls the callbacks and logs the latency. Can be called directly."
+        self.cut_motors()
+        cut = time.monotonic()
+        if self._triggered.is_set():
+            return
+        if seen is not None:
+            self.latency = cut - seen
+        self._triggered.set()
+        if seen is not None:
+            self._log(cut - seen, None if previous is None else cut - previous)
+        for func in self.callbacks:
+            try:
+                func()
+            except Exception as err:
+                print(f"Emergency stop callback failed: {err!r}", file=sys.stderr)
+
+    def _log(self, latency: float, bound: float):
+        if self.log_path is None:
+            return
+        bound = "" if bound is None else f"{bound * 1000:.3f}"
+        try:
+            with open(self.log_path, "a") as f:
+                f.write(f"{time.time():.3f},{latency * 1000:.3f},{bound}\n")
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), ESTOP_NICE)
+        except (AttributeError, OSError):
+            pass  # not allowed, or not Linux
+
+        previous = None
+        failures = 0  # consecutive failed reads
+        next_time = time.monotonic()
+        while not self._stop_event.is_set():
+            if self._triggered.is_set():
+                # Latched, the motors were cut by trigger()
+                self._stop_event.wait()
+                break
+            now = time.monotonic()
+            try:
+                if self.sensor.is_pressed():
+                    self.trigger(now, previous)
+            except (OSError, SensorError) as err:
+                # Keep watching through transient bus errors, reported once at the rate of the watch
+                if failures == 0:
+                    print(f"Emergency stop read failed: {err!r}", file=sys.stderr)
+                failures += 1
+            else:
+                if failures:
+                    print(f"Emergency stop read recovered after {failures} failed reads", file=sys.stderr)
+                failures = 0
+            previous = now
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+
+
 def reset_brick(*args):
-    "Reset BrickPi devices when program exits ('at exit')."
-    BP.reset_all()
+    "Reset BrickPi devices when program exits ('at exit'), if they were used."
+    if BP is not None:
+        BP.reset_all()
 
 
 # Reset brick when the program exits
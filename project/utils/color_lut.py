@@ -0,0 +1,202 @@
+"""
+Module for classifying colors with a lookup table instead of a nearest color search.
+
+The normalized RGB vector of a reading has its 3 components between 0 and 1. The table
+splits that cube into BINS^3 cells, and holds the closest reference color of every cell
+with the confidence of color.py at its center, so that classifying a reading only takes
+an index computation. A cell where the closest color is not the same everywhere (on a
+boundary between two colors) has no color in the table, and classify() returns None
+for it: the caller then runs the exact search, so that the colors found are always the
+same as with the search.
+
+The confidence of a reading can differ from the one at the center of its cell. The table
+also holds how much it can differ in every cell (its spread), so that classify() can
+return None when the confidence is too close to a threshold of the caller to be sure
+which side of it the reading is on.
+
+The table is saved in a binary file with the reference colors it was built from, and is
+rebuilt when they change.
+
+Example Usage:
+
+    lut = ColorLUT.load_or_build("color_lut.bin", {"red": [0.98, 0.14, 0.08], ...})
+    result = lut.classify(0.97, 0.15, 0.09, thresholds=(0.2,))  # normalized RGB
+    if result is None:
+        ...  # exact search
+    name, confidence = result
+"""
+
+from math import sqrt
+import os
+import struct
+
+BINS = 32  # cells along each component
+MAGIC = b"CLU2"
+_HEADER = struct.Struct("<4sBB")  # magic, bins, number of colors
+_COLOR = struct.Struct("<3d")
+NO_COLOR = 255  # class id of the cells on a boundary, or that no reading can fall in
+SPREAD_MARGIN = 1.25  # the spread of a cell is measured at its corners, this covers the rest
+
+
+def _closest(x, y, z, colors):
+    "Returns the index of the closest color to (x, y, z), and the confidence of color.py."
+    closest, closest_dist, second_dist = 0, float("inf"), float("inf")
+    for i, (r, g, b) in enumerate(colors):
+        dist = sqrt((x - r) * (x - r) + (y - g) * (y - g) + (z - b) * (z - b))
+        if dist < closest_dist:
+            closest, second_dist, closest_dist = i, closest_dist, dist
+        elif dist < second_dist:
+            second_dist = dist
+    if second_dist == float("inf"):
+        return closest, 1.0
+    return closest, 1 - closest_dist / second_dist
+
+
+class ColorLUT:
+    """Lookup table of the closest reference color of every cell of the normalized RGB cube.
+
+    >>> lut = ColorLUT.build({"red": [0.98, 0.14, 0.08], "green": [0.62, 0.77, 0.12]}, bins=16)
+    >>> lut.classify(0.97, 0.2, 0.1)[0], lut.classify(0.6, 0.8, 0.1)[0]
+    ('red', 'green')
+    >>> name, confidence = lut.classify(0.97, 0.2, 0.1)
+    >>> lut.classify(0.97, 0.2, 0.1, thresholds=(confidence,)) is None
+    True
+    >>> ColorLUT.from_bytes(lut.to_bytes()).spreads == lut.spreads
+    True
+    """
+
+    def __init__(self, names: list, colors: list, bins: int, table: bytes, confidences: bytes,
+                 spreads: bytes):
+        self.names = list(names)
+        self.colors = [list(color) for color in colors]
+        self.bins = bins
+        self.table = table  # class id of every cell, NO_COLOR if none
+        self.confidences = confidences  # confidence of every cell, from 0 to 255
+        self.spreads = spreads  # largest difference from that confidence in the cell, from 0 to 255
+
+    @classmethod
+    def build(cls, colors: dict, bins: int = BINS) -> "ColorLUT":
+        """Builds the table of the reference colors, a dictionary of normalized RGB vectors by name."""
+        names = list(colors)
+        refs = [colors[name] for name in names]
+        if len(refs) >= NO_COLOR:
+            raise ValueError(f"at most {NO_COLOR - 1} colors")
+
+        # The closest color to a unit vector x is i if, for every other color j,
+        # x . (ref_i - ref_j) >= (|ref_i|^2 - |ref_j|^2) / 2. A cell is inside the region of i
+        # if all its corners are on the right side of these planes.
+        planes = [[((ri[0] - rj[0], ri[1] - rj[1], ri[2] - rj[2]),
+                    (sum(c * c for c in ri) - sum(c * c for c in rj)) / 2)
+                   for rj in refs if rj is not ri] for ri in refs]
+
+        table = bytearray([NO_COLOR]) * bins ** 3
+        confidences = bytearray(bins ** 3)
+        spreads = bytearray(bins ** 3)
+        step = 1 / bins
+        for i in range(bins):
+            for j in range(bins):
+                for k in range(bins):
+                    low = (i * step, j * step, k * step)
+                    high = (low[0] + step, low[1] + step, low[2] + step)
+                    # Only cells crossing the unit sphere can hold a normalized vector
+                    if sum(c * c for c in low) > 1 or sum(c * c for c in high) < 1:
+                        continue
+                    center = [c + step / 2 for c in low]
+                    norm = sqrt(sum(c * c for c in center))
+                    closest, confidence = _closest(*[c / norm for c in center], refs)
+                    corners = [(x, y, z) for x in (low[0], high[0]) for y in (low[1], high[1])
+                               for z in (low[2], high[2])]
+                    if all(x * n[0] + y * n[1] + z * n[2] >= offset
+                           for n, offset in planes[closest] for x, y, z in corners):
+                        index = (i * bins + j) * bins + k
+                        table[index] = closest
+                        confidences[index] = round(confidence * 255)
+                        spread = 0.0
+                        for corner in corners:
+                            norm = sqrt(sum(c * c for c in corner))
+                            corner_confidence = _closest(*[c / norm for c in corner], refs)[1]
+                            spread = max(spread, abs(corner_confidence - confidence))
+                        spreads[index] = min(255, int(spread * SPREAD_MARGIN * 255) + 2)  # + rounding
+        return cls(names, refs, bins, bytes(table), bytes(confidences), bytes(spreads))
+
+    def classify(self, r: float, g: float, b: float, thresholds: tuple = ()):
+        """Returns (name, confidence) of a normalized RGB vector, or None if the exact search
+        is needed. The confidence is the one at the center of the cell of the vector, and
+        None is also returned if the exact one could be on the other side of a threshold."""
+        if r < 0 or g < 0 or b < 0:
+            return None
+        bins = self.bins
+        last = bins - 1
+        index = ((min(int(r * bins), last) * bins + min(int(g * bins), last)) * bins
+                 + min(int(b * bins), last))
+        class_id = self.table[index]
+        if class_id == NO_COLOR:
+            return None
+        confidence = self.confidences[index] / 255
+        spread = self.spreads[index] / 255
+        for threshold in thresholds:
+            if abs(confidence - threshold) <= spread:
+                return None
+        return self.names[class_id], confidence
+
+    def matches(self, colors: dict) -> bool:
+        "Returns True if the table was built from these reference colors."
+        return self.names == list(colors) and self.colors == [list(colors[name]) for name in self.names]
+
+    def to_bytes(self) -> bytes:
+        data = [_HEADER.pack(MAGIC, self.bins, len(self.names))]
+        for name, color in zip(self.names, self.colors):
+            encoded = name.encode()
+            data.append(bytes([len(encoded)]) + encoded + _COLOR.pack(*color))
+        data.append(self.table)
+        data.append(self.confidences)
+        data.append(self.spreads)
+        return b"".join(data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ColorLUT":
+        magic, bins, count = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a color lookup table")
+        offset = _HEADER.size
+        names, colors = [], []
+        for _ in range(count):
+            length = data[offset]
+            names.append(data[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+            colors.append(list(_COLOR.unpack_from(data, offset)))
+            offset += _COLOR.size
+        cells = bins ** 3
+        table = data[offset:offset + cells]
+        confidences = data[offset + cells:offset + 2 * cells]
+        spreads = data[offset + 2 * cells:offset + 3 * cells]
+        if len(spreads) != cells:
+            raise ValueError("truncated color lookup table")
+        return cls(names, colors, bins, table, confidences, spreads)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str) -> "ColorLUT":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def load_or_build(cls, path: str, colors: dict, bins: int = BINS) -> "ColorLUT":
+        """Loads the table of path if it was built from these colors, otherwise builds it and
+        saves it to path (if possible)."""
+        if os.path.exists(path):
+            try:
+                lut = cls.load(path)
+                if lut.bins == bins and lut.matches(colors):
+                    return lut
+            except (OSError, ValueError, struct.error):
+                pass
+        lut = cls.build(colors, bins)
+        try:
+            lut.save(path)
+        except OSError:
+            pass
+        return lut
@@ -5,6 +5,7 @@ Changes to the source list result in changes in the filters' results.
 Author: Ryan Au
 """
 
+import bisect
 import math
 import time
 from collections import UserList, deque
@@ -556,6 +557,101 @@ class MedianWindow(WindowedFilter):
         return median(self.data)
 
 
+class AdaptiveThreshold(WindowedFilter):
+    """Threshold between the dark and bright values of a rolling window, eg. the ambient
+    light of a line and of the floor around it, which follows changes of lighting.
+
+    method - "minmax": dark and bright are the low and high quantiles of the window,
+             "kmeans": they are the means of the two clusters of the window (2-means)
+    quantile - fraction of the window below dark (and above bright) with "minmax"
+    refresh - number of appends between two updates of the levels
+    min_samples - number of values needed before the levels are computed
+    min_margin - contrast margin below which the levels are not valid (eg. only the floor was seen)
+
+    >>> f = AdaptiveThreshold(window_size=20, refresh=1, min_samples=4)
+    >>> for value in [2.0, 2.5, 5.0, 5.5] * 5:
+    ...     f.append(value)
+    >>> f.dark, f.bright, f.get_value(), round(f.get_margin(), 2), f.is_valid()
+    (2.0, 5.5, 3.75, 0.47, True)
+    >>> f.get_position(3.75), f.get_position(1.0)
+    (0.0, -1.0)
+    >>> f = AdaptiveThreshold(window_size=20, method="kmeans", refresh=1, min_samples=4)
+    >>> for value in [2.0, 2.5, 5.0, 5.5] * 5:
+    ...     f.append(value)
+    >>> f.dark, f.bright
+    (2.25, 5.25)
+    """
+
+    def __init__(self, window_size=200, method="minmax", quantile=0.02, refresh=10, min_samples=20,
+                 min_margin=0.15, iterations=5):
+        super().__init__(window_size)
+        if method not in ("minmax", "kmeans"):
+            raise ValueError("method must be 'minmax' or 'kmeans'")
+        self.queue = deque(maxlen=1)  # only the current threshold is kept
+        self.method = method
+        self.quantile = quantile
+        self.refresh = refresh
+        self.min_samples = min_samples
+        self.min_margin = min_margin
+        self.iterations = iterations
+        self.dark = None
+        self.bright = None
+        self._appended = 0
+
+    def __appender__(self, in_value, out_value):
+        if in_value is not None:
+            self._appended += 1
+            if self._appended % self.refresh == 0:
+                self.update_levels()
+        if self.dark is None:
+            return None
+        return (self.dark + self.bright) / 2
+
+    def update_levels(self):
+        """Computes the dark and bright levels of the current window."""
+        values = sorted(self.get_inner_list())
+        n = len(values)
+        if n < self.min_samples:
+            return
+        if self.method == "minmax":
+            self.dark = values[int(self.quantile * (n - 1))]
+            self.bright = values[int((1 - self.quantile) * (n - 1))]
+            return
+
+        # 2-means, from the previous levels: split at the midpoint, then move each level
+        # to the mean of its side, until the split does not change
+        dark = values[0] if self.dark is None else self.dark
+        bright = values[-1] if self.bright is None else self.bright
+        split = None
+        for i in range(self.iterations):
+            new_split = bisect.bisect_left(values, (dark + bright) / 2)
+            if new_split in (0, n) or new_split == split:
+                break
+            split = new_split
+            dark = mean(values[:split])
+            bright = mean(values[split:])
+        self.dark, self.bright = dark, bright
+
+    def get_margin(self):
+        """Returns the contrast (bright - dark) / (bright + dark) of the levels, None before
+        there are levels. It is 0 without contrast, and does not depend on the brightness."""
+        if self.dark is None or self.dark + self.bright <= 0:
+            return None
+        return (self.bright - self.dark) / (self.bright + self.dark)
+
+    def is_valid(self):
+        """Returns True if the levels can be used: both the dark and the bright were seen."""
+        margin = self.get_margin()
+        return margin is not None and margin >= self.min_margin and self.dark > 0
+
+    def get_position(self, value):
+        """Returns where value is between the levels: -1.0 at dark, 1.0 at bright and 0.0 at
+        the threshold, clipped to that range. None before there are levels."""
+        if self.dark is None or self.bright == self.dark:
+            return None
+        return range_limit(2 * (value - self.dark) / (self.bright - self.dark) - 1, -1.0, 1.0)
+
+
 class IntegrationTracker(WindowedFilter):
     def __init__(self, default_dx=1):
         super().__init__(window_size=1)
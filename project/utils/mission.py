@@ -0,0 +1,219 @@
+"""
+Module for describing a mission as a graph of waypoints, and executing it.
+
+A mission file (JSON) lists waypoints (nodes) and the actions that drive the robot
+from one waypoint to another (edges). Some nodes are rooms, which are visited with
+their own actions. The executor repeatedly picks the closest room that can still
+yield a delivery, drives there along the cheapest path, and goes to the goal once
+every delivery is done or no room is left.
+
+Mission file format:
+
+    {
+      "start": "start",
+      "goal": "mail_room",
+      "deliveries": 2,
+      "nodes": {
+        "start": {},
+        "office_1": {"room": true, "actions": [{"do": "check_room"}]},
+        "mail_room": {"actions": [{"do": "play_victory_sound"}]}
+      },
+      "edges": [
+        {"from": "start", "to": "office_1", "cost": 8,
+         "actions": [{"do": "follow_line", "args": [75.5]}, {"do": "turn", "args": [-90]}]}
+      ]
+    }
+
+An action with "background": true is started in a separate thread and the next
+action starts immediately, eg. to play a sound while driving. Background actions
+must not use the motors.
+"""
+
+from typing import Callable, Dict, List, Optional
+import heapq
+import json
+import threading
+import time
+
+
+class MissionError(Exception):
+    """Raised when a mission file is invalid, or an action is not registered."""
+
+
+class Action:
+    def __init__(self, name: str, args=(), background: bool = False):
+        self.name = name
+        self.args = list(args)
+        self.background = background
+
+    @staticmethod
+    def from_dict(data: dict):
+        if "do" not in data:
+            raise MissionError(f"action without 'do': {data}")
+        return Action(data["do"], data.get("args", ()), data.get("background", False))
+
+    def __repr__(self):
+        return f"{self.name}({', '.join(map(repr, self.args))})"
+
+
+class Edge:
+    def __init__(self, start: str, end: str, cost: float, actions: List[Action]):
+        self.start = start
+        self.end = end
+        self.cost = cost
+        self.actions = actions
+
+
+class Mission:
+    """A graph of waypoints (nodes) linked by directed edges of actions."""
+
+    def __init__(self, start: str, goal: str, deliveries: int, nodes: Dict[str, dict], edges: List[Edge]):
+        self.start = start
+        self.goal = goal
+        self.deliveries = deliveries
+        self.rooms = [name for name, node in nodes.items() if node.get("room", False)]
+        self.node_actions = {name: [Action.from_dict(a) for a in node.get("actions", ())]
+                             for name, node in nodes.items()}
+        self.edges: Dict[str, List[Edge]] = {name: [] for name in nodes}
+        for edge in edges:
+            if edge.start not in nodes or edge.end not in nodes:
+                raise MissionError(
+                    f"edge {edge.start} -> {edge.end} uses an unknown node")
+            self.edges[edge.start].append(edge)
+        if start not in nodes or goal not in nodes:
+            raise MissionError("start and goal must be nodes of the mission")
+
+    @staticmethod
+    def load(path: str):
+        "Reads a Mission from a JSON file."
+        with open(path, "r") as f:
+            data = json.load(f)
+        try:
+            edges = [Edge(e["from"], e["to"], float(e.get("cost", 1)),
+                          [Action.from_dict(a) for a in e.get("actions", ())])
+                     for e in data["edges"]]
+            return Mission(data["start"], data["goal"], int(data.get("deliveries", 0)),
+                           data["nodes"], edges)
+        except KeyError as err:
+            raise MissionError(f"missing key in mission file: {err}")
+
+    def shortest_paths(self, source: str):
+        """Dijkstra from source. Returns ({node: cost}, {node: edge used to reach it})."""
+        costs = {source: 0.0}
+        previous: Dict[str, Edge] = {}
+        queue = [(0.0, source)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if cost > costs[node]:
+                continue
+            for edge in self.edges[node]:
+                new_cost = cost + edge.cost
+                if new_cost < costs.get(edge.end, float("inf")):
+                    costs[edge.end] = new_cost
+                    previous[edge.end] = edge
+                    heapq.heappush(queue, (new_cost, edge.end))
+        return costs, previous
+
+    def path(self, source: str, target: str) -> Optional[List[Edge]]:
+        "Returns the cheapest list of edges from source to target, or None if unreachable."
+        costs, previous = self.shortest_paths(source)
+        if target not in costs:
+            return None
+        edges = []
+        while target != source:
+            edge = previous[target]
+            edges.append(edge)
+            target = edge.start
+        return edges[::-1]
+
+
+class MissionExecutor:
+    """Runs a Mission with the given actions.
+
+    actions - maps action names of the mission file to functions
+    delivered - returns the number of deliveries done so far
+    settle - called between two motion actions, eg. to wait for the robot to stop
+    log - called with a line of text after every step, eg. print
+    on_step - called with the label of every step before it starts
+    """
+
+    def __init__(self, mission: Mission, actions: Dict[str, Callable], delivered: Callable[[], int],
+                 settle: Callable[[], None] = None, log: Callable[[str], None] = None,
+                 on_step: Callable[[str], None] = None):
+        self.mission = mission
+        self.actions = actions
+        self.delivered = delivered
+        self.settle = settle
+        self.log = log
+        self.on_step = on_step
+        self.visited = set()
+        self.node = mission.start
+        self.timings = []  # (step label, seconds)
+        self._background: List[threading.Thread] = []
+
+        for action in self._all_actions():
+            if action.name not in actions:
+                raise MissionError(f"action '{action.name}' is not registered")
+
+    def _all_actions(self):
+        for actions in self.mission.node_actions.values():
+            yield from actions
+        for edges in self.mission.edges.values():
+            for edge in edges:
+                yield from edge.actions
+
+    def _run_actions(self, label: str, actions: List[Action]):
+        for action in actions:
+            func = self.actions[action.name]
+            if self.on_step is not None:
+                self.on_step(f"{label}: {action}")
+            if action.background:
+                thread = threading.Thread(
+                    target=func, args=action.args, name=f"{label}: {action}", daemon=True)
+                thread.start()
+                self._background.append(thread)
+                continue
+            start = time.monotonic()
+            func(*action.args)
+            if self.settle is not None:
+                self.settle()
+            self._record(f"{label}: {action}", time.monotonic() - start)
+
+    def _record(self, label: str, seconds: float):
+        self.timings.append((label, seconds))
+        if self.log is not None:
+            self.log(f"[{seconds:6.2f}s] {label}")
+
+    def next_target(self) -> str:
+        """Returns the closest unvisited room if deliveries remain, or else the goal."""
+        if self.delivered() >= self.mission.deliveries:
+            return self.mission.goal
+        costs, _ = self.mission.shortest_paths(self.node)
+        rooms = [room for room in self.mission.rooms
+                 if room not in self.visited and room in costs]
+        if not rooms:
+            return self.mission.goal
+        return min(rooms, key=lambda room: costs[room])
+
+    def run(self):
+        """Drives to every useful room then to the goal. Returns the total seconds spent."""
+        mission_start = time.monotonic()
+        while True:
+            target = self.next_target()
+            path = self.mission.path(self.node, target)
+            if path is None:
+                raise MissionError(f"no path from {self.node} to {target}")
+            for edge in path:
+                self._run_actions(f"{edge.start} -> {edge.end}", edge.actions)
+                self.node = edge.end
+            if target != self.mission.goal:
+                self.visited.add(target)
+            self._run_actions(target, self.mission.node_actions[target])
+            if target == self.mission.goal:
+                break
+
+        for thread in self._background:
+            thread.join()
+        total = time.monotonic() - mission_start
+        self._record("mission", total)
+        return total
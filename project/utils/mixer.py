@@ -0,0 +1,292 @@
+"""
+Module for playing many Sounds through one continuously open audio stream.
+
+Sound.play() starts a new playback object for every sound, which takes a long
+time to start. A Mixer instead keeps a single output stream open, and mixes every
+playing Sound (a voice) into small blocks that are written just ahead of the
+speaker, so that a note starts playing a few tens of milliseconds after note_on.
+
+Example Usage:
+
+    from utils.mixer import get_mixer
+    from utils.sound import Sound
+
+    note = Sound(duration=0.5, pitch="C5", volume=85)
+    mixer = get_mixer()
+    voice = mixer.note_on(note)  # returns immediately
+    ...
+    mixer.note_off(voice)  # optional, the voice ends by itself with the Sound
+"""
+
+from typing import Dict, Optional
+import array
+import atexit
+import itertools
+import shutil
+import subprocess
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, blocks are then mixed in pure Python
+    np = None
+
+
+class _AplayStream:
+    """Raw mono int16 output stream, written to the standard input of ALSA's aplay."""
+
+    def __init__(self, fs: int, buffer_time: float, period_time: float):
+        path = shutil.which("aplay")
+        if path is None:
+            raise OSError("aplay was not found, cannot open an audio stream")
+        self.process = subprocess.Popen(
+            [path, "-q", "-t", "raw", "-f", "S16_LE", "-c", "1", "-r", str(int(fs)),
+             f"--buffer-time={int(buffer_time * 1e6)}", f"--period-time={int(period_time * 1e6)}"],
+            stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+    def write(self, data: bytes):
+        self.process.stdin.write(data)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.terminate()
+        self.process.wait()
+
+
+class _Voice:
+    """A Sound being played by the Mixer."""
+
+    def __init__(self, audio, gain: float, loop: bool, start_frame: int):
+        self.audio = audio
+        self.gain = gain
+        self.loop = loop
+        self.start_frame = start_frame  # stream frame where the voice begins
+        self.pos = 0
+        self.release = None  # [frames left, total frames] once note_off was called
+
+
+class Mixer:
+    """Mixes any number of Sounds into one output stream, in real time.
+
+    fs - Sample rate of the stream. Every Sound played must use the same rate.
+    block_time - Seconds of audio mixed at once.
+    lead_time - Seconds of audio written ahead of the speaker. Lower values
+        reduce latency, but the stream may stutter if the mixer thread is late.
+    buffer_time - Seconds of audio buffered by the audio device.
+    max_voices - Polyphony. The oldest voice is stopped when it is exceeded.
+    """
+
+    def __init__(self, fs=8000, block_time=0.005, lead_time=0.015, buffer_time=0.02, max_voices=8, stream=None):
+        self.fs = int(fs)
+        self.block_frames = max(1, int(block_time * fs))
+        self.lead_frames = max(self.block_frames, int(lead_time * fs))
+        self.buffer_time = buffer_time
+        self.max_voices = max_voices
+        self.frame = 0  # stream frame of the next block, written or skipped when late
+
+        self._stream = stream
+        self._voices: Dict[int, _Voice] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def latency(self) -> float:
+        "Expected seconds between note_on and the note being heard."
+        return (self.lead_frames + self.block_frames) / self.fs + self.buffer_time
+
+    def start(self):
+        "Opens the output stream and starts mixing in a background thread."
+        if self.is_running():
+            return self
+        if self._stream is None:
+            self._stream = _AplayStream(
+                self.fs, self.buffer_time, self.block_frames / self.fs)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stops all voices and closes the output stream."
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        with self._lock:
+            self._voices.clear()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def note_on(self, sound, volume: float = 1.0, loop: bool = False, at_frame: Optional[int] = None) -> int:
+        """Starts playing a Sound (or an int16 buffer) and returns its voice id.
+
+        volume - gain applied to the Sound, from 0 to 1.
+        loop - if True, the Sound repeats until note_off is called.
+        at_frame - stream frame (see Mixer.frame) where the Sound starts, for
+            sample-accurate scheduling. Starts as soon as possible if None or past.
+        """
+        audio = getattr(sound, "audio", sound)
+        fs = getattr(sound, "_fs", self.fs)
+        if fs != self.fs:
+            raise ValueError(
+                f"Sound sample rate ({fs}) does not match the mixer ({self.fs})")
+        voice = _Voice(audio, volume, loop,
+                       self.frame if at_frame is None else int(at_frame))
+        with self._lock:
+            while len(self._voices) >= self.max_voices:
+                del self._voices[next(iter(self._voices))]  # oldest voice
+            voice_id = next(self._ids)
+            self._voices[voice_id] = voice
+        return voice_id
+
+    def note_off(self, voice_id: int, release: float = 0.01):
+        """Stops a voice, fading it out over release seconds to avoid pops."""
+        with self._lock:
+            self._release(voice_id, release)
+
+    def all_notes_off(self, release: float = 0.01):
+        with self._lock:
+            for voice_id in list(self._voices):
+                self._release(voice_id, release)
+
+    def _release(self, voice_id: int, release: float):
+        "Starts the fade out of a voice. Must be called with the lock held."
+        voice = self._voices.get(voice_id)
+        if voice is None:
+            return
+        frames = int(release * self.fs)
+        if frames <= 0:
+            del self._voices[voice_id]
+        elif voice.release is None:
+            voice.release = [frames, frames]
+
+    def is_playing(self, voice_id: Optional[int] = None) -> bool:
+        "Returns True if the given voice, or any voice if None, is playing."
+        with self._lock:
+            if voice_id is None:
+                return len(self._voices) > 0
+            return voice_id in self._voices
+
+    def _take(self, voice: _Voice, n: int) -> list:
+        """Returns up to n next samples of a voice, wrapping around if it loops."""
+        out = voice.audio[voice.pos:voice.pos+n]
+        voice.pos += len(out)
+        while voice.loop and len(out) < n and len(voice.audio) > 0:
+            voice.pos = 0
+            more = voice.audio[:n-len(out)]
+            voice.pos = len(more)
+            out += more
+        return out
+
+    def _mix_block(self, n: int) -> bytes:
+        "Mixes the next n frames of every voice, and removes finished voices."
+        with self._lock:
+            voices = list(self._voices.items())
+        if np is not None:
+            acc = np.zeros(n, dtype=np.float64)
+        else:
+            acc = [0.0] * n
+
+        for voice_id, voice in voices:
+            offset = max(0, voice.start_frame - self.frame)
+            if offset >= n:
+                continue  # scheduled for a later block
+            samples = self._take(voice, n - offset)
+            count = len(samples)
+            if np is not None:
+                chunk = np.frombuffer(samples, dtype=np.int16) * voice.gain
+                if voice.release is not None:
+                    left, total = voice.release
+                    chunk *= np.clip((left - np.arange(count)) / total, 0, 1)
+                acc[offset:offset+count] += chunk
+            else:
+                gain = voice.gain
+                if voice.release is None:
+                    for i in range(count):
+                        acc[offset+i] += samples[i] * gain
+                else:
+                    left, total = voice.release
+                    for i in range(count):
+                        acc[offset+i] += samples[i] * gain * max(left - i, 0) / total
+            if voice.release is not None:
+                voice.release[0] -= n
+            if count < n - offset or (voice.release is not None and voice.release[0] <= 0) or \
+                    (not voice.loop and voice.pos >= len(voice.audio)):
+                with self._lock:
+                    if self._voices.get(voice_id) is voice:
+                        del self._voices[voice_id]
+
+        if np is not None:
+            return np.clip(acc, -32768, 32767).astype(np.int16).tobytes()
+        return array.array('h', [min(max(int(y), -32768), 32767) for y in acc]).tobytes()
+
+    def _skip(self, n: int):
+        "Advances every voice by n frames without mixing them, and removes finished voices."
+        with self._lock:
+            voices = list(self._voices.items())
+        for voice_id, voice in voices:
+            offset = max(0, voice.start_frame - self.frame)
+            if offset >= n:
+                continue
+            if voice.loop and len(voice.audio) > 0:
+                voice.pos = (voice.pos + n - offset) % len(voice.audio)
+            else:
+                voice.pos = min(voice.pos + n - offset, len(voice.audio))
+            if voice.release is not None:
+                voice.release[0] -= n
+            if (voice.release is not None and voice.release[0] <= 0) or \
+                    (not voice.loop and voice.pos >= len(voice.audio)):
+                with self._lock:
+                    if self._voices.get(voice_id) is voice:
+                        del self._voices[voice_id]
+        self.frame += n
+
+    def _run(self):
+        """Mixer thread: keeps the stream lead_frames ahead of the monotonic clock.
+
+        After a late wakeup, the frames that should already have been played are skipped
+        instead of written, so that the pipe never holds more than the lead."""
+        start = time.monotonic()
+        start_frame = self.frame
+        while not self._stop_event.is_set():
+            now = start_frame + int((time.monotonic() - start) * self.fs)
+            due = now + self.lead_frames
+            if self.frame >= due:
+                time.sleep((self.frame - due + 1) / self.fs)
+                continue
+            if self.frame + self.block_frames < now:
+                self._skip(now - self.frame)
+            try:
+                self._stream.write(self._mix_block(self.block_frames))
+            except (OSError, ValueError):
+                break  # the stream was closed
+            self.frame += self.block_frames
+
+
+_MIXER = None
+
+
+def get_mixer(fs=8000) -> Mixer:
+    """Returns the shared Mixer of this program, starting it on first use.
+    It is stopped automatically when the program exits. Raises ValueError if it was
+    started at another sample rate.
+    """
+    global _MIXER
+    if _MIXER is None:
+        _MIXER = Mixer(fs=fs).start()
+        atexit.register(_MIXER.stop)
+    elif _MIXER.fs != int(fs):
+        raise ValueError(
+            f"Mixer sample rate ({_MIXER.fs}) does not match the requested one ({int(fs)})")
+    return _MIXER
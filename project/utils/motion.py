@@ -0,0 +1,192 @@
+"""
+Module for smooth, synchronized motor moves using velocity profiles.
+
+Commanding each motor with set_position_relative makes every motor accelerate as
+hard as it can, and start and finish at slightly different times. Here, a profile
+gives the position and velocity of a move at any time, with a bounded acceleration.
+SyncMove plays one profile on several motors at once, scaled to each motor's
+distance, so that they all start and finish together.
+
+Example Usage:
+
+    move = SyncMove([LEFT_MOTOR, RIGHT_MOTOR], [720, -720], max_velocity=400, max_acceleration=1500)
+    move.run()  # blocks until both motors reached their targets
+"""
+
+from typing import Callable, List, Sequence, Tuple
+import math
+
+from .scheduler import Scheduler
+
+START_READS = 3  # attempts to read the start encoder of each motor before giving up
+
+
+class TrapezoidalProfile:
+    """Moves a distance with a constant acceleration, a cruise at max_velocity,
+    then a constant deceleration. If the distance is too short to reach max_velocity,
+    the cruise is skipped (triangular profile).
+
+    >>> p = TrapezoidalProfile(100, max_velocity=50, max_acceleration=100)
+    >>> p.duration
+    2.5
+    >>> p.sample(0.5), p.sample(1.25), p.sample(2.5)
+    ((12.5, 50.0), (50.0, 50.0), (100.0, 0.0))
+    """
+    # accel time = SHAPE * velocity / max_acceleration
+    SHAPE = 1.0
+
+    def __init__(self, distance: float, max_velocity: float, max_acceleration: float):
+        if max_velocity <= 0 or max_acceleration <= 0:
+            raise ValueError("max_velocity and max_acceleration must be positive")
+        self.distance = distance
+        self.direction = 1 if distance >= 0 else -1
+        length = abs(distance)
+
+        velocity = float(max_velocity)
+        if self.SHAPE * velocity ** 2 / max_acceleration > length:
+            velocity = math.sqrt(length * max_acceleration / self.SHAPE)
+        self.velocity = velocity
+        self.t_accel = self.SHAPE * velocity / max_acceleration if velocity > 0 else 0.0
+        self.d_accel = velocity * self.t_accel / 2
+        self.t_cruise = (length - 2 * self.d_accel) / velocity if velocity > 0 else 0.0
+        self.duration = 2 * self.t_accel + self.t_cruise
+
+    def _ramp(self, t: float) -> Tuple[float, float]:
+        "(position, velocity) at t seconds into the acceleration phase."
+        a = self.velocity / self.t_accel
+        return a * t * t / 2, a * t
+
+    def sample(self, t: float) -> Tuple[float, float]:
+        "Returns (position, velocity) at t seconds after the start of the move."
+        if t <= 0 or self.duration == 0:
+            return 0.0, 0.0
+        if t >= self.duration:
+            return float(self.distance), 0.0
+        if t < self.t_accel:
+            pos, vel = self._ramp(t)
+        elif t <= self.t_accel + self.t_cruise:
+            pos, vel = self.d_accel + self.velocity * (t - self.t_accel), self.velocity
+        else:
+            pos, vel = self._ramp(self.duration - t)
+            pos = abs(self.distance) - pos
+        return self.direction * pos, self.direction * vel
+
+
+class SCurveProfile(TrapezoidalProfile):
+    """Like TrapezoidalProfile, but the acceleration rises and falls smoothly
+    (raised cosine), which avoids jerks at the start and end of each phase.
+    The peak acceleration still respects max_acceleration.
+
+    >>> p = SCurveProfile(100, max_velocity=50, max_acceleration=100)
+    >>> round(p.duration, 3)
+    2.785
+    >>> p.sample(p.duration)
+    (100.0, 0.0)
+    """
+    SHAPE = math.pi / 2
+
+    def _ramp(self, t: float) -> Tuple[float, float]:
+        w = math.pi / self.t_accel
+        vel = self.velocity * (1 - math.cos(w * t)) / 2
+        pos = self.velocity * (t - math.sin(w * t) / w) / 2
+        return pos, vel
+
+
+class SyncMove:
+    """Moves several motors by given relative distances (encoder degrees), following
+    the same profile timing so that they start and finish together.
+
+    The motor with the longest distance moves at max_velocity, the others are scaled
+    down. Every tick, each motor is commanded a speed equal to the profile velocity
+    plus kp times its position error.
+
+    motors - Motor objects
+    distances - relative encoder degrees for each motor
+    max_velocity - dps limit of the longest move
+    max_acceleration - degrees per second squared limit of the longest move
+    profile - TrapezoidalProfile or SCurveProfile
+    rate - control loop frequency in Hz
+    tolerance - encoder degrees of error accepted at the end of the move
+    settle_timeout - extra seconds allowed after the profile ends to reach tolerance
+    """
+
+    def __init__(self, motors: Sequence, distances: Sequence[float], max_velocity: float,
+                 max_acceleration: float, profile=SCurveProfile, rate: float = 100, kp: float = 4.0,
+                 tolerance: float = 3.0, settle_timeout: float = 0.5):
+        if len(motors) != len(distances):
+            raise ValueError("motors and distances must have the same length")
+        self.motors = list(motors)
+        self.distances = [float(d) for d in distances]
+        longest = max((abs(d) for d in self.distances), default=0.0)
+        self.profile = profile(longest, max_velocity, max_acceleration)
+        self.ratios = [d / longest if longest else 0.0 for d in self.distances]
+        self.rate = rate
+        self.kp = kp
+        self.tolerance = tolerance
+        self.settle_timeout = settle_timeout
+
+        self.starts: List[float] = []
+        self.errors: List[float] = [0.0] * len(self.motors)
+        self.reached = False
+
+    def _tick(self, t: float) -> bool:
+        "Commands every motor for time t. Returns True once all motors are within tolerance."
+        pos, vel = self.profile.sample(t)
+        done = t >= self.profile.duration
+        for i, motor in enumerate(self.motors):
+            encoder = motor.get_encoder()
+            if encoder is None:
+                done = False
+                continue
+            target = self.starts[i] + self.ratios[i] * pos
+            self.errors[i] = target - encoder
+            if abs(self.errors[i]) > self.tolerance:
+                done = False
+            motor.set_dps(self.ratios[i] * vel + self.kp * self.errors[i])
+        return done
+
+    def _read_starts(self) -> List[float]:
+        "Returns the encoder of every motor, retrying failed reads. Raises OSError if one keeps failing."
+        starts = []
+        for motor in self.motors:
+            for _ in range(START_READS):
+                encoder = motor.get_encoder()
+                if encoder is not None:
+                    break
+            else:
+                raise OSError(f"could not read the encoder of motor {motor.port}")
+            starts.append(encoder)
+        return starts
+
+    def run(self, tasks: Sequence[Tuple[Callable[[], None], float]] = ()) -> bool:
+        """Runs the move, blocking until every motor is within tolerance of its target,
+        or the settle timeout expired. Motors are stopped at the end.
+
+        tasks - extra (func, rate) pairs run by the same scheduler during the move,
+                eg. to sample a sensor while turning
+
+        Returns True if every motor reached its target. Raises OSError before moving if
+        the encoder of a motor cannot be read.
+        """
+        scheduler = Scheduler()
+        self.starts = self._read_starts()
+        start = scheduler.clock()
+        deadline = self.profile.duration + self.settle_timeout
+
+        def control() -> None:
+            t = scheduler.clock() - start
+            if self._tick(t):
+                self.reached = True
+                scheduler.stop()
+            elif t >= deadline:
+                scheduler.stop()
+
+        scheduler.add_task(control, self.rate)
+        for func, rate in tasks:
+            scheduler.add_task(func, rate)
+        try:
+            scheduler.run()
+        finally:
+            for motor in self.motors:
+                motor.set_dps(0)
+        return self.reached
@@ -0,0 +1,167 @@
+"""
+Module for tracking the pose (x, y, heading) of a two-wheeled robot from its wheel encoders.
+
+An Odometry object reads both drive motor encoders in a background thread, and
+integrates the wheel displacements into a pose with a covariance estimate. Reading
+the pose is then free: it does not talk to the brick.
+
+Conventions: x and y are in the unit of wheel_diameter (eg. cm), the robot starts
+at (0, 0) facing the +x axis, and heading is in degrees, counterclockwise positive
+(a left turn increases the heading).
+"""
+
+from typing import List, Tuple
+import math
+import threading
+import time
+
+
+def _mat_mul(a: List[List[float]], b: List[List[float]]) -> List[List[float]]:
+    """Multiplies two matrices given as lists of rows.
+
+    >>> _mat_mul([[1, 2], [3, 4]], [[0, 1], [1, 0]])
+    [[2, 1], [4, 3]]
+    """
+    return [[sum(a[i][k] * b[k][j] for k in range(len(b))) for j in range(len(b[0]))]
+            for i in range(len(a))]
+
+
+def _transpose(a: List[List[float]]) -> List[List[float]]:
+    return [list(row) for row in zip(*a)]
+
+
+def wrap_degrees(angle: float) -> float:
+    """Wraps an angle in degrees to the range [-180, 180).
+
+    >>> wrap_degrees(270)
+    -90.0
+    >>> wrap_degrees(-190)
+    170.0
+    """
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+class Odometry:
+    """Differential-drive odometry from two Motor encoders.
+
+    left, right - the drive Motors, positive encoder degrees moving the robot forward
+    wheel_diameter - diameter of the wheels
+    track_width - distance between the two wheels, in the same unit
+    rate - encoder reads per second of the background thread
+    k_wheel - variance of a wheel displacement per unit travelled, used for the covariance
+    """
+
+    def __init__(self, left, right, wheel_diameter: float, track_width: float, rate: float = 100, k_wheel: float = 0.01):
+        self.left = left
+        self.right = right
+        self.distance_per_degree = math.pi * wheel_diameter / 360
+        self.track_width = track_width
+        self.rate = rate
+        self.k_wheel = k_wheel
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._last = None  # last (left, right) encoder readings
+        self.reset()
+
+    def reset(self, x: float = 0.0, y: float = 0.0, heading: float = 0.0):
+        """Sets the current pose, with no uncertainty. The next encoder read becomes the reference."""
+        with self._lock:
+            self._x = x
+            self._y = y
+            self._theta = math.radians(heading)
+            self._cov = [[0.0] * 3 for i in range(3)]
+            self._last = None
+            self._time = time.monotonic()
+
+    def start(self):
+        "Starts integrating the encoders in a background thread."
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="odometry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        period = 1 / self.rate
+        next_tick = time.monotonic()
+        while not self._stop_event.is_set():
+            self.update()
+            next_tick += period
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+    def update(self):
+        """Reads both encoders once and integrates the displacement since the last read."""
+        left, right = self.left.get_encoder(), self.right.get_encoder()
+        if left is None or right is None:
+            return
+        with self._lock:
+            if self._last is None:
+                self._last = (left, right)
+                return
+            dl = (left - self._last[0]) * self.distance_per_degree
+            dr = (right - self._last[1]) * self.distance_per_degree
+            self._last = (left, right)
+            self._integrate(dl, dr)
+            self._time = time.monotonic()
+
+    def _integrate(self, dl: float, dr: float):
+        "Midpoint integration of a wheel displacement, and propagation of the covariance."
+        b = self.track_width
+        ds = (dr + dl) / 2
+        dtheta = (dr - dl) / b
+        mid = self._theta + dtheta / 2
+        cos_mid, sin_mid = math.cos(mid), math.sin(mid)
+
+        self._x += ds * cos_mid
+        self._y += ds * sin_mid
+        self._theta += dtheta
+
+        # Jacobians of the pose with regards to the previous pose and to (dr, dl)
+        fx = [[1, 0, -ds * sin_mid],
+              [0, 1, ds * cos_mid],
+              [0, 0, 1]]
+        fu = [[cos_mid / 2 - ds * sin_mid / (2 * b), cos_mid / 2 + ds * sin_mid / (2 * b)],
+              [sin_mid / 2 + ds * cos_mid / (2 * b), sin_mid / 2 - ds * cos_mid / (2 * b)],
+              [1 / b, -1 / b]]
+        q = [[self.k_wheel * abs(dr), 0], [0, self.k_wheel * abs(dl)]]
+        a = _mat_mul(_mat_mul(fx, self._cov), _transpose(fx))
+        c = _mat_mul(_mat_mul(fu, q), _transpose(fu))
+        self._cov = [[a[i][j] + c[i][j] for j in range(3)] for i in range(3)]
+
+    def get_pose(self) -> Tuple[float, float, float]:
+        "Returns the last (x, y, heading in degrees), without reading the encoders."
+        with self._lock:
+            return self._x, self._y, math.degrees(self._theta)
+
+    def get_heading(self) -> float:
+        return self.get_pose()[2]
+
+    def get_covariance(self) -> List[List[float]]:
+        "Returns the 3x3 covariance of (x, y, heading in radians)."
+        with self._lock:
+            return [row[:] for row in self._cov]
+
+    def get_age(self) -> float:
+        "Returns the seconds since the pose was last updated."
+        with self._lock:
+            return time.monotonic() - self._time
+
+    def distance_to(self, pose: Tuple[float, float, float]) -> float:
+        """Returns the signed distance to travel along the current heading to
+        reach the point of pose (negative if it is behind the robot)."""
+        x, y, heading = self.get_pose()
+        theta = math.radians(heading)
+        return (pose[0] - x) * math.cos(theta) + (pose[1] - y) * math.sin(theta)
+
+    def heading_error(self, heading: float) -> float:
+        "Returns the degrees to turn counterclockwise to face the given heading."
+        return wrap_degrees(heading - self.get_heading())
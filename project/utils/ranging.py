@@ -0,0 +1,125 @@
+"""
+Module for tracking the distance to an obstacle from noisy ultrasonic readings.
+
+The EV3 ultrasonic sensor sometimes returns 255 (no echo) or a single reading far
+from the others. A RangeTracker timestamps every reading, drops the invalid ones,
+takes the median of the last few, rejects the medians too far from its prediction,
+and smooths the rest with an alpha-beta filter, which also estimates the closing
+velocity. It can then predict when a given distance will be reached.
+
+Example Usage:
+
+    tracker = ULTRASONIC_SENSOR.get_tracker()
+    while True:
+        tracker.update()
+        if tracker.predict(0.1) <= 10:  # will be within 10 cm in 100 ms
+            break
+"""
+
+from collections import deque
+from statistics import median
+from typing import Callable, Optional
+import time
+
+
+class RangeTracker:
+    """Alpha-beta tracker of the distance given by read().
+
+    read - returns a distance, or None if the sensor could not be read
+    window - number of valid readings in the median
+    gate - largest distance between the median and the prediction that is accepted
+    max_range - readings at or above this are dropouts (the sensor returns 255 without echo)
+    alpha, beta - gains of the distance and velocity corrections
+    max_rejects - consecutive rejected medians after which the tracker restarts from the median,
+                  in case the obstacle really changed (eg. after a turn)
+
+    >>> readings = iter([100, 98, 255, 96, 20, 94, 92])
+    >>> clock = iter(i / 10 for i in range(7))
+    >>> tracker = RangeTracker(lambda: next(readings), window=1, clock=lambda: next(clock))
+    >>> [round(tracker.update(), 1) for i in range(7)]
+    [100.0, 98.8, 98.8, 96.8, 96.8, 94.6, 92.8]
+    >>> tracker.dropouts, tracker.outliers
+    (1, 1)
+    >>> round(tracker.velocity, 1), round(tracker.time_to(50), 1)
+    (-11.4, 3.8)
+    """
+
+    def __init__(self, read: Callable[[], Optional[float]], window: int = 3, gate: float = 15.0,
+                 max_range: float = 255, alpha: float = 0.6, beta: float = 0.2, max_rejects: int = 5,
+                 clock: Callable[[], float] = time.monotonic):
+        self.read = read
+        self.window = deque(maxlen=window)
+        self.gate = gate
+        self.max_range = max_range
+        self.alpha = alpha
+        self.beta = beta
+        self.max_rejects = max_rejects
+        self.clock = clock
+
+        self.distance = None  # filtered distance
+        self.velocity = 0.0  # distance per second, negative when closing in
+        self.timestamp = None  # clock() of the last accepted reading
+        self.dropouts = 0
+        self.outliers = 0
+        self._rejects = 0
+
+    def reset(self):
+        self.window.clear()
+        self.distance = None
+        self.velocity = 0.0
+        self.timestamp = None
+        self._rejects = 0
+
+    def update(self) -> Optional[float]:
+        """Reads the sensor once and returns the filtered distance (None until a valid reading)."""
+        value = self.read()
+        now = self.clock()
+        if value is None or value >= self.max_range:
+            self.dropouts += 1
+            return self.distance
+
+        self.window.append(value)
+        measure = float(median(self.window))
+        if self.distance is None:
+            self.distance = measure
+            self.timestamp = now
+            return self.distance
+
+        dt = now - self.timestamp
+        predicted = self.distance + self.velocity * dt
+        residual = measure - predicted
+        if abs(residual) > self.gate:
+            self.outliers += 1
+            self._rejects += 1
+            if self._rejects >= self.max_rejects:
+                self.reset()
+                self.window.append(value)
+                self.distance = measure
+                self.timestamp = now
+            return self.distance
+
+        self._rejects = 0
+        self.distance = predicted + self.alpha * residual
+        if dt > 0:
+            self.velocity += self.beta * residual / dt
+        self.timestamp = now
+        return self.distance
+
+    def get_age(self) -> float:
+        "Returns the seconds since the last accepted reading."
+        if self.timestamp is None:
+            return float("inf")
+        return self.clock() - self.timestamp
+
+    def predict(self, seconds: float = 0.0) -> Optional[float]:
+        """Returns the distance expected seconds from now, at the current velocity."""
+        if self.distance is None:
+            return None
+        return self.distance + self.velocity * (self.get_age() + seconds)
+
+    def time_to(self, target: float) -> float:
+        """Returns the seconds from the last reading until the distance is down to target,
+        0 if it already is, or inf if not getting closer."""
+        if self.distance is None or self.distance > target and self.velocity >= 0:
+            return float("inf")
+        return max(0.0, (target - self.distance) / self.velocity) if self.distance > target else 0.0
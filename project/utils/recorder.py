@@ -0,0 +1,238 @@
+"""
+Module for recording every sensor read and motor command of a run into a binary file.
+
+Each event is a fixed-size record: a time.monotonic() timestamp, the kind of event,
+the port of the device (as in BrickPi3.PORT_4, not 4), the thread that made it (see
+caller_id) and up to 4 values. Recording only packs the record and appends it to
+a queue, a background thread writes the queue to the file every FLUSH_INTERVAL, so
+that a 100 Hz control loop is not slowed down by the SD card. The file is append-only:
+recording to an existing file adds a new run after the previous ones.
+
+A RecordReader maps a recording into memory and reads its records without loading
+the whole file, even while it is being recorded.
+
+Example Usage:
+
+    from utils import brick
+    from utils.recorder import Recorder, RecordReader, SENSOR_VALUE
+
+    recorder = brick.set_recorder(Recorder("~/run.rec"))
+    ...  # every sensor read and motor command is recorded
+    brick.set_recorder(None).close()
+
+    with RecordReader("~/run.rec") as reader:
+        for record in reader.records(kind=SENSOR_VALUE, port=COLOR_SENSOR.port):
+            print(record.timestamp, record.value)
+"""
+
+from collections import deque
+from math import isnan, nan
+from typing import Iterator, NamedTuple
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b"DPMREC02"  # start of every recording, followed by the records
+FLUSH_INTERVAL = 0.5  # seconds between two writes of the queued records
+
+# timestamp, kind, port, flags (number of values and FLAG_*), caller, 4 values
+RECORD = struct.Struct("<dBBHH4f")
+MAX_VALUES = 4
+FLAG_NONE = 0x100  # the value was None
+FLAG_SCALAR = 0x200  # the value was a single number, not a list
+FLAG_INT = 0x400  # the values were integers (or booleans)
+
+# Kinds of records. Reads are below 10, commands from 10.
+SENSOR_VALUE = 1  # Sensor.get_value()
+SENSOR_STATUS = 2  # Sensor.get_status(), as the status code
+MOTOR_STATUS = 3  # Motor.get_status(): flags, power, encoder, dps
+MOTOR_ENCODER = 4  # Motor.get_encoder()
+MOTOR_POWER = 10  # Motor.set_power() and float_motor() (-128)
+MOTOR_DPS = 11  # Motor.set_dps()
+MOTOR_POSITION = 12  # Motor.set_position()
+MOTOR_POSITION_RELATIVE = 13  # Motor.set_position_relative()
+MOTOR_LIMITS = 14  # Motor.set_limits(): power, dps
+MOTOR_OFFSET = 15  # Motor.offset_encoder(), and reset_encoder() (None)
+MARK = 20  # Recorder.mark(), the port is the mark code
+
+RUN_START = 0  # code of the mark recorded when a Recorder starts
+
+KIND_NAMES = {
+    SENSOR_VALUE: "sensor_value", SENSOR_STATUS: "sensor_status", MOTOR_STATUS: "motor_status",
+    MOTOR_ENCODER: "motor_encoder", MOTOR_POWER: "motor_power", MOTOR_DPS: "motor_dps",
+    MOTOR_POSITION: "motor_position", MOTOR_POSITION_RELATIVE: "motor_position_relative",
+    MOTOR_LIMITS: "motor_limits", MOTOR_OFFSET: "motor_offset", MARK: "mark",
+}
+
+_PADDING = (0.0,) * MAX_VALUES
+
+
+class Record(NamedTuple):
+    timestamp: float
+    kind: int
+    port: int
+    value: object  # None, a number, or a list of numbers
+    caller: int = 0  # caller_id() of the thread that made it
+
+    @property
+    def is_command(self) -> bool:
+        return MOTOR_POWER <= self.kind < MARK
+
+
+def caller_id(name: str = None) -> int:
+    """Returns the id of a thread name (the current thread by default) in the records.
+
+    The same name always has the same id, so a replay can give each thread the reads it
+    made in the recorded run, whatever the order the threads read in. Threads reading the
+    devices must then have stable names, eg. threading.Thread(name="odometry").
+
+    >>> caller_id("odometry") == caller_id("odometry") != caller_id("MainThread")
+    True
+    """
+    if name is None:
+        name = threading.current_thread().name
+    return zlib.crc32(name.encode()) & 0xFFFF
+
+
+def encode(timestamp: float, kind: int, port: int, value=None, caller: int = 0) -> bytes:
+    "Returns the record of a value, as written in the file."
+    if value is None:
+        return RECORD.pack(timestamp, kind, port, FLAG_NONE, caller, *_PADDING)
+    if isinstance(value, (list, tuple)):
+        values = value[:MAX_VALUES]
+        flags = len(values)
+    else:
+        values = [value]
+        flags = 1 | FLAG_SCALAR
+    if all(isinstance(v, int) for v in values if v is not None):
+        flags |= FLAG_INT
+    values = [nan if v is None else v for v in values]
+    return RECORD.pack(timestamp, kind, port, flags, caller, *values, *_PADDING[len(values):])
+
+
+def decode(data, offset: int = 0) -> Record:
+    """Returns the record at offset of data, with its value as it was recorded.
+
+    >>> decode(encode(1.5, MOTOR_STATUS, 2, [0, 50, 360, None], caller=7))
+    Record(timestamp=1.5, kind=3, port=2, value=[0, 50, 360, None], caller=7)
+    >>> decode(encode(2.0, SENSOR_VALUE, 1, 12.5)).value, decode(encode(2.0, MOTOR_OFFSET, 1)).value
+    (12.5, None)
+    """
+    timestamp, kind, port, flags, caller, *values = RECORD.unpack_from(data, offset)
+    if flags & FLAG_NONE:
+        return Record(timestamp, kind, port, None, caller)
+    values = [None if isnan(v) else int(v) if flags & FLAG_INT else v for v in values[:flags & 0xFF]]
+    return Record(timestamp, kind, port, values[0] if flags & FLAG_SCALAR else values, caller)
+
+
+class Recorder:
+    """Appends records to a file, written by a background thread.
+
+    path - file of the recording, created if it does not exist
+    flush_interval - seconds between two writes
+    """
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, clock=time.monotonic):
+        self.path = os.path.expanduser(path)
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.count = 0  # records written to the file
+
+        self._queue = deque()
+        self._file = open(self.path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+        self._thread.start()
+        self.mark(RUN_START)
+
+    def record(self, kind: int, port: int, value=None):
+        "Queues a record of value, timestamped now. Safe to call from any thread."
+        self._queue.append(encode(self.clock(), kind, port, value, caller_id()))
+
+    def mark(self, code: int, value=None):
+        "Records an event of the program, eg. the start of a mission step."
+        self.record(MARK, code, value)
+
+    def flush(self):
+        "Writes the queued records to the file."
+        queue = self._queue
+        records = [queue.popleft() for _ in range(len(queue))]
+        if records:
+            self._file.write(b"".join(records))
+            self._file.flush()
+            self.count += len(records)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        "Stops the flush thread, writes the last records and closes the file."
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordReader:
+    """Reads the records of a recording, mapped into memory.
+
+    Records written after the reader was opened are not seen, and an incomplete record
+    at the end (eg. if the program was killed) is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a recording")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._length = (len(self._map) - len(MAGIC)) // RECORD.size
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> Record:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("record index out of range")
+        return decode(self._map, len(MAGIC) + index * RECORD.size)
+
+    def __iter__(self) -> Iterator[Record]:
+        for index in range(self._length):
+            yield decode(self._map, len(MAGIC) + index * RECORD.size)
+
+    def runs(self) -> list:
+        "Returns the (start, stop) record indices of every run in the recording."
+        starts = [index for index, record in enumerate(self)
+                  if record.kind == MARK and record.port == RUN_START]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        return list(zip(starts, starts[1:] + [self._length]))
+
+    def records(self, kind: int = None, port: int = None) -> Iterator[Record]:
+        "Yields the records of the given kind and port (any if None), in order."
+        for record in self:
+            if (kind is None or record.kind == kind) and (port is None or record.port == port):
+                yield record
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -41,7 +41,7 @@ class RemoteBrickClient(RemoteClient):
 class RemoteBrickServer(RemoteServer):
     def __init__(self, password, port=None):
         super(RemoteBrickServer, self).__init__(password, port)
-        self.register_object(brick.BP, var_name='brick')
+        self.register_object(brick.get_default_brick(), var_name='brick')
 
 
 class RemoteEV3UltrasonicSensor(brick.EV3UltrasonicSensor):
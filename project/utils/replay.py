@@ -0,0 +1,213 @@
+"""
+Module for replaying a run recorded by utils.recorder, without the robot.
+
+A ReplayBrick replaces the BrickPi3: once started, every sensor value, sensor status,
+motor status and encoder read by the program is the next one of the same port made by
+the same thread in the recording, instead of a reading of the hardware. Threads reading
+the same port (eg. the odometry and a control loop reading the encoders) then get the
+values they read in the recorded run, whatever the order they read in now. The motor commands of the program
+are kept, to be compared with the recorded ones by diff_commands(). If the program
+makes the same decisions as during the recorded run, it reads the same values in the
+same order, and issues the same commands.
+
+With realtime, a read waits until the time it was made at in the recorded run, so the
+program runs with the original timing. Without, reads return at once and the replay
+only takes as long as the waits of the program itself.
+
+utils.brick uses a ReplayBrick as the default brick when the DPM_REPLAY environment
+variable is set to a recording (and DPM_REPLAY_FAST to replay without the original
+timing), eg.
+
+    DPM_REPLAY=~/run.rec python3 move.py
+
+Example Usage:
+
+    bp = ReplayBrick("~/run.rec")
+    COLOR_SENSOR = EV3ColorSensor(4, bp=bp)
+    bp.start()
+    ...  # run the program
+    print("\\n".join(bp.diff_commands()))
+"""
+
+from collections import defaultdict, deque
+from difflib import unified_diff
+import os
+import threading
+import time
+
+from . import recorder
+from .dummy import BrickPi3
+
+REPLAY_ENV = "DPM_REPLAY"  # recording used by the default brick, if set
+REPLAY_FAST_ENV = "DPM_REPLAY_FAST"  # replay without the original timing, if set
+VALID_DATA = 0  # sensor status code
+
+
+class ReplayEnded(Exception):
+    """Raised when the program reads more values of a port than were recorded."""
+
+
+class ReplayBrick(BrickPi3):
+    """A dummy BrickPi3 that returns the reads of a recorded run once started.
+
+    path - recording made with utils.recorder
+    run - index of the run to replay in the recording, the last one by default
+    realtime - wait for the time of each read in the recorded run
+    """
+
+    # Methods used by utils.brick.Brick, which copies the attributes of its BrickPi3 instead
+    # of calling its methods, so these are also set as attributes of every ReplayBrick
+    DEVICE_METHODS = (
+        "get_sensor", "get_sensor_status", "get_motor_status", "get_motor_encoder",
+        "set_motor_power", "set_motor_position", "set_motor_position_relative", "set_motor_dps",
+        "set_motor_limits", "offset_motor_encoder", "reset_motor_encoder",
+    )
+
+    def __init__(self, path: str, run: int = -1, realtime: bool = True, clock=time.monotonic):
+        super(ReplayBrick, self).__init__()
+        for name in self.DEVICE_METHODS:
+            setattr(self, name, getattr(self, name))
+
+        with recorder.RecordReader(path) as reader:
+            start, stop = reader.runs()[run]
+            records = [reader[index] for index in range(start, stop)]
+        self.realtime = realtime
+        self.clock = clock
+        self.origin = records[0].timestamp if records else 0.0  # time of the recorded run start
+        self.expected = [record for record in records if record.is_command]
+        self.commands = []  # commands of the replayed run, with timestamps from its start
+        self._reads = defaultdict(deque)  # by (kind, port, caller)
+        for record in records:
+            if record.kind < recorder.MOTOR_POWER:
+                self._reads[record.kind, record.port, record.caller].append(record)
+        self._start = None
+
+    def start(self):
+        "Starts replaying. Before this, the brick behaves like the dummy BrickPi3."
+        self._start = self.clock()
+        return self
+
+    def is_replaying(self) -> bool:
+        return self._start is not None
+
+    def _next(self, kind: int, port: int):
+        """Returns the next recorded value of kind on port read by the current thread, after
+        its recorded time if realtime."""
+        reads = self._reads[kind, port, recorder.caller_id()]
+        if not reads:
+            raise ReplayEnded(f"no more {recorder.KIND_NAMES[kind]} recorded on port {port} "
+                              f"by thread {threading.current_thread().name}")
+        record = reads.popleft()
+        if self.realtime:
+            delay = (record.timestamp - self.origin) - (self.clock() - self._start)
+            if delay > 0:
+                time.sleep(delay)
+        return record.value
+
+    def _command(self, kind: int, port: int, value=None):
+        if self._start is not None:
+            data = recorder.encode(self.clock() - self._start, kind, port, value, recorder.caller_id())
+            self.commands.append(recorder.decode(data))
+
+    def get_sensor(self, port):
+        if self._start is None:
+            return super(ReplayBrick, self).get_sensor(port)
+        return self._next(recorder.SENSOR_VALUE, port)
+
+    def get_sensor_status(self, port):
+        # Statuses are only waited on, so the sensors are ready once the recorded ones are used
+        if self._start is None or not self._reads[recorder.SENSOR_STATUS, port, recorder.caller_id()]:
+            return VALID_DATA
+        return self._next(recorder.SENSOR_STATUS, port)
+
+    def get_motor_status(self, port):
+        if self._start is None:
+            return super(ReplayBrick, self).get_motor_status(port)
+        return self._next(recorder.MOTOR_STATUS, port)
+
+    def get_motor_encoder(self, port):
+        if self._start is None:
+            return super(ReplayBrick, self).get_motor_encoder(port)
+        return self._next(recorder.MOTOR_ENCODER, port)
+
+    # Commands are kept, and sent to the dummy motors before the replay starts
+
+    def set_motor_power(self, port, power):
+        if self._start is None:
+            return super(ReplayBrick, self).set_motor_power(port, power)
+        self._command(recorder.MOTOR_POWER, port, power)
+
+    def set_motor_position(self, port, position):
+        if self._start is None:
+            return super(ReplayBrick, self).set_motor_position(port, position)
+        self._command(recorder.MOTOR_POSITION, port, position)
+
+    def set_motor_position_relative(self, port, degrees):
+        if self._start is None:
+            return super(ReplayBrick, self).set_motor_position_relative(port, degrees)
+        self._command(recorder.MOTOR_POSITION_RELATIVE, port, degrees)
+
+    def set_motor_dps(self, port, dps):
+        if self._start is None:
+            return super(ReplayBrick, self).set_motor_dps(port, dps)
+        self._command(recorder.MOTOR_DPS, port, dps)
+
+    def set_motor_limits(self, port, power=0, dps=0):
+        if self._start is None:
+            return super(ReplayBrick, self).set_motor_limits(port, power, dps)
+        self._command(recorder.MOTOR_LIMITS, port, [power, dps])
+
+    def offset_motor_encoder(self, port, position):
+        if self._start is None:
+            return super(ReplayBrick, self).offset_motor_encoder(port, position)
+        self._command(recorder.MOTOR_OFFSET, port, position)
+
+    def reset_motor_encoder(self, port):
+        if self._start is None:
+            return super(ReplayBrick, self).reset_motor_encoder(port)
+        self._command(recorder.MOTOR_OFFSET, port)
+
+    def diff_commands(self, digits: int = 1, context: int = 3) -> list:
+        "Returns the unified diff of the recorded and replayed commands, empty if they are the same."
+        return diff_commands(self.expected, self.commands, digits, context)
+
+
+def format_command(record: recorder.Record, digits: int = 1) -> str:
+    "Returns a line describing a command, with its values rounded to digits."
+    value = record.value
+    if isinstance(value, list):
+        value = [v if v is None else round(v, digits) + 0.0 for v in value]
+    elif value is not None:
+        value = round(value, digits) + 0.0  # also turns -0.0 into 0.0
+    return f"{recorder.KIND_NAMES[record.kind]} port={record.port} {value}"
+
+
+def diff_commands(expected: list, actual: list, digits: int = 1, context: int = 3) -> list:
+    """Returns the unified diff of two lists of command records, ignoring their timestamps.
+    The commands of each thread are compared in order, but not the order between threads.
+
+    >>> expected = [recorder.Record(0.0, recorder.MOTOR_DPS, 2, 450), recorder.Record(1.0, recorder.MOTOR_DPS, 2, 0)]
+    >>> actual = [recorder.Record(0.0, recorder.MOTOR_DPS, 2, 450.01), recorder.Record(0.9, recorder.MOTOR_POWER, 2, 0)]
+    >>> print("\\n".join(diff_commands(expected, actual)))
+    --- recorded
+    +++ replayed
+    @@ -1,2 +1,2 @@
+     motor_dps port=2 450.0
+    -motor_dps port=2 0.0
+    +motor_power port=2 0.0
+    """
+    def by_caller(records):
+        return sorted(records, key=lambda record: record.caller)  # keeps the order of each caller
+
+    return [line.rstrip("\n") for line in unified_diff(
+        [format_command(record, digits) for record in by_caller(expected)],
+        [format_command(record, digits) for record in by_caller(actual)],
+        "recorded", "replayed", n=context, lineterm="")]
+
+
+def from_env():
+    "Returns a ReplayBrick of the recording named by REPLAY_ENV, or None if it is not set."
+    path = os.environ.get(REPLAY_ENV)
+    if not path:
+        return None
+    return ReplayBrick(path, realtime=not os.environ.get(REPLAY_FAST_ENV))
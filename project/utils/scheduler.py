@@ -0,0 +1,165 @@
+"""
+Module for running periodic tasks at fixed rates, against a monotonic clock.
+
+A loop written as `while ...: read(); sleep(POLL)` runs slower than intended, since
+the time spent reading sensors is added to every period. The Scheduler instead
+runs each task on its own deadlines (next = previous + period), and records how
+late each run started (jitter) and how long it ran past its period (overrun).
+
+Example Usage:
+
+    scheduler = Scheduler()
+    scheduler.add_task(control_line, rate=100)
+    scheduler.add_task(read_ultrasonic, rate=20)
+    scheduler.run(until=lambda: distance < 10)
+    print(scheduler.report())
+"""
+
+from typing import Callable, List, Optional
+import heapq
+import itertools
+import time
+
+# Upper bounds of the histogram bins in seconds, the last bin counts everything larger
+HISTOGRAM_BINS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+class Histogram:
+    """Counts durations (seconds) into the bins of HISTOGRAM_BINS.
+
+    >>> h = Histogram()
+    >>> h.add(0.0003); h.add(0.004); h.add(2)
+    >>> h.counts
+    [1, 0, 0, 1, 0, 0, 0, 0, 1]
+    >>> h.maximum
+    2
+    """
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.bins = bins
+        self.counts = [0] * (len(bins) + 1)
+        self.maximum = 0.0
+
+    def add(self, value: float):
+        for i, upper in enumerate(self.bins):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.maximum = max(self.maximum, value)
+
+    def __repr__(self):
+        labels = [f"<={upper * 1000:g}ms" for upper in self.bins] + \
+            [f">{self.bins[-1] * 1000:g}ms"]
+        return " ".join(f"{label}:{count}" for label, count in zip(labels, self.counts) if count)
+
+
+class Task:
+    """A function run periodically by a Scheduler. Use Scheduler.add_task to create one."""
+
+    def __init__(self, func: Callable[[], None], rate: float, name: str):
+        if rate <= 0:
+            raise ValueError("rate must be a positive number of runs per second")
+        self.func = func
+        self.rate = rate
+        self.period = 1 / rate
+        self.name = name
+        self.next_time = 0.0
+
+        self.runs = 0
+        self.overruns = 0  # runs longer than one period
+        self.skipped = 0  # periods skipped because the task was too late
+        self.busy_time = 0.0
+        self.jitter = Histogram()  # how late each run started
+        self.overrun = Histogram()  # how long each overrun lasted past its period
+
+    def __repr__(self):
+        load = self.busy_time * self.rate / self.runs if self.runs else 0
+        return (f"{self.name} @ {self.rate:g}Hz: {self.runs} runs, {self.overruns} overruns, "
+                f"{self.skipped} skipped, load {load:.0%}, max jitter {self.jitter.maximum * 1000:.2f}ms\n"
+                f"  jitter  {self.jitter}\n  overrun {self.overrun}")
+
+
+class Scheduler:
+    """Runs registered tasks at their declared rates, in the calling thread.
+
+    When several tasks are due at once, the task with the highest rate runs first.
+    A task that runs late is not run several times in a row to catch up: the
+    missed periods are counted as skipped and the task keeps its original phase.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks: List[Task] = []
+        self._queue = []
+        self._order = itertools.count()
+        self._running = False
+
+    def add_task(self, func: Callable[[], None], rate: float, name: Optional[str] = None) -> Task:
+        """Registers func to be run rate times per second. Returns its Task."""
+        task = Task(func, rate, name or getattr(func, "__name__", "task"))
+        self.tasks.append(task)
+        if self._running:
+            self._push(task, self.clock())
+        return task
+
+    def remove_task(self, task: Task):
+        self.tasks.remove(task)
+        self._queue = [item for item in self._queue if item[3] is not task]
+        heapq.heapify(self._queue)
+
+    def _push(self, task: Task, when: float):
+        task.next_time = when
+        heapq.heappush(self._queue, (when, -task.rate, next(self._order), task))
+
+    def stop(self):
+        """Makes Scheduler.run return, after the current task is done. Can be called from a task."""
+        self._running = False
+
+    def run(self, until: Callable[[], bool] = None, timeout: float = None):
+        """Runs the tasks until stop() is called, until() returns True (checked after
+        every task run), or timeout seconds have passed.
+        """
+        start = self.clock()
+        self._queue = []
+        for task in self.tasks:
+            self._push(task, start)
+        self._running = True
+
+        while self._running and self._queue:
+            when, _, _, task = self._queue[0]
+            now = self.clock()
+            if timeout is not None and min(now, when) - start >= timeout:
+                break
+            if when > now:
+                self.sleep(when - now)
+                continue
+            heapq.heappop(self._queue)
+
+            task.jitter.add(now - when)
+            task.func()
+            end = self.clock()
+            task.runs += 1
+            task.busy_time += end - now
+            if end - now > task.period:
+                task.overruns += 1
+                task.overrun.add(end - now - task.period)
+
+            # Keep the original phase, skipping the periods that are already over
+            next_time = when + task.period
+            if next_time < end:
+                missed = int((end - next_time) / task.period) + 1
+                task.skipped += missed
+                next_time += missed * task.period
+            if task in self.tasks:
+                self._push(task, next_time)
+
+            if until is not None and until():
+                break
+        self._running = False
+
+    def report(self) -> str:
+        "Returns the run, overrun and jitter statistics of every task."
+        return "\n".join(repr(task) for task in self.tasks)
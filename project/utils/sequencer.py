@@ -0,0 +1,158 @@
+"""
+Module for playing a score of notes at a given tempo, through a Mixer.
+
+Instead of compiling a whole Song before playing it, the Sequencer only renders
+the notes that start within the next lookahead seconds, and schedules each one on
+the Mixer at its exact sample frame. Long scores start playing immediately, and
+tempo changes take effect while playing.
+
+Example Usage:
+
+    from utils.sequencer import Event, Sequencer
+
+    score = [
+        Event("C4", start=0, duration=1),
+        Event("E4", start=1, duration=1),
+        Event("G4", start=2, duration=2, volume=60),
+    ]
+    seq = Sequencer(score, bpm=120)
+    seq.play()
+    seq.set_tempo(90)  # slows down every note not yet scheduled
+    seq.wait_done()
+"""
+
+from typing import Iterable, NamedTuple, Union
+import threading
+import time
+
+from .mixer import Mixer, get_mixer
+from .sound import Sound
+
+
+class Event(NamedTuple):
+    """A note of a score.
+
+    note - note name such as 'A4', or a frequency in Hertz
+    start - beat at which the note starts
+    duration - length of the note in beats
+    volume - 0 to 100, as for Sound
+    """
+    note: Union[str, float]
+    start: float
+    duration: float
+    volume: float = 40
+
+
+class Sequencer:
+    """Plays a score of Events through a Mixer, rendering them just ahead of the playhead.
+
+    bpm - tempo in beats per minute. Can be changed while playing with set_tempo.
+    lookahead - seconds of the score rendered ahead of the mixer.
+    tick - seconds between two scheduling passes, measured on the monotonic clock.
+    """
+
+    def __init__(self, score: Iterable[Event], bpm: float = 120, mixer: Mixer = None,
+                 lookahead: float = 0.25, tick: float = 0.02, **sound_kwargs):
+        self.score = sorted(score, key=lambda e: e.start)
+        self.bpm = float(bpm)
+        self.mixer = mixer
+        self.lookahead = lookahead
+        self.tick = tick
+        self.sound_kwargs = sound_kwargs  # extra arguments for every Sound, eg. cutoff
+
+        self._next = 0  # index of the next event to schedule
+        self._anchor_beat = 0.0  # tempo changes are anchored at (beat, frame)
+        self._anchor_frame = 0
+        self._last_frame = 0  # frame where the last scheduled note ends
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _frame_of(self, beat: float) -> int:
+        "Mixer frame at which the given beat is played, at the current tempo."
+        seconds = (beat - self._anchor_beat) * 60 / self.bpm
+        return self._anchor_frame + int(round(seconds * self.mixer.fs))
+
+    def _beat_of(self, frame: int) -> float:
+        seconds = (frame - self._anchor_frame) / self.mixer.fs
+        return self._anchor_beat + seconds * self.bpm / 60
+
+    def set_tempo(self, bpm: float):
+        """Changes the tempo. Notes already scheduled (within lookahead) keep
+        their timing, every later note follows the new tempo."""
+        with self._lock:
+            if self.mixer is not None and self._thread is not None:
+                horizon = self._horizon()
+                self._anchor_beat = self._beat_of(horizon)
+                self._anchor_frame = horizon
+            self.bpm = float(bpm)
+
+    def _horizon(self) -> int:
+        return self.mixer.frame + int(self.lookahead * self.mixer.fs)
+
+    def _schedule(self):
+        "Renders and schedules every event starting before the lookahead horizon."
+        with self._lock:
+            horizon = self._horizon()
+            while self._next < len(self.score):
+                event = self.score[self._next]
+                start = self._frame_of(event.start)
+                if start >= horizon:
+                    break
+                end = self._frame_of(event.start + event.duration)
+                sound = Sound(duration=(end - start) / self.mixer.fs, volume=event.volume,
+                              pitch=event.note, fs=self.mixer.fs, **self.sound_kwargs)
+                self.mixer.note_on(sound, at_frame=start)
+                self._last_frame = max(self._last_frame, end)
+                self._next += 1
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop_event.is_set() and self._next < len(self.score):
+            self._schedule()
+            next_tick += self.tick
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+    def play(self, start_beat: float = 0):
+        """Starts playing the score from start_beat, in a background thread."""
+        self.stop()
+        if self.mixer is None:
+            self.mixer = get_mixer()
+        self.mixer.start()
+        with self._lock:
+            self._next = 0
+            while self._next < len(self.score) and self.score[self._next].start < start_beat:
+                self._next += 1
+            # leave time to render the first notes before they are due
+            self._anchor_beat = start_beat
+            self._anchor_frame = self.mixer.frame + int(self.lookahead * self.mixer.fs)
+            self._last_frame = self._anchor_frame
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops scheduling notes. Notes already sent to the mixer finish playing."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def is_playing(self) -> bool:
+        if self.mixer is None:
+            return False
+        return (self._thread is not None and self._thread.is_alive()) or \
+            self.mixer.frame < self._last_frame
+
+    def get_beat(self) -> float:
+        "Returns the beat currently being written by the mixer."
+        with self._lock:
+            return self._beat_of(self.mixer.frame)
+
+    def wait_done(self):
+        """Waits until every note of the score has been played."""
+        while self.is_playing():
+            time.sleep(self.tick)
+        return self
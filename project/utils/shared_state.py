@@ -0,0 +1,116 @@
+"""
+Module for sharing the robot state between processes, without pickling.
+
+The movement process writes its state (phase, deliveries, pose) into a block of
+shared memory with a fixed struct layout, and any other process can read it at
+any time. A seqlock makes reads consistent: the writer makes the sequence number
+odd while it writes, and readers retry until they read the same even sequence
+number before and after copying the block. Only one process may write the state.
+
+The block also holds a stop flag, outside the seqlock, which any process can set.
+The writer calls check_stop() at safe points, which raises StopRequested, so that
+it can stop its motors itself instead of being killed in the middle of a transfer.
+
+Example Usage:
+
+    state = SharedState()  # in the supervisor
+    process = Process(target=worker, args=(state,))
+
+    state.update(phase="office_1", deliveries=1)  # in the worker
+    state.check_stop()
+
+    print(state.read().deliveries)  # in the supervisor
+    state.request_stop()
+"""
+
+from multiprocessing import shared_memory
+from typing import NamedTuple
+import struct
+import time
+
+PHASE_SIZE = 48  # bytes of the phase name, longer names are truncated
+
+# seq, then the state: phase, deliveries, x, y, heading, timestamp
+_SEQ = struct.Struct("<I")
+_STATE = struct.Struct(f"<{PHASE_SIZE}si4d")
+_STATE_OFFSET = _SEQ.size
+_STOP_OFFSET = _STATE_OFFSET + _STATE.size
+SIZE = _STOP_OFFSET + 1
+
+
+class StopRequested(Exception):
+    """Raised by SharedState.check_stop once another process requested a stop."""
+
+
+class State(NamedTuple):
+    phase: str
+    deliveries: int
+    x: float
+    y: float
+    heading: float
+    timestamp: float  # time.monotonic() of the last update, 0 if never updated
+
+
+class SharedState:
+    """A State in shared memory, written by one process and read by any.
+
+    name - name of an existing block to attach to, or None to create a new one
+    """
+
+    def __init__(self, name: str = None):
+        self._owner = name is None
+        self._memory = shared_memory.SharedMemory(name=name, create=self._owner, size=SIZE)
+        self._buffer = self._memory.buf
+        self._state = State("", 0, 0.0, 0.0, 0.0, 0.0)
+        if self._owner:
+            self._buffer[:SIZE] = bytes(SIZE)
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    def __reduce__(self):
+        # Other processes attach to the same block by name
+        return SharedState, (self.name,)
+
+    def update(self, **fields):
+        """Writes the given State fields, keeping the others. Only one process may call this."""
+        self._state = self._state._replace(timestamp=time.monotonic(), **fields)
+        phase = self._state.phase.encode()[:PHASE_SIZE]
+        data = _STATE.pack(phase, *self._state[1:])
+
+        seq = _SEQ.unpack_from(self._buffer, 0)[0]
+        _SEQ.pack_into(self._buffer, 0, (seq + 1) & 0xFFFFFFFF)
+        self._buffer[_STATE_OFFSET:_STOP_OFFSET] = data
+        _SEQ.pack_into(self._buffer, 0, (seq + 2) & 0xFFFFFFFF)
+
+    def read(self) -> State:
+        """Returns a consistent copy of the last State written."""
+        while True:
+            before = _SEQ.unpack_from(self._buffer, 0)[0]
+            if before % 2 == 1:
+                continue  # a write is in progress
+            data = bytes(self._buffer[_STATE_OFFSET:_STOP_OFFSET])
+            if _SEQ.unpack_from(self._buffer, 0)[0] == before:
+                break
+        phase, *values = _STATE.unpack(data)
+        return State(phase.rstrip(b"\0").decode(errors="ignore"), *values)
+
+    def request_stop(self):
+        "Asks the writer to stop at its next check_stop."
+        self._buffer[_STOP_OFFSET] = 1
+
+    def stop_requested(self) -> bool:
+        return self._buffer[_STOP_OFFSET] != 0
+
+    def check_stop(self):
+        "Raises StopRequested if a stop was requested."
+        if self.stop_requested():
+            raise StopRequested()
+
+    def close(self):
+        """Detaches from the block. The process that created it also frees it."""
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
@@ -10,13 +10,31 @@ from typing import Callable, Iterable, SupportsIndex, Tuple, Union
 import time
 import os
 import pickle
+import hashlib
+import mmap
 import simpleaudio as sa
 import math
 import functools
 import array
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, waveforms are then generated in pure Python
+    np = None
 
 LIMIT_MAX_VOLUME = True
 
+# Generated waves are cached on disk as raw int16 PCM, in the home folder so that
+# the cache survives redeploying the project folder.
+WAVE_CACHE_ENABLED = True
+WAVE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dpm_sounds")
+WAVE_CACHE_MAX_BYTES = 32 * 2**20  # least recently used waves are evicted past this size
+WAVE_CACHE_EVICT_TO = 0.75  # fraction of WAVE_CACHE_MAX_BYTES left after an eviction
+_WAVE_CACHE_VERSION = 1  # change whenever _gen_wave produces different samples
+_wave_cache_bytes = None  # size of the cache, scanned on the first store then kept up to date
+
 
 def change_volume(percentage):
     vol = abs(int(percentage))
@@ -98,10 +116,147 @@ def gen_wave(duration=1, volume=40, pitch: Union[str, float] = "A4", mod_f: Unio
     # Convert volume using decibel underneath
     volume = vol_to_amp(volume)
 
-    return _gen_wave(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs)
+    params = (duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs)
+    if not WAVE_CACHE_ENABLED:
+        return _gen_wave(*params)
+
+    key = _wave_cache_key(*params)
+    arr = _wave_cache_load(key)
+    if arr is None:
+        arr = _gen_wave(*params)
+        _wave_cache_store(key, arr)
+    return arr
+
+
+def _wave_cache_key(*params) -> str:
+    """Content address of a wave, the hash of every parameter given to _gen_wave."""
+    text = repr((_WAVE_CACHE_VERSION,) + tuple(float(p) for p in params))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _wave_cache_path(key: str) -> str:
+    return os.path.join(WAVE_CACHE_DIR, key + ".pcm")
+
+
+def _wave_cache_load(key: str):
+    """Returns the cached wave for key as an array('h'), or None if it is not cached.
+    The file is memory-mapped and copied into the array in a single operation.
+    """
+    path = _wave_cache_path(key)
+    arr = array.array('h')
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    arr.frombytes(mm)
+        os.utime(path)  # mark as recently used
+    except (OSError, ValueError):
+        return None
+    return arr
+
+
+def _wave_cache_store(key: str, arr: array.array):
+    """Saves a wave to the cache, then evicts the least recently used waves
+    if the cache grew beyond WAVE_CACHE_MAX_BYTES. Failures are ignored, since
+    the cache is only an optimization.
+
+    The size of the cache is kept in memory, so that the directory is only scanned
+    on the first store and when the cache is full, which then evicts down to
+    WAVE_CACHE_EVICT_TO of the limit (the scan also counts the waves stored by other
+    processes since).
+    """
+    global _wave_cache_bytes
+    path = _wave_cache_path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(WAVE_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            arr.tofile(f)
+        os.replace(tmp_path, path)  # other processes never see partial files
+        if _wave_cache_bytes is None:
+            _wave_cache_bytes = _wave_cache_evict(WAVE_CACHE_MAX_BYTES)
+        else:
+            _wave_cache_bytes += len(arr) * arr.itemsize
+            if _wave_cache_bytes > WAVE_CACHE_MAX_BYTES:
+                _wave_cache_bytes = _wave_cache_evict(int(WAVE_CACHE_MAX_BYTES * WAVE_CACHE_EVICT_TO))
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _wave_cache_evict(max_bytes: int) -> int:
+    """Deletes the least recently used waves until the cache holds at most max_bytes.
+    Returns the size of the cache left."""
+    entries = []
+    with os.scandir(WAVE_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".pcm"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+    return total
+
+
+def clear_wave_cache():
+    """Deletes every wave saved in the on-disk cache."""
+    global _wave_cache_bytes
+    try:
+        _wave_cache_bytes = _wave_cache_evict(0)
+    except OSError:
+        pass
 
 
 def _gen_wave(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs):
+    """Generates the int16 samples of a wave. Uses the vectorized numpy
+    implementation when numpy is installed, and the pure Python one otherwise.
+    """
+    if np is not None:
+        return _gen_wave_numpy(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs)
+    return _gen_wave_python(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs)
+
+
+def _gen_wave_numpy(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs):
+    """Same as _gen_wave_python, but every step is done on whole numpy arrays
+    instead of one sample at a time.
+    """
+    n = int(duration * fs)
+    x = np.arange(n) / fs
+    # create carrier wave, frequency modulate, then amplitude modulate
+    c = 2 * math.pi * x * pitch
+    m = mod_k * np.sin(2 * math.pi * mod_f * x)
+    y = np.cos(c + m)
+    y *= amp_ac * (1 + (amp_ka * np.sin(2 * math.pi * amp_f * x)))
+    maximum = float(np.abs(y).max()) if n > 0 else -2**31
+
+    # apply volume
+    y *= volume
+
+    # apply cutoff (logarithmic lead-in and fade-out)
+    cutoff = min(int(n/2), int(fs * cutoff))
+    if cutoff > 0:
+        k = (1/3) * (1/math.log(2))
+        fade = np.log(np.arange(cutoff) / cutoff * 7 + 1) * k
+        y[:cutoff] *= fade
+        y[n-cutoff:] *= fade[::-1]
+
+    # pull down value to int16, int() truncates towards zero
+    max16 = (2**15 - 1)
+    y = np.trunc(y * max16 / maximum)
+    y = np.clip(y, -32768, 32767).astype(np.int16)
+
+    arr = array.array('h')
+    arr.frombytes(y.tobytes())
+    return arr
+
+
+def _gen_wave_python(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cutoff, fs):
     n = int(duration * fs)
     t = [0 for i in range(n)]  # comprehension faster than append
     maximum = -2**31
@@ -141,10 +296,34 @@ def _gen_wave(duration, volume, pitch, mod_f, mod_k, amp_f, amp_ka, amp_ac, cuto
     return array.array('h', t)
 
 
+def _join_buffers(segments: Iterable[Union[array.array, int]]) -> array.array:
+    """Joins int16 buffers into a single new array('h').
+
+    segments is an iterable of int16 buffers (such as Sound.audio), or of ints
+    giving a number of silent samples. The result is allocated once (already
+    silent) and each buffer is copied in with a single memoryview slice assignment.
+    """
+    segments = list(segments)
+    total = sum(seg if isinstance(seg, int) else len(seg) for seg in segments)
+    out = array.array('h', bytes(2 * total))
+    ptr = 0
+    # Release the view before returning, since arrays cannot be resized while exported
+    with memoryview(out) as view:
+        for seg in segments:
+            if isinstance(seg, int):
+                ptr += max(seg, 0)
+            else:
+                n = len(seg)
+                view[ptr:ptr+n] = memoryview(seg)
+                ptr += n
+    return out
+
+
 class Sound:
     def __init__(self, duration=1, volume=40, pitch="A4", mod_f=0, mod_k=0, amp_f=0, amp_ka=0, amp_ac=1, cutoff=0.01, fs=8000):
         self.player = None
         self._fs = fs  # needs a default value
+        self._audio_version = 0  # incremented whenever self.audio is changed in place
         self.set_volume(volume)
         self.set_pitch(pitch)
         self.set_cutoff(cutoff)
@@ -188,11 +367,7 @@ class Sound:
         spacing_n = int(spacing * self._fs)
 
         if not self.is_playing():
-            src = list(self.audio)
-            dst = list(other.audio)
-            spacer = [0 for i in range(spacing_n)]
-
-            self.audio = array.array('h', src + spacer + dst)
+            self.audio = _join_buffers([self.audio, spacing_n, other.audio])
         else:
             raise RuntimeError(
                 "Cannot alter this sound object for repetition while playing this sound.")
@@ -212,6 +387,8 @@ class Sound:
             sound playing for 0.1 seconds, and then no silence spacing afterwards. This is desired behavior. You can then perform 
             a time.sleep(0.4) seconds before replaying this Sound object. BUT there is sometimes latency in "starting" a sound, 
             so the time sleep may need to be smaller, such as 0.35 seconds instead.
+
+        To play notes at a steady BPM without tuning sleeps by hand, see utils.sequencer.
         """
         repeat_times = int(
             repeat_times)  # This can cause an error, which is desired
@@ -226,16 +403,9 @@ class Sound:
         interval_n = int(fs * repeat_interval)
 
         if not self.is_playing():
-            src = list(self.audio)
-            src_n = len(src)
-            end_n = src_n * repeat_times + (repeat_times - 1) * interval_n
-            spacer = [0 for i in range(interval_n)]
-            n = src_n + interval_n
-            arr = []
-            tmp = src + spacer
-            for i in range(end_n):
-                arr.append(tmp[i % n])
-            self.audio = array.array('h', arr)
+            src = self.audio
+            segments = [src, interval_n] * (repeat_times - 1) + [src]
+            self.audio = _join_buffers(segments)
         else:
             raise RuntimeError(
                 "Cannot alter this sound object for repetition while playing this sound.")
@@ -354,6 +524,7 @@ class Sound:
                 self.audio[i] = arr[i]
         else:
             self.audio = arr
+        self._audio_version += 1
         return self
 
     def alter_wave(self, func: Callable[[float, int], int]):
@@ -370,6 +541,7 @@ class Sound:
             # func(x:float, y:int16) -> y:int16
             self.audio[i] = clip(
                 func(i/self._fs, self.audio[i]), -32768, 32767)
+        self._audio_version += 1
         return self
 
     def play(self):
@@ -407,9 +579,9 @@ class Song(list):
     song = Song([s1, s0, s2, s0])
     song *= 4 # repeat the song 4 times over
 
-    song.compile() # Slow process, several seconds latency
+    song.compile() # Optional, otherwise done by the first play()
 
-    song.play() # Faster, ~0.7 seconds latency
+    song.play() # ~0.7 seconds latency
     time.sleep(song.duration)
     song.stop()
     """
@@ -422,8 +594,8 @@ class Song(list):
         """
 
         core = Sound(duration=1)
-        core.audio = array.array(
-            'h', [0 for i in range(int(core._fs*seconds))])
+        core.audio = array.array('h', bytes(2 * int(core._fs*seconds)))
+        core._duration = seconds
 
         return core
 
@@ -438,6 +610,7 @@ class Song(list):
         super().__init__()
         self.core = self.create_silence(1)  # Default silence
         self.duration = self.core._duration
+        self._compiled_key = ()
 
         self.extend(sounds)
 
@@ -460,23 +633,24 @@ class Song(list):
             if isinstance(el, Sound):
                 self.append(el)
 
+    def _segments_key(self):
+        """Identifies the current audio of this Song's Sounds, to know whether the
+        compiled audio is outdated. A buffer changed in place keeps its id and length,
+        so the version of the Sound's audio is part of the key."""
+        return tuple((id(s.audio), len(s.audio), s._audio_version) for s in self if isinstance(s, Sound))
+
     def compile(self):
         """Compiles the appended sounds to create the song.
 
-        After this is set, then it can be played using Song.play()
+        The Song only keeps a list of its Sounds until then. Song.play() calls
+        this automatically when Sounds were added or changed since the last compile.
         """
         sounds = [s for s in self if isinstance(s, Sound)]
-        self.duration = sum([s._duration for s in sounds])
-        self._samples = sum([len(s.audio) for s in sounds])
         self.core = Sound(duration=1)
-        self.core.audio = array.array(
-            'h', [0 for i in range(int(self._samples))])
-        ptr = 0
-        for s in sounds:
-            n = len(s.audio)
-            for i in range(n):
-                self.core.audio[min(ptr, self._samples-1)] = s.audio[i]
-                ptr += 1
+        self.core.audio = _join_buffers(s.audio for s in sounds)
+        self._samples = len(self.core.audio)
+        self.duration = self._samples / self.core._fs
+        self._compiled_key = self._segments_key()
 
     def play(self):
         """Starts the Song. It plays silence by default.
@@ -487,6 +661,8 @@ class Song(list):
         If Song.play_sound(s1) was done already, then Song.start()
             will play the given sound s1 to begin with.
         """
+        if self._segments_key() != self._compiled_key:
+            self.compile()
         self.core.play()
 
     def stop(self):
@@ -694,7 +870,7 @@ def preload_all_pitches(duration=1, volume=40, mod_f=0, mod_k=0, amp_f=0, amp_ka
 def save_all_pitches_file(sounds, filename="sounds"):
     path = os.path.join(os.path.dirname(
         os.path.realpath(__file__)), str(filename) + ".pickle")
-    with open(path, "rb") as f:
+    with open(path, "wb") as f:
         pickle.dump(sounds, f)
 
 
@@ -745,5 +921,39 @@ def _test_vol1():
         Sound(volume=float(ans)).play().wait_done()
 
 
+def _bench_gen_wave(repeats=3):
+    """Compares the speed of the numpy and pure Python wave generation,
+    for a single note and for preload_all_pitches.
+    """
+    def best_of(func, *args, repeats=repeats):
+        best = float("inf")
+        for i in range(repeats):
+            start = time.perf_counter()
+            result = func(*args)
+            best = min(best, time.perf_counter() - start)
+        return best, result
+
+    args = (1, vol_to_amp(40), NOTES["A4"], 0, 0, 0, 0, 1, 0.01, 8000)
+    t_py, a_py = best_of(_gen_wave_python, *args)
+    print(f"python: 1s A4 @ 8kHz  {t_py * 1000:8.2f} ms")
+    if np is None:
+        print("numpy is not installed, skipping numpy benchmark")
+        return
+    t_np, a_np = best_of(_gen_wave_numpy, *args)
+    diff = max(abs(p - q) for p, q in zip(a_py, a_np))
+    print(f"numpy:  1s A4 @ 8kHz  {t_np * 1000:8.2f} ms  "
+          f"({t_py / t_np:.1f}x faster, max sample difference {diff})")
+
+    def preload(gen):
+        return [gen(1, vol_to_amp(40), NOTES[key], 0, 0, 0, 0, 1, 0.01, 8000) for key in NOTE_NAMES]
+    t_py, _ = best_of(preload, _gen_wave_python, repeats=1)
+    t_np, _ = best_of(preload, _gen_wave_numpy, repeats=1)
+    print(f"preload_all_pitches ({len(NOTE_NAMES)} notes): python {t_py:.2f} s, "
+          f"numpy {t_np:.2f} s ({t_py / t_np:.1f}x faster)")
+
+
 if __name__ == '__main__':
-    _test_vol1()
+    if "-bench" in sys.argv:
+        _bench_gen_wave()
+    else:
+        _test_vol1()
@@ -0,0 +1,85 @@
+"""
+Module for profiling the startup of a program: which imports and initializations
+happen, when, and how long they take.
+
+Profiling is enabled by setting the DPM_STARTUP_PROFILE environment variable, eg.
+
+    DPM_STARTUP_PROFILE=1 python3 move.py
+
+Import this module first in the program. From then on, every first import slower
+than IMPORT_THRESHOLD is printed (nested imports are indented), and so are the
+marks and spans of the program. Times are in milliseconds since this module was
+imported. When profiling is disabled, mark() and span() do nothing.
+
+Example Usage:
+
+    from utils import startup
+    ...
+    with startup.span("wait sensors"):
+        wait_ready_sensors()
+    startup.mark("first motor command")
+"""
+
+from contextlib import contextmanager
+import builtins
+import os
+import sys
+import time
+
+ENABLED = bool(os.environ.get("DPM_STARTUP_PROFILE"))
+IMPORT_THRESHOLD = 0.001  # seconds, faster imports are not printed
+
+_START = time.perf_counter()
+_original_import = builtins.__import__
+_depth = 0
+
+
+def elapsed() -> float:
+    "Returns the seconds since this module was imported."
+    return time.perf_counter() - _START
+
+
+def _print(text: str, start: float = None):
+    if start is None:
+        start = elapsed()
+    print(f"[startup {start * 1000:8.1f} ms] {'  ' * _depth}{text}", file=sys.stderr, flush=True)
+
+
+def mark(label: str):
+    "Prints the time of an event, if profiling is enabled."
+    if ENABLED:
+        _print(label)
+
+
+@contextmanager
+def span(label: str):
+    "Prints how long the body of the with statement took, if profiling is enabled."
+    if not ENABLED:
+        yield
+        return
+    start = elapsed()
+    try:
+        yield
+    finally:
+        _print(f"{label}: {(elapsed() - start) * 1000:.1f} ms", start)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level == 0 and name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    start = elapsed()
+    _depth += 1
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        duration = elapsed() - start
+        if duration >= IMPORT_THRESHOLD:
+            module = "." * level + (name or ", ".join(fromlist or ()))
+            _print(f"import {module}: {duration * 1000:.1f} ms", start)
+
+
+if ENABLED:
+    builtins.__import__ = _timed_import
+    mark(f"profiling startup of {sys.argv[0]}")
@@ -0,0 +1,74 @@
+"""sample_async
+
+This is sample code for utils.aio, running a line follower, an emergency
+stop, an obstacle watch and telemetry at the same time in one program,
+each as its own simple loop
+
+"""
+
+import asyncio
+
+from utils.aio import AsyncBrick
+from utils.brick import EV3ColorSensor, EV3UltrasonicSensor, Motor, TouchSensor
+
+touch = TouchSensor(1)
+ultra = EV3UltrasonicSensor(2)
+color = EV3ColorSensor(3)
+left = Motor("A")
+right = Motor("D")
+
+BASE_DPS = 180
+GAIN = 120
+BLACK, WHITE = 10, 60  # ambients of the line and of the floor
+
+#####################
+### Line Follower ###
+#####################
+
+
+async def follow_line(bus):
+    async for ambient in bus.stream(color.get_ambient, rate=50):  # 50 readings per second
+        if ambient is None:
+            continue
+        error = 2 * (ambient - BLACK) / (WHITE - BLACK) - 1  # -1 on the line, 1 on the floor
+        await bus.call(left.set_dps, BASE_DPS + GAIN * error)
+        await bus.call(right.set_dps, BASE_DPS - GAIN * error)
+
+
+#################
+### Telemetry ###
+#################
+
+
+async def telemetry(bus):
+    async for encoders in bus.stream(lambda: (left.get_encoder(), right.get_encoder()), rate=2):
+        print("encoders", encoders)
+
+
+############
+### Main ###
+############
+
+
+async def main():
+    async with AsyncBrick() as bus:
+        await bus.wait_ready()  # all sensors
+        tasks = [
+            asyncio.ensure_future(follow_line(bus)),
+            asyncio.ensure_future(telemetry(bus)),
+            asyncio.ensure_future(bus.watch(touch.is_pressed)),  # emergency stop
+            asyncio.ensure_future(bus.watch_threshold(ultra.get_cm, below=10)),  # obstacle
+        ]
+        try:
+            # The watches end when their condition holds, the loops never end
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await bus.call(left.set_power, 0)
+            await bus.call(right.set_power, 0)
+        await bus.wait_stopped(left, timeout=2)
+
+
+asyncio.run(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+Resident runner, to start programs on the brick without a cold Python start.
+
+The server keeps an interpreter running with the slow modules (brickpi3, numpy,
+utils.brick, ...) already imported. For every run request it forks, and the child
+runs the entry point as __main__ with its output sent back to the client. If a
+preloaded module was changed since it was imported (eg. after a deploy), the
+server first restarts itself so that the new code is used.
+
+Usage (from the folder the entry point is relative to):
+    python3 scripts/brick_runner.py run project/move.py [args...]   # starts the server if needed
+    python3 scripts/brick_runner.py serve [project_dir]
+    python3 scripts/brick_runner.py stop
+"""
+
+import atexit
+import importlib
+import json
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SOCKET_PATH = "/tmp/brick_runner.sock"
+LOG_FILE = os.path.expanduser("~/brick_runner.log")
+PID_FILE = os.path.expanduser("~/brickpi3_pid")  # read by scripts/reset_brick.py
+PRELOAD = ("brickpi3", "spidev", "numpy", "simpleaudio", "utils.brick", "utils.sound")
+START_TIMEOUT = 10  # seconds to wait for a new server to accept connections
+
+# Lines sent by the server before the output of a run
+RUN, RESTART = b"RUN\n", b"RESTART\n"
+# Sent by the server after the output of a run, followed by the exit code and a newline
+EXIT_MARKER = b"\0brick_runner exit "
+
+
+def read_line(conn: socket.socket) -> bytes:
+    "Read one line from conn, without reading past it (what follows is program output)."
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = conn.recv(1)
+        if not byte:
+            break
+        line += byte
+    return line
+
+
+def preload(project_dir: str) -> dict:
+    "Import the PRELOAD modules. Return the modification time of every imported source file."
+    sys.path.insert(0, project_dir)
+    for name in PRELOAD:
+        try:
+            importlib.import_module(name)
+        except Exception as err:
+            print(f"Not preloading {name}: {err!r}", file=sys.stderr)
+    mtimes = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.exists(path):
+            mtimes[path] = os.path.getmtime(path)
+    return mtimes
+
+
+def is_stale(mtimes: dict) -> bool:
+    "Return True if a preloaded source file was changed or removed since it was imported."
+    for path, mtime in mtimes.items():
+        if not os.path.exists(path) or os.path.getmtime(path) != mtime:
+            return True
+    return False
+
+
+def run_child(conn: socket.socket, request: dict):
+    "In the forked child: run the entry point with its output sent to conn, then exit."
+    code = 0
+    try:
+        os.setsid()
+        with open(PID_FILE, "w") as f:
+            f.write(f"{os.getpid()}\n")
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        sys.stdout = os.fdopen(1, "w", buffering=1)
+        sys.stderr = os.fdopen(2, "w", buffering=1)
+
+        os.chdir(request["cwd"])
+        script = request["argv"][0]
+        sys.argv = list(request["argv"])
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as err:
+        code = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+        if not isinstance(err.code, int) and err.code is not None:
+            print(err.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        # Same cleanup as a normal interpreter exit (eg. reset the brick), but never
+        # return to the server loop
+        try:
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def handle(conn: socket.socket, mtimes: dict, project_dir: str):
+    "Serve one request on conn."
+    request = json.loads(read_line(conn))
+
+    if request.get("command") == "stop":
+        conn.sendall(b"STOPPING\n")
+        conn.close()
+        os.unlink(SOCKET_PATH)
+        sys.exit(0)
+
+    if is_stale(mtimes):
+        conn.sendall(RESTART)
+        conn.close()
+        os.unlink(SOCKET_PATH)
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__), "serve", project_dir])
+
+    conn.sendall(RUN)
+    pid = os.fork()
+    if pid == 0:
+        run_child(conn, request)
+
+    # Interrupt the program if the client goes away (eg. Ctrl+C)
+    interrupted = False
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            break
+        if interrupted:
+            time.sleep(0.1)
+            continue
+        readable, _, _ = select.select([conn], [], [], 0.1)
+        if readable and not conn.recv(1):
+            os.kill(pid, signal.SIGINT)
+            interrupted = True
+    code = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    try:
+        conn.sendall(EXIT_MARKER + f"{code}\n".encode())
+    except OSError:
+        pass
+    conn.close()
+
+
+def serve(project_dir: str):
+    "Run the server until a stop request."
+    mtimes = preload(os.path.abspath(project_dir))
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SOCKET_PATH)
+    server.listen(1)
+    print(f"brick_runner {os.getpid()} ready, {len(mtimes)} modules loaded", flush=True)
+    while True:
+        conn, _ = server.accept()
+        try:
+            handle(conn, mtimes, project_dir)
+        except (OSError, ValueError) as err:
+            print(f"Request failed: {err!r}", file=sys.stderr, flush=True)
+            conn.close()
+
+
+def connect(start: bool = True, timeout: float = START_TIMEOUT) -> socket.socket:
+    "Connect to the server, waiting up to timeout seconds for it. If start is True, start it if needed."
+    deadline = time.monotonic() + timeout
+    started = not start
+    while True:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(SOCKET_PATH)
+            return client
+        except OSError:
+            client.close()
+            if time.monotonic() > deadline:
+                raise
+        if not started:
+            with open(LOG_FILE, "a") as log:
+                subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "project"],
+                                 stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+            started = True
+        time.sleep(0.05)
+
+
+def run(argv: list) -> int:
+    "Ask the server to run argv, print its output, and return its exit code."
+    request = json.dumps({"command": "run", "argv": argv, "cwd": os.getcwd()}).encode() + b"\n"
+    client = connect()
+    while True:
+        client.sendall(request)
+        reply = read_line(client)
+        if reply == RUN:
+            break
+        client.close()
+        # The server restarts itself with the new code
+        client = connect(start=False)
+
+    code = 1
+    pending = b""
+    out = sys.stdout.buffer
+    interrupted = False
+    while True:
+        try:
+            data = client.recv(4096)
+        except KeyboardInterrupt:
+            if interrupted:
+                return 130
+            # The server interrupts the program when the client stops sending, keep
+            # printing its output until it exits
+            client.shutdown(socket.SHUT_WR)
+            interrupted = True
+            continue
+        if not data:
+            break
+        pending += data
+        # Hold back what could be the start of the exit marker
+        marker = pending.find(EXIT_MARKER)
+        keep = marker if marker >= 0 else max(0, len(pending) - len(EXIT_MARKER))
+        out.write(pending[:keep])
+        out.flush()
+        pending = pending[keep:]
+    if pending.startswith(EXIT_MARKER):
+        code = int(pending[len(EXIT_MARKER):].strip() or 1)
+    else:
+        out.write(pending)
+    return code
+
+
+if __name__ == "__main__":
+    "Main entry point."
+    if len(sys.argv) >= 3 and sys.argv[1] == "run":
+        sys.exit(run(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        serve(sys.argv[2] if len(sys.argv) >= 3 else "project")
+    elif len(sys.argv) == 2 and sys.argv[1] == "stop":
+        try:
+            client = connect(start=False, timeout=0)
+            client.sendall(b'{"command": "stop"}\n')
+            print(read_line(client).decode().strip())
+        except OSError:
+            print("brick_runner is not running")
+    else:
+        print(__doc__)
+        exit(1)